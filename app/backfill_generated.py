@@ -0,0 +1,165 @@
+#! /usr/bin/env python3
+
+# Script to generate the missing or outdated LogsGenerated entries (and
+# optionally the missing LogParameters) of all logs. The web server does not
+# parse log files for these in requests, so run this after upgrading (e.g. when
+# db_entry.GENERATED_VERSION changed) or importing DB entries.
+
+import sys
+import os
+import argparse
+import json
+import timeit
+from collections import OrderedDict
+from multiprocessing import Pool
+
+# this is needed for the following imports
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'plot_app'))
+from plot_app.config import get_log_storage, get_cache_filepath
+from plot_app.db_entry import DBDataGenerated, GENERATED_VERSION
+from plot_app.db_repository import get_metadata_repository
+from plot_app.log_parameters import extract_parameters
+
+#pylint: disable=invalid-name,broad-except
+
+
+def _get_tasks(need_parameters, skip_log_ids):
+    """ get the logs to process, grouped by file (logs with the same content
+    share the file, which is then parsed only once)
+    :return: list of (blob id, list of (log id, need generated, need parameters))
+    """
+    repository = get_metadata_repository()
+    tasks = OrderedDict()
+    needs = {}
+    for log_id, blob_id in repository.get_logs_to_generate(GENERATED_VERSION):
+        tasks.setdefault(blob_id, []).append(log_id)
+        needs[log_id] = [True, False]
+    if need_parameters:
+        for log_id, blob_id in repository.get_logs_without_parameters():
+            if log_id not in needs:
+                tasks.setdefault(blob_id, []).append(log_id)
+                needs[log_id] = [False, False]
+            needs[log_id][1] = True
+    ret = []
+    for blob_id, log_ids in tasks.items():
+        log_ids = [log_id for log_id in log_ids if log_id not in skip_log_ids]
+        if len(log_ids) > 0:
+            ret.append((blob_id, [(log_id, *needs[log_id]) for log_id in log_ids]))
+    return ret
+
+
+def _process_file(task):
+    """ worker: parse a log file and extract the missing data
+    :return: tuple (task, list of (log id, DBDataGenerated or None,
+             parameters or None), error or None)
+    """
+    blob_id, logs = task
+    try:
+        file_name = get_log_storage().get_local_filename(blob_id)
+        if not os.path.exists(file_name):
+            return task, [], 'log file not found'
+        # parameters are always loaded, no need for additional topics
+        ulog = DBDataGenerated.load_ulog(file_name)
+        db_data_gen = None
+        if any(need_generated for _, need_generated, _ in logs):
+            db_data_gen = DBDataGenerated.from_ulog(ulog)
+        parameters = None
+        if any(need_parameters for _, _, need_parameters in logs):
+            parameters = extract_parameters(ulog)
+        return task, [(log_id, db_data_gen if need_generated else None,
+                       parameters if need_parameters else None)
+                      for log_id, need_generated, need_parameters in logs], None
+    except Exception as error:
+        return task, [], '{}: {}'.format(type(error).__name__, error)
+
+
+class _Checkpoint:
+    """ state of previous runs: the logs that failed (e.g. corrupt files) are
+    skipped in the next run. The processed logs are stored in the DB in
+    batches, so an interrupted run continues where it stopped. """
+
+    def __init__(self, file_name):
+        self._file_name = file_name
+        self.failed = {}
+        if os.path.exists(file_name):
+            with open(file_name, 'r', encoding='utf-8') as checkpoint_file:
+                self.failed = json.load(checkpoint_file).get('failed', {})
+
+    def save(self):
+        """ write the checkpoint file (atomically) """
+        temp_file_name = self._file_name + '.tmp'
+        with open(temp_file_name, 'w', encoding='utf-8') as checkpoint_file:
+            json.dump({'failed': self.failed}, checkpoint_file, indent=1)
+        os.replace(temp_file_name, self._file_name)
+
+
+def _insert_batch(batch):
+    """ insert a batch of extracted data, entry by entry if some of it was
+    generated concurrently (e.g. by an upload) """
+    repository = get_metadata_repository()
+    if repository.insert_extracted_data(batch):
+        return
+    for entry in batch:
+        if not repository.insert_extracted_data([entry]):
+            print('Warning: {}: parameters already exist, skipped'.format(entry[0]))
+
+
+def main():
+    """ backfill the generated data """
+    parser = argparse.ArgumentParser(
+        description='Generate the missing or outdated LogsGenerated entries '
+        'from the log files')
+
+    parser.add_argument('--parameters', action='store_true', default=False,
+                        help='Also extract the missing LogParameters')
+    parser.add_argument('-j', '--jobs', action='store', type=int,
+                        default=os.cpu_count(),
+                        help='Number of worker processes (default=number of CPUs)')
+    parser.add_argument('--batch-size', action='store', type=int, default=100,
+                        help='Number of logs inserted per DB transaction (default=100)')
+    parser.add_argument('--checkpoint', action='store',
+                        default=os.path.join(get_cache_filepath(), 'backfill_generated.json'),
+                        help='Checkpoint file (default=<cache>/backfill_generated.json)')
+    parser.add_argument('--retry-failed', action='store_true', default=False,
+                        help='Retry the logs that failed in previous runs')
+
+    args = parser.parse_args()
+
+    checkpoint = _Checkpoint(args.checkpoint)
+    if args.retry_failed:
+        checkpoint.failed = {}
+    tasks = _get_tasks(args.parameters, set(checkpoint.failed))
+    num_logs = sum(len(logs) for _, logs in tasks)
+    print('{} logs to process ({} files, {} skipped because they failed before)'.format(
+        num_logs, len(tasks), len(checkpoint.failed)))
+    if num_logs == 0:
+        checkpoint.save()
+        return
+
+    num_done = 0
+    batch = []
+    start_time = timeit.default_timer()
+    with Pool(max(args.jobs, 1)) as pool:
+        for task, entries, error in pool.imap_unordered(_process_file, tasks):
+            if error is not None:
+                print('Error: {}: {}'.format(task[0], error))
+                for log_id, _, _ in task[1]:
+                    checkpoint.failed[log_id] = error
+            batch.extend(entries)
+            num_done += len(task[1])
+            if len(batch) >= args.batch_size:
+                _insert_batch(batch)
+                batch = []
+                checkpoint.save()
+                elapsed = timeit.default_timer() - start_time
+                print('{}/{} logs processed ({:.1f} logs/s)'.format(
+                    num_done, num_logs, num_done / elapsed))
+    _insert_batch(batch)
+    checkpoint.save()
+
+    print('Processed {} logs in {:.1f} s, {} failed'.format(
+        num_done, timeit.default_timer() - start_time, len(checkpoint.failed)))
+
+
+if __name__ == '__main__':
+    main()
@@ -6,7 +6,9 @@ import sys
 import os
 import argparse
 
-from plot_app.config import get_db_connection
+# this is needed for the following imports
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'plot_app'))
+from plot_app.db_repository import get_metadata_repository
 
 
 parser = argparse.ArgumentParser(description='Remove a DB entry (but not the log file)')
@@ -16,17 +18,9 @@ parser.add_argument('log_id', metavar='log-id', action='store', nargs='+',
 
 args = parser.parse_args()
 
-con = get_db_connection()
-with con:
-    cur = con.cursor()
-    for log_id in args.log_id:
-        print('Removing '+log_id)
-        cur.execute("DELETE FROM LogsGenerated WHERE Id = ?", (log_id,))
-        cur.execute("DELETE FROM Logs WHERE Id = ?", (log_id,))
-        num_deleted = cur.rowcount
-        if num_deleted != 1:
-            print('Error: not found ({})'.format(num_deleted))
-        con.commit()
-
-con.close()
-
+repository = get_metadata_repository()
+for log_id in args.log_id:
+    print('Removing '+log_id)
+    deleted, _ = repository.delete_logs([log_id])
+    if len(deleted) != 1:
+        print('Error: not found ({})'.format(len(deleted)))
@@ -6,18 +6,8 @@ import sys
 # this is needed for the following imports
 sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'plot_app'))
 from plot_app.overview_generator import generate_overview_img_from_id
-from plot_app.config import get_db_connection
+from plot_app.db_repository import get_metadata_repository
 
 # get the logs (but only the public ones)
-con = get_db_connection()
-cur = con.cursor()
-cur.execute('SELECT Id FROM Logs WHERE Public = 1 ORDER BY Date DESC')
-db_tuples = cur.fetchall()
-
-for db_row in db_tuples:    
-    log_id=db_row[0]
+for log_id, _, _ in get_metadata_repository().get_logs(public_only=True):
     generate_overview_img_from_id(log_id)
-
-cur.close()
-con.close()
-
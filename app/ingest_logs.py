@@ -0,0 +1,331 @@
+#! /usr/bin/env python3
+
+# Script to import many log files at once (e.g. to migrate or seed an instance),
+# without going through the upload page
+
+import sys
+import os
+import argparse
+import binascii
+import datetime
+import hashlib
+import tarfile
+import threading
+import timeit
+import uuid
+from html import escape
+from multiprocessing import Pool
+
+# this is needed for the following imports
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'plot_app'))
+from pyulog import ULog
+from plot_app.config import get_log_storage, get_overview_img_filepath
+from plot_app.db_entry import DBDataGenerated, DBVehicleData
+from plot_app.db_repository import get_metadata_repository
+from plot_app.helper import load_ulog_file, clear_ulog_cache, get_total_flight_time, \
+    get_blob_kml_filename, delete_log_file
+from plot_app.kml_generator import generate_kml_file
+from plot_app.log_parameters import extract_parameters
+from plot_app.overview_generator import generate_overview_img, copy_overview_img
+
+#pylint: disable=invalid-name,broad-except
+
+COPY_BUFFER_SIZE = 1024 * 1024
+
+
+def _new_log_id(storage):
+    while True:
+        log_id = str(uuid.uuid4())
+        if not storage.exists(log_id):
+            return log_id
+
+
+def _copy_to_staging(file_obj, staging_file_name):
+    """ copy a log file into the log storage staging file and check the header
+    :return: sha256 hex digest or None if it's not a ULog file
+    """
+    sha256 = hashlib.sha256()
+    header = file_obj.read(len(ULog.HEADER_BYTES))
+    if header != ULog.HEADER_BYTES:
+        return None
+    sha256.update(header)
+    with open(staging_file_name, 'wb') as staging_file:
+        staging_file.write(header)
+        for data in iter(lambda: file_obj.read(COPY_BUFFER_SIZE), b''):
+            sha256.update(data)
+            staging_file.write(data)
+    return sha256.hexdigest()
+
+
+def _iter_log_files(paths):
+    """ iterate the log files of a list of files, directories & tarballs
+    :return: generator of (file name or None, tar file, tar member or None,
+             original file name, modification time)
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, file_names in os.walk(path):
+                for file_name in sorted(file_names):
+                    if file_name.lower().endswith('.ulg'):
+                        full_name = os.path.join(root, file_name)
+                        yield full_name, None, None, file_name, os.path.getmtime(full_name)
+        elif tarfile.is_tarfile(path):
+            # sequential access, so that compressed archives are read only once
+            with tarfile.open(path, 'r|*') as tar:
+                for member in tar:
+                    if member.isfile() and member.name.lower().endswith('.ulg'):
+                        yield None, tar, member, os.path.basename(member.name), member.mtime
+        else:
+            yield path, None, None, os.path.basename(path), os.path.getmtime(path)
+
+
+def _generate_tasks(paths, pending):
+    """ generate the tasks for the worker processes. Tarball members are
+    extracted here (into the log storage staging file), as they can only be read
+    sequentially.
+    :param pending: semaphore limiting the number of tasks waiting to be
+                    processed (and thus extracted files)
+    """
+    storage = get_log_storage()
+    for file_name, tar, member, original_file_name, mtime in _iter_log_files(paths):
+        pending.acquire() #pylint: disable=consider-using-with
+        log_id = _new_log_id(storage)
+        content_hash = None
+        staging_file_name = None
+        if tar is not None:
+            staging_file_name = storage.get_staging_filename(log_id)
+            content_hash = _copy_to_staging(tar.extractfile(member), staging_file_name)
+            if content_hash is None:
+                os.unlink(staging_file_name)
+                staging_file_name = None
+        yield {'log_id': log_id, 'file_name': file_name,
+               'staging_file_name': staging_file_name, 'content_hash': content_hash,
+               'original_file_name': original_file_name, 'mtime': mtime,
+               'is_tar_member': tar is not None}
+
+
+# options of the worker processes (set by the pool initializer)
+_worker_options = {'overview': True, 'kml': False}
+
+def _init_worker(overview, kml):
+    _worker_options['overview'] = overview
+    _worker_options['kml'] = kml
+
+
+def _process_log(task):
+    """ worker: store a log file and extract everything needed for the DB
+    :return: dict with the task and 'error', or the extracted data
+    """
+    storage = get_log_storage()
+    log_id = task['log_id']
+    staging_file_name = task['staging_file_name']
+    result = {'task': task, 'error': None, 'duplicate_of': None}
+    try:
+        if task['is_tar_member']:
+            if staging_file_name is None:
+                result['error'] = 'not a ULog file'
+                return result
+        else:
+            staging_file_name = storage.get_staging_filename(log_id)
+            with open(task['file_name'], 'rb') as file_obj:
+                task['content_hash'] = _copy_to_staging(file_obj, staging_file_name)
+            if task['content_hash'] is None:
+                result['error'] = 'not a ULog file'
+                return result
+
+        # known content: reference the existing file, nothing to extract
+        duplicate = get_metadata_repository().find_log_by_content_hash(task['content_hash'])
+        if duplicate is not None:
+            result['duplicate_of'] = duplicate
+            return result
+
+        ulog = load_ulog_file(staging_file_name)
+        result['generated'] = DBDataGenerated.from_ulog(ulog)
+        result['parameters'] = extract_parameters(ulog)
+        result['vehicle_uuid'] = None
+        if 'sys_uuid' in ulog.msg_info_dict:
+            result['vehicle_uuid'] = escape(ulog.msg_info_dict['sys_uuid'])
+            result['flight_time'] = get_total_flight_time(ulog)
+        if _worker_options['overview']:
+            generate_overview_img(ulog, log_id)
+        if _worker_options['kml']:
+            try:
+                generate_kml_file(ulog, get_blob_kml_filename(log_id))
+            except KeyError: # no position data
+                pass
+        storage.commit(log_id, staging_file_name)
+        staging_file_name = None
+    except Exception as error:
+        result['error'] = '{}: {}'.format(type(error).__name__, error)
+    finally:
+        clear_ulog_cache()
+        if staging_file_name is not None and os.path.exists(staging_file_name):
+            os.unlink(staging_file_name)
+    return result
+
+
+class _Ingester:
+    """ collects the worker results and inserts them into the DB in batches """
+
+    def __init__(self, args):
+        self._args = args
+        self._repository = get_metadata_repository()
+        self._batch = []
+        self._content_hashes = {} # content hash -> (log id, blob id) of this run
+        self._vehicle_names = {}
+        self.num_ingested = 0
+        self.num_duplicates = 0
+        self.num_failed = 0
+
+    def _vehicle_data(self, result, log_id):
+        uuid_str = result['vehicle_uuid']
+        if uuid_str is None:
+            return None
+        if uuid_str not in self._vehicle_names:
+            db_vehicle_data = self._repository.get_vehicle(uuid_str)
+            self._vehicle_names[uuid_str] = '' if db_vehicle_data is None \
+                else db_vehicle_data.name
+        vehicle_data = DBVehicleData()
+        vehicle_data.uuid = uuid_str
+        vehicle_data.name = self._vehicle_names[uuid_str]
+        vehicle_data.log_id = log_id
+        if result['flight_time'] is not None:
+            vehicle_data.flight_time = result['flight_time']
+        return vehicle_data
+
+    def add(self, result):
+        """ add a worker result to the current batch """
+        task = result['task']
+        log_id = task['log_id']
+        if result['error'] is not None:
+            print('Error: {}: {}'.format(task['original_file_name'], result['error']))
+            self.num_failed += 1
+            return
+
+        content_hash = task['content_hash']
+        duplicate_of = result['duplicate_of']
+        if duplicate_of is None and content_hash in self._content_hashes:
+            # duplicate within this run: processed in parallel, drop the file
+            # (and the files generated from it) again
+            delete_log_file(log_id)
+            duplicate_of = self._content_hashes[content_hash]
+
+        args = self._args
+        date = datetime.datetime.now()
+        if args.use_file_date:
+            date = datetime.datetime.fromtimestamp(task['mtime'])
+        entry = {'columns': {
+            'Id': log_id, 'Title': '', 'Description': escape(args.description),
+            'OriginalFilename': task['original_file_name'], 'Date': date,
+            'AllowForAnalysis': 1, 'Obfuscated': 0, 'Source': args.source,
+            'Email': '', 'WindSpeed': -1, 'Rating': '', 'Feedback': '',
+            'Type': args.type, 'VideoUrl': '', 'ErrorLabels': '',
+            'Public': 1 if args.public else 0,
+            'Token': str(binascii.hexlify(os.urandom(16)), 'ascii'),
+            'ContentHash': content_hash, 'BlobId': log_id}}
+        if duplicate_of is not None:
+            entry['columns']['BlobId'] = duplicate_of[1]
+            entry['copy_from'] = duplicate_of[0]
+            if not args.no_overview:
+                copy_overview_img(duplicate_of[0], log_id)
+            self.num_duplicates += 1
+        else:
+            entry['generated'] = result['generated']
+            entry['parameters'] = result['parameters']
+            entry['vehicle'] = self._vehicle_data(result, log_id)
+            self._content_hashes[content_hash] = (log_id, log_id)
+        self._batch.append(entry)
+        if len(self._batch) >= args.batch_size:
+            self.flush()
+
+    def flush(self):
+        """ insert the current batch """
+        if len(self._batch) == 0:
+            return
+        batch = self._batch
+        self._batch = []
+        try:
+            self._repository.insert_logs(batch)
+        except Exception as error:
+            print('Error: inserting {} logs failed: {}: {}'.format(
+                len(batch), type(error).__name__, error))
+            self._remove_files(batch)
+            self.num_failed += len(batch)
+            return
+        self.num_ingested += len(batch)
+
+    def _remove_files(self, batch):
+        """ remove the stored files of a batch that was not inserted """
+        for entry in batch:
+            log_id = entry['columns']['Id']
+            print('Error: not ingested: {} (log id {})'.format(
+                entry['columns']['OriginalFilename'], log_id))
+            overview_image_filename = os.path.join(get_overview_img_filepath(),
+                                                   log_id+'.png')
+            if os.path.exists(overview_image_filename):
+                os.unlink(overview_image_filename)
+            if entry.get('copy_from') is not None:
+                self.num_duplicates -= 1
+            if entry['columns']['BlobId'] == log_id:
+                delete_log_file(log_id)
+                # later duplicates must not reference the file
+                self._content_hashes.pop(entry['columns']['ContentHash'], None)
+
+
+def main():
+    """ ingest the logs """
+    parser = argparse.ArgumentParser(
+        description='Import log files from directories and/or tarballs')
+
+    parser.add_argument('paths', metavar='path', nargs='+',
+                        help='.ulg file, directory (searched recursively) or tarball')
+    parser.add_argument('--source', action='store', default='ingest',
+                        help='Source DB entry tag (default=ingest)')
+    parser.add_argument('--type', action='store', default='personal',
+                        choices=['personal', 'flightreport'],
+                        help='Upload type (default=personal)')
+    parser.add_argument('--public', action='store_true', default=False,
+                        help='List the logs publicly (with --type flightreport)')
+    parser.add_argument('--description', action='store', default='',
+                        help='Description for all logs')
+    parser.add_argument('--use-file-date', action='store_true', default=False,
+                        help='Use the file modification time as upload date')
+    parser.add_argument('--no-overview', action='store_true', default=False,
+                        help='Do not generate the overview images')
+    parser.add_argument('--kml', action='store_true', default=False,
+                        help='Also generate the KML files')
+    parser.add_argument('-j', '--jobs', action='store', type=int,
+                        default=os.cpu_count(),
+                        help='Number of worker processes (default=number of CPUs)')
+    parser.add_argument('--batch-size', action='store', type=int, default=200,
+                        help='Number of logs inserted per DB transaction (default=200)')
+
+    args = parser.parse_args()
+    if args.public and args.type != 'flightreport':
+        parser.error('--public requires --type flightreport')
+
+    jobs = max(args.jobs, 1)
+    ingester = _Ingester(args)
+    # limit the number of extracted files waiting for a worker
+    pending = threading.BoundedSemaphore(4 * jobs)
+    start_time = timeit.default_timer()
+    with Pool(jobs, initializer=_init_worker,
+              initargs=(not args.no_overview, args.kml)) as pool:
+        for i, result in enumerate(pool.imap_unordered(
+                _process_log, _generate_tasks(args.paths, pending))):
+            pending.release()
+            ingester.add(result)
+            if (i + 1) % 100 == 0:
+                elapsed = timeit.default_timer() - start_time
+                print('{} logs processed ({:.1f} logs/s)'.format(i + 1, (i + 1) / elapsed))
+    ingester.flush()
+
+    elapsed = timeit.default_timer() - start_time
+    print('Ingested {} logs ({} duplicates) in {:.1f} s, {} failed'.format(
+        ingester.num_ingested, ingester.num_duplicates, elapsed, ingester.num_failed))
+    if ingester.num_failed > 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
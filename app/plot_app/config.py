@@ -1,7 +1,11 @@
 """ configuration variables """
 import configparser
 import os
-import sqlite3
+
+from db_pool import get_connection_pool
+from db_postgres import PostgresConnectionPool
+from log_storage import FilesystemLogStorage, S3LogStorage, LocalFileCache, \
+    create_s3_client, get_log_storage_instance
 
 #pylint: disable=invalid-name
 
@@ -41,7 +45,18 @@ __CESIUM_API_KEY = _conf.get('general', 'cesium_api_key')
 __CESIUM_ENABLE_BING_AERIAL = _conf.get('general', 'cesium_enable_bing_aerial')
 __LOG_CACHE_SIZE = int(_conf.get('general', 'log_cache_size'))
 __LOG_LOAD_TIMEOUT = int(_conf.get('general', 'log_load_timeout'))
+__PID_ANALYSIS_MEMORY_MB = int(_conf.get('general', 'pid_analysis_memory_mb'))
 __DB_FILENAME_CUSTOM = _conf.get('general', 'db_filename')
+__DB_POOL_SIZE = int(_conf.get('general', 'db_pool_size'))
+__DB_BACKEND = _conf.get('general', 'db_backend')
+__DB_POSTGRES_DSN = _conf.get('general', 'db_postgres_dsn')
+if __DB_BACKEND not in ('sqlite', 'postgresql'):
+    raise ValueError('Invalid db_backend: {}'.format(__DB_BACKEND))
+__LOG_STORAGE = _conf.get('general', 'log_storage')
+if __LOG_STORAGE not in ('filesystem', 's3'):
+    raise ValueError('Invalid log_storage: {}'.format(__LOG_STORAGE))
+__S3_CONFIG = dict(_conf.items('s3'))
+__DOWNLOAD_ACCEL_REDIRECT = _conf.get('general', 'download_accel_redirect')
 
 __STORAGE_PATH = _conf.get('general', 'storage_path')
 if not os.path.isabs(__STORAGE_PATH):
@@ -50,10 +65,12 @@ if not os.path.isabs(__STORAGE_PATH):
 __LOG_FILE_PATH = os.path.join(__STORAGE_PATH, 'log_files')
 __DB_FILENAME = os.path.join(__STORAGE_PATH, 'logs.sqlite')
 __CACHE_FILE_PATH = os.path.join(__STORAGE_PATH, 'cache')
+__LOG_CACHE_FILE_PATH = os.path.join(__CACHE_FILE_PATH, 'log_files')
 __AIRFRAMES_FILENAME = os.path.join(__CACHE_FILE_PATH, 'airframes.xml')
 __PARAMETERS_FILENAME = os.path.join(__CACHE_FILE_PATH, 'parameters.xml')
 __EVENTS_FILENAME = os.path.join(__CACHE_FILE_PATH, 'events.json.xz')
 __RELEASES_FILENAME = os.path.join(__CACHE_FILE_PATH, 'releases.json')
+__FFTW_WISDOM_FILENAME = os.path.join(__CACHE_FILE_PATH, 'fftw_wisdom.json')
 
 __PRINT_TIMING = int(_conf.get('debug', 'print_timing'))
 __VERBOSE_OUTPUT = int(_conf.get('debug', 'verbose_output'))
@@ -94,6 +111,10 @@ def get_http_protocol():
     """ get the protocol: either http or https """
     return __HTTP_PROTOCOL
 
+def get_storage_path():
+    """ get configured storage directory (contains logs, DB & cache) """
+    return __STORAGE_PATH
+
 def get_log_filepath():
     """ get configured log files directory """
     return __LOG_FILE_PATH
@@ -102,6 +123,10 @@ def get_cache_filepath():
     """ get configured cache directory """
     return __CACHE_FILE_PATH
 
+def get_log_cache_filepath():
+    """ get the directory of the local log file cache (for log_storage = s3) """
+    return __LOG_CACHE_FILE_PATH
+
 def get_kml_filepath():
     """ get configured KML files directory """
     return os.path.join(get_cache_filepath(), 'kml')
@@ -110,23 +135,45 @@ def get_overview_img_filepath():
     """ get configured overview image directory """
     return os.path.join(get_cache_filepath(), 'img')
 
+def get_pid_analysis_cache_filepath():
+    """ get the directory of the cached PID analysis results """
+    return os.path.join(get_cache_filepath(), 'pid_analysis')
+
+def get_spectral_analysis_cache_filepath():
+    """ get the directory of the cached spectral analysis results (FFT's &
+    spectrograms) """
+    return os.path.join(get_cache_filepath(), 'spectral_analysis')
+
+def get_download_accel_redirect():
+    """ get the nginx X-Accel-Redirect location prefix for log file downloads
+    ('' if disabled) """
+    return __DOWNLOAD_ACCEL_REDIRECT
+
 def get_db_filename():
     """ get configured DB file name """
     if __DB_FILENAME_CUSTOM != "":
         return __DB_FILENAME_CUSTOM
     return __DB_FILENAME
 
-def get_db_connection():
-    """ get a properly configured SQLite database connection with WAL mode
-    and a 30s busy timeout to handle contention from multiple workers """
-    con = sqlite3.connect(get_db_filename(),
-                          detect_types=sqlite3.PARSE_DECLTYPES,
-                          timeout=30)
-    result = con.execute('PRAGMA journal_mode=WAL').fetchone()
-    if result is None or result[0].lower() != 'wal':
-        print('Warning: failed to enable WAL mode, got: {}'.format(result))
-    con.execute('PRAGMA busy_timeout=30000')
-    return con
+def get_db_backend():
+    """ get the configured metadata DB backend: 'sqlite' or 'postgresql' """
+    return __DB_BACKEND
+
+def get_db_postgres_dsn():
+    """ get the libpq connection string of the PostgreSQL backend """
+    return __DB_POSTGRES_DSN
+
+def get_db_connection(read_only=False):
+    """ get a properly configured database connection. For SQLite with WAL mode
+    and a 30s busy timeout to handle contention from multiple workers.
+    The connection comes from a per-process pool: read-only connections are
+    shared, the SQLite write connection is serialized. close() returns it to
+    the pool. Queries use the qmark ('?') parameter style for all backends.
+    """
+    if __DB_BACKEND == 'postgresql':
+        return get_connection_pool(__DB_POSTGRES_DSN, __DB_POOL_SIZE,
+                                   PostgresConnectionPool).acquire(read_only)
+    return get_connection_pool(get_db_filename(), __DB_POOL_SIZE).acquire(read_only)
 
 def get_airframes_filename():
     """ get configured airframes file name """
@@ -148,6 +195,10 @@ def get_releases_filename():
     """ get configured releases file name """
     return __RELEASES_FILENAME
 
+def get_fftw_wisdom_filename():
+    """ get the file name of the stored FFTW wisdom (see fft_plans.py) """
+    return __FFTW_WISDOM_FILENAME
+
 def get_parameters_filename():
     """ get configured parameters file name """
     return __PARAMETERS_FILENAME
@@ -176,6 +227,10 @@ def get_log_load_timeout():
     """ get maximum seconds to spend loading a single log (0 = disabled) """
     return __LOG_LOAD_TIMEOUT
 
+def get_pid_analysis_memory_budget():
+    """ get the memory budget for the PID analysis temporary arrays in bytes """
+    return __PID_ANALYSIS_MEMORY_MB * 1024 * 1024
+
 def debug_print_timing():
     """ print timing information? """
     return __PRINT_TIMING == 1
@@ -194,3 +249,22 @@ def get_ulge_private_key_path():
     return __ENCRYPTION_KEY
 
 
+
+def get_log_storage():
+    """ get the configured log file storage of this process (see log_storage.py).
+    Log files should only be accessed via helper.get_log_filename() and this.
+    """
+    if __LOG_STORAGE == 's3':
+        def create():
+            num_connections = int(__S3_CONFIG['download_connections'])
+            client = create_s3_client(
+                __S3_CONFIG['endpoint_url'], __S3_CONFIG['access_key_id'],
+                __S3_CONFIG['secret_access_key'], num_connections)
+            cache = LocalFileCache(__LOG_CACHE_FILE_PATH,
+                                   int(__S3_CONFIG['cache_size_mb']) * 1024 * 1024)
+            return S3LogStorage(client, __S3_CONFIG['bucket'], __S3_CONFIG['prefix'],
+                                cache, num_connections,
+                                int(__S3_CONFIG['download_chunk_size_mb']) * 1024 * 1024)
+        return get_log_storage_instance('s3', create)
+    return get_log_storage_instance(
+        'filesystem', lambda: FilesystemLogStorage(__LOG_FILE_PATH))
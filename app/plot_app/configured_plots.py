@@ -26,8 +26,12 @@ from vtol_tailsitter import *
 
 
 def generate_plots(ulog, px4_ulog, db_data, vehicle_data, link_to_3d_page,
-                   link_to_pid_analysis_page):
-    """ create a list of bokeh plots (and widgets) to show """
+                   link_to_pid_analysis_page, log_metrics=None, spectral_analysis=None):
+    """ create a list of bokeh plots (and widgets) to show
+    :param log_metrics: LogMetrics of the log from the DB or None
+    :param spectral_analysis: SpectralAnalysis of the log (to cache the FFT's &
+                              spectrograms) or None
+    """
 
     plots = []
     data = ulog.data_list
@@ -85,44 +89,7 @@ def generate_plots(ulog, px4_ulog, db_data, vehicle_data, link_to_3d_page,
     flight_mode_changes = get_flight_mode_changes(ulog)
 
     # VTOL state changes & vehicle type
-    vtol_states = None
-    is_vtol = False
-    is_vtol_tailsitter = False
-    try:
-        cur_dataset = ulog.get_dataset('vehicle_status')
-        if np.amax(cur_dataset.data['is_vtol']) == 1:
-            is_vtol = True
-            # check if is tailsitter
-            is_vtol_tailsitter = ('is_vtol_tailsitter' in cur_dataset.data and
-                                  np.amax(cur_dataset.data['is_vtol_tailsitter']) == 1)
-            # find mode after transitions (states: 1=transition, 2=FW, 3=MC)
-            if 'vehicle_type' in cur_dataset.data:
-                vehicle_type_field = 'vehicle_type'
-                vtol_state_mapping = {2: 2, 1: 3}
-                vehicle_type = cur_dataset.data['vehicle_type']
-                in_transition_mode = cur_dataset.data['in_transition_mode']
-                vtol_states = []
-                for i in range(len(vehicle_type)):
-                    # a VTOL can change state also w/o in_transition_mode set
-                    # (e.g. in Manual mode)
-                    if i == 0 or in_transition_mode[i-1] != in_transition_mode[i] or \
-                        vehicle_type[i-1] != vehicle_type[i]:
-                        vtol_states.append((cur_dataset.data['timestamp'][i],
-                                            in_transition_mode[i]))
-
-            else: # COMPATIBILITY: old logs (https://github.com/PX4/Firmware/pull/11918)
-                vtol_states = cur_dataset.list_value_changes('in_transition_mode')
-                vehicle_type_field = 'is_rotary_wing'
-                vtol_state_mapping = {0: 2, 1: 3}
-            for i in range(len(vtol_states)):
-                if vtol_states[i][1] == 0:
-                    t = vtol_states[i][0]
-                    idx = np.argmax(cur_dataset.data['timestamp'] >= t) + 1
-                    vtol_states[i] = (t, vtol_state_mapping[
-                        cur_dataset.data[vehicle_type_field][idx]])
-            vtol_states.append((ulog.last_timestamp, -1))
-    except (KeyError, IndexError) as error:
-        vtol_states = None
+    vtol_states, is_vtol, is_vtol_tailsitter = get_vtol_states(ulog)
 
 
 
@@ -133,7 +100,8 @@ def generate_plots(ulog, px4_ulog, db_data, vehicle_data, link_to_3d_page,
 
     # info text on top (logging duration, max speed, ...)
     curdoc().template_variables['info_table_html'] = \
-        get_info_table_html(ulog, px4_ulog, db_data, vehicle_data, vtol_states)
+        get_info_table_html(ulog, px4_ulog, db_data, vehicle_data, vtol_states,
+                            log_metrics)
 
     curdoc().template_variables['error_labels_html'] = get_error_labels_html()
 
@@ -500,7 +468,8 @@ def generate_plots(ulog, px4_ulog, db_data, vehicle_data, link_to_3d_page,
 
     # actuator controls (Main) FFT (for filter & output noise analysis)
     data_plot = DataPlotFFT(data, plot_config, actuator_controls_0.torque_sp_topic,
-                            title='Actuator Controls FFT', y_range = Range1d(0, 0.01))
+                            title='Actuator Controls FFT', y_range = Range1d(0, 0.01),
+                            spectral_analysis=spectral_analysis)
     data_plot.add_graph(actuator_controls_0.torque_axes_field_names,
                         colors3, ['Roll', 'Pitch', 'Yaw'])
     if not data_plot.had_error:
@@ -522,7 +491,8 @@ def generate_plots(ulog, px4_ulog, db_data, vehicle_data, link_to_3d_page,
 
     # angular_velocity FFT (for filter & output noise analysis)
     data_plot = DataPlotFFT(data, plot_config, 'vehicle_angular_velocity',
-                            title='Angular Velocity FFT', y_range = Range1d(0, 0.01))
+                            title='Angular Velocity FFT', y_range = Range1d(0, 0.01),
+                            spectral_analysis=spectral_analysis)
     data_plot.add_graph(['xyz[0]', 'xyz[1]', 'xyz[2]'],
                         colors3, ['Rollspeed', 'Pitchspeed', 'Yawspeed'])
     if not data_plot.had_error:
@@ -541,7 +511,8 @@ def generate_plots(ulog, px4_ulog, db_data, vehicle_data, link_to_3d_page,
 
     # angular_acceleration FFT (for filter & output noise analysis)
     data_plot = DataPlotFFT(data, plot_config, 'vehicle_angular_acceleration',
-                            title='Angular Acceleration FFT')
+                            title='Angular Acceleration FFT',
+                            spectral_analysis=spectral_analysis)
     data_plot.add_graph(['xyz[0]', 'xyz[1]', 'xyz[2]'],
                         colors3, ['Roll accel', 'Pitch accel', 'Yaw accel'])
     if not data_plot.had_error:
@@ -692,7 +663,8 @@ def generate_plots(ulog, px4_ulog, db_data, vehicle_data, link_to_3d_page,
     # Acceleration Spectrogram
     data_plot = DataPlotSpec(data, plot_config, 'sensor_combined',
                              y_axis_label='[Hz]', title='Acceleration Power Spectral Density',
-                             plot_height='small', x_range=x_range)
+                             plot_height='small', x_range=x_range,
+                             spectral_analysis=spectral_analysis)
     data_plot.add_graph(['accelerometer_m_s2[0]', 'accelerometer_m_s2[1]', 'accelerometer_m_s2[2]'],
                         ['X', 'Y', 'Z'])
     if data_plot.finalize() is not None: plots.append(data_plot)
@@ -701,7 +673,8 @@ def generate_plots(ulog, px4_ulog, db_data, vehicle_data, link_to_3d_page,
     # Filtered Gyro (angular velocity) Spectrogram
     data_plot = DataPlotSpec(data, plot_config, 'vehicle_angular_velocity',
                              y_axis_label='[Hz]', title='Angular velocity Power Spectral Density',
-                             plot_height='small', x_range=x_range)
+                             plot_height='small', x_range=x_range,
+                             spectral_analysis=spectral_analysis)
     data_plot.add_graph(['xyz[0]', 'xyz[1]', 'xyz[2]'],
                         ['rollspeed', 'pitchspeed', 'yawspeed'])
 
@@ -712,7 +685,8 @@ def generate_plots(ulog, px4_ulog, db_data, vehicle_data, link_to_3d_page,
     data_plot = DataPlotSpec(data, plot_config, 'vehicle_angular_acceleration',
                              y_axis_label='[Hz]',
                              title='Angular acceleration Power Spectral Density',
-                             plot_height='small', x_range=x_range)
+                             plot_height='small', x_range=x_range,
+                             spectral_analysis=spectral_analysis)
     data_plot.add_graph(['xyz[0]', 'xyz[1]', 'xyz[2]'],
                         ['roll accel', 'pitch accel', 'yaw accel'])
 
@@ -749,7 +723,8 @@ def generate_plots(ulog, px4_ulog, db_data, vehicle_data, link_to_3d_page,
                                      y_axis_label='[Hz]',
                                      title=(f'Acceleration Power Spectral Density'
                                             f'(FIFO, IMU{instance})'),
-                                     plot_height='normal', x_range=x_range, topic_instance=instance)
+                                     plot_height='normal', x_range=x_range, topic_instance=instance,
+                                     spectral_analysis=spectral_analysis)
             data_plot.add_graph(['x', 'y', 'z'], ['X', 'Y', 'Z'])
             if data_plot.finalize() is not None: plots.append(data_plot)
 
@@ -788,7 +763,8 @@ def generate_plots(ulog, px4_ulog, db_data, vehicle_data, link_to_3d_page,
             data_plot = DataPlotSpec(data, plot_config, 'sensor_gyro_fifo_virtual',
                                      y_axis_label='[Hz]',
                                      title=f'Gyro Power Spectral Density (FIFO, IMU{instance})',
-                                     plot_height='normal', x_range=x_range, topic_instance=instance)
+                                     plot_height='normal', x_range=x_range, topic_instance=instance,
+                                     spectral_analysis=spectral_analysis)
             data_plot.add_graph(['x', 'y', 'z'], ['X', 'Y', 'Z'])
             if data_plot.finalize() is not None: plots.append(data_plot)
 
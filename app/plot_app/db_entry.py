@@ -5,7 +5,8 @@ from html import escape
 from pyulog import *
 from pyulog.px4 import *
 
-from helper import get_log_filename, load_ulog_file
+from helper import get_log_filename, load_ulog_file, get_vtol_states, list_value_changes
+from log_metrics import compute_log_metrics, LOG_METRICS_TOPICS
 
 #pylint: disable=missing-docstring, too-few-public-methods
 
@@ -72,6 +73,8 @@ class DBDataGenerated:
         self.flight_modes = set()
         self.vehicle_uuid = ''
         self.flight_mode_durations = [] # list of tuples of (mode, duration sec)
+        self.version = 0 # GENERATED_VERSION the data was extracted with
+        self.metrics = None # LogMetrics (see log_metrics.py), not read from the DB
         super().__init__()
 
     def flight_mode_durations_str(self):
@@ -80,74 +83,34 @@ class DBDataGenerated:
             ret.append(str(duration[0])+':'+str(duration[1]))
         return ','.join(ret)
 
+    def set_flight_modes(self, flight_mode_rows):
+        """ set flight_modes & flight_mode_durations from a list of
+        (mode, duration) tuples as returned by read_flight_modes() """
+        self.flight_modes = {mode for mode, _ in flight_mode_rows}
+        self.flight_mode_durations = [(mode, duration) for mode, duration
+                                      in flight_mode_rows if duration is not None]
+
     @classmethod
     def from_log_file(cls, log_id):
         """ initialize from a log file """
-        obj = cls()
-
         ulog_file_name = get_log_filename(log_id)
-        ulog = load_ulog_file(ulog_file_name)
-        px4_ulog = PX4ULog(ulog)
-
-        # extract information
-        max_duration_us = 86400 * 1000000  # 24h — anything beyond is a corrupted timestamp
-        duration_us = int(ulog.last_timestamp) - int(ulog.start_timestamp)
-        if duration_us < 0 or duration_us > max_duration_us or ulog.last_timestamp > 2**63:
-            obj.duration_s = 0
-        else:
-            obj.duration_s = int(duration_us // 1000000)
-        obj.mav_type = px4_ulog.get_mav_type()
-        obj.estimator = px4_ulog.get_estimator()
-        obj.sys_autostart_id = ulog.initial_parameters.get('SYS_AUTOSTART', 0)
-        obj.sys_hw = escape(ulog.msg_info_dict.get('ver_hw', ''))
-        obj.ver_sw = escape(ulog.msg_info_dict.get('ver_sw', ''))
-        version_info = ulog.get_version_info()
-        if version_info is not None:
-            obj.ver_sw_release = 'v{}.{}.{} {}'.format(*version_info)
-        obj.num_logged_errors = 0
-        obj.num_logged_warnings = 0
-        if 'sys_uuid' in ulog.msg_info_dict:
-            obj.vehicle_uuid = escape(ulog.msg_info_dict['sys_uuid'])
-
-        for m in ulog.logged_messages:
-            if m.log_level <= ord('3'):
-                obj.num_logged_errors += 1
-            if m.log_level == ord('4'):
-                obj.num_logged_warnings += 1
-
-        try:
-            cur_dataset = ulog.get_dataset('vehicle_status')
-            flight_mode_changes = cur_dataset.list_value_changes('nav_state')
-            obj.flight_modes = {int(x[1]) for x in flight_mode_changes}
-
-            # get the durations
-            # make sure the first entry matches the start of the logging
-            if len(flight_mode_changes) > 0:
-                flight_mode_changes[0] = (ulog.start_timestamp, flight_mode_changes[0][1])
-            flight_mode_changes.append((ulog.last_timestamp, -1))
-            for i in range(len(flight_mode_changes)-1):
-                flight_mode = int(flight_mode_changes[i][1])
-                flight_mode_duration = int((flight_mode_changes[i+1][0] -
-                                            flight_mode_changes[i][0]) / 1e6)
-                obj.flight_mode_durations.append((flight_mode, flight_mode_duration))
-
-        except (KeyError, IndexError) as error:
-            obj.flight_modes = set()
-
-        # logging start time & date
-        try:
-           # get the first non-zero timestamp
-            gps_data = ulog.get_dataset('vehicle_gps_position')
-            indices = np.nonzero(gps_data.data['time_utc_usec'])
-            if len(indices[0]) > 0:
-                obj.start_time_utc = int(gps_data.data['time_utc_usec'][indices[0][0]] / 1000000)
-        except:
-            # Ignore. Eg. if topic not found
-            pass
-
+        return cls.from_ulog(load_ulog_file(ulog_file_name))
 
+    @classmethod
+    def from_ulog(cls, ulog):
+        """ initialize from a loaded ULog, by running all registered extractors """
+        obj = cls()
+        for _, _, extractor in _GENERATED_EXTRACTORS:
+            extractor(obj, ulog)
+        obj.version = GENERATED_VERSION
         return obj
 
+    @staticmethod
+    def load_ulog(file_name):
+        """ load a ULog file with only the topics needed by the extractors
+        (a single pass over the file, faster than helper.load_ulog_file) """
+        return ULog(file_name, get_generated_topics(), disable_str_exceptions=True)
+
     def to_json_dict(self):
         jsondict = {}
         jsondict['duration_s'] = int(self.duration_s)
@@ -164,6 +127,104 @@ class DBDataGenerated:
         jsondict['flight_mode_durations'] = self.flight_mode_durations
         return jsondict
 
+
+# Extractors of the generated data: list of (version, topics, function) tuples.
+# All extractors run on the same ULog, loaded once with the union of their
+# topics. To add a derived value, register a new extractor with the next
+# version (and add its column); to change one, bump its version. Rows with an
+# older version are then recomputed by backfill_generated.py.
+_GENERATED_EXTRACTORS = []
+
+def generated_extractor(version, topics=()):
+    """
+    decorator to register an extractor function(db_data_gen, ulog) that sets
+    attributes of a DBDataGenerated
+    :param version: generated data version in which the extractor was added or
+                    last changed
+    :param topics: topics the extractor reads the data of
+    """
+    def register(extractor):
+        _GENERATED_EXTRACTORS.append((version, tuple(topics), extractor))
+        return extractor
+    return register
+
+def get_generated_topics():
+    """ :return: sorted list of the topics needed by the extractors """
+    return sorted({topic for _, topics, _ in _GENERATED_EXTRACTORS for topic in topics})
+
+
+@generated_extractor(1)
+def _extract_info(obj, ulog):
+    px4_ulog = PX4ULog(ulog)
+    max_duration_us = 86400 * 1000000  # 24h — anything beyond is a corrupted timestamp
+    duration_us = int(ulog.last_timestamp) - int(ulog.start_timestamp)
+    if duration_us < 0 or duration_us > max_duration_us or ulog.last_timestamp > 2**63:
+        obj.duration_s = 0
+    else:
+        obj.duration_s = int(duration_us // 1000000)
+    obj.mav_type = px4_ulog.get_mav_type()
+    obj.estimator = px4_ulog.get_estimator()
+    obj.sys_autostart_id = ulog.initial_parameters.get('SYS_AUTOSTART', 0)
+    obj.sys_hw = escape(ulog.msg_info_dict.get('ver_hw', ''))
+    obj.ver_sw = escape(ulog.msg_info_dict.get('ver_sw', ''))
+    version_info = ulog.get_version_info()
+    if version_info is not None:
+        obj.ver_sw_release = 'v{}.{}.{} {}'.format(*version_info)
+    if 'sys_uuid' in ulog.msg_info_dict:
+        obj.vehicle_uuid = escape(ulog.msg_info_dict['sys_uuid'])
+
+@generated_extractor(1)
+def _extract_logged_messages(obj, ulog):
+    obj.num_logged_errors = 0
+    obj.num_logged_warnings = 0
+    for m in ulog.logged_messages:
+        if m.log_level <= ord('3'):
+            obj.num_logged_errors += 1
+        if m.log_level == ord('4'):
+            obj.num_logged_warnings += 1
+
+@generated_extractor(1, ['vehicle_status'])
+def _extract_flight_modes(obj, ulog):
+    try:
+        cur_dataset = ulog.get_dataset('vehicle_status')
+        flight_mode_changes = list_value_changes(cur_dataset, 'nav_state')
+        obj.flight_modes = {int(x[1]) for x in flight_mode_changes}
+
+        # get the durations
+        # make sure the first entry matches the start of the logging
+        if len(flight_mode_changes) > 0:
+            flight_mode_changes[0] = (ulog.start_timestamp, flight_mode_changes[0][1])
+        flight_mode_changes.append((ulog.last_timestamp, -1))
+        for i in range(len(flight_mode_changes)-1):
+            flight_mode = int(flight_mode_changes[i][1])
+            flight_mode_duration = int((flight_mode_changes[i+1][0] -
+                                        flight_mode_changes[i][0]) / 1e6)
+            obj.flight_mode_durations.append((flight_mode, flight_mode_duration))
+
+    except (KeyError, IndexError) as error:
+        obj.flight_modes = set()
+
+@generated_extractor(1, ['vehicle_gps_position'])
+def _extract_start_time(obj, ulog):
+    # logging start time & date
+    try:
+       # get the first non-zero timestamp
+        gps_data = ulog.get_dataset('vehicle_gps_position')
+        indices = np.nonzero(gps_data.data['time_utc_usec'])
+        if len(indices[0]) > 0:
+            obj.start_time_utc = int(gps_data.data['time_utc_usec'][indices[0][0]] / 1000000)
+    except:
+        # Ignore. Eg. if topic not found
+        pass
+
+@generated_extractor(2, LOG_METRICS_TOPICS)
+def _extract_metrics(obj, ulog):
+    obj.metrics = compute_log_metrics(ulog, get_vtol_states(ulog)[0])
+
+# current version of the generated data (LogsGenerated.GeneratedVersion)
+GENERATED_VERSION = max(version for version, _, _ in _GENERATED_EXTRACTORS)
+
+
 class DBVehicleData:
     """ simple class that contains information from the DB entry of a vehicle """
     def __init__(self):
@@ -172,3 +233,79 @@ class DBVehicleData:
         self.name = ''
         self.flight_time = 0
 
+
+
+def sql_chunks(values, chunk_size=500):
+    """ split a list into chunks (to stay below the SQL variable limit) """
+    values = list(values)
+    for i in range(0, len(values), chunk_size):
+        yield values[i:i + chunk_size]
+
+def read_flight_modes(cur, log_ids):
+    """
+    read the flight modes of a set of logs from the LogFlightModes table
+    :param cur: db cursor
+    :param log_ids: iterable of log ids
+    :return: dict with key=log id and value=list of (mode, duration sec) tuples,
+             in the order of occurrence. duration is None if unknown.
+    """
+    ret = {}
+    for chunk in sql_chunks(log_ids):
+        cur.execute('select LogId, Mode, Duration from LogFlightModes '
+                    'where LogId in ({}) order by LogId, Seq'.format(
+                        ','.join('?' * len(chunk))), chunk)
+        for log_id, mode, duration in cur.fetchall():
+            ret.setdefault(log_id, []).append((mode, duration))
+    return ret
+
+def write_flight_modes(cur, log_id, flight_mode_durations):
+    """
+    insert the flight modes of a log into the LogFlightModes table
+    :param flight_mode_durations: list of (mode, duration sec) tuples
+    """
+    cur.executemany('insert into LogFlightModes (LogId, Seq, Mode, Duration) '
+                    'values (?, ?, ?, ?)',
+                    [(log_id, i, mode, duration) for i, (mode, duration)
+                     in enumerate(flight_mode_durations)])
+
+def read_error_labels(cur, log_ids):
+    """
+    read the error labels of a set of logs from the LogErrorLabels table
+    :return: dict with key=log id and value=sorted list of error label ids
+    """
+    ret = {}
+    for chunk in sql_chunks(log_ids):
+        cur.execute('select LogId, Label from LogErrorLabels '
+                    'where LogId in ({}) order by LogId, Label'.format(
+                        ','.join('?' * len(chunk))), chunk)
+        for log_id, label in cur.fetchall():
+            ret.setdefault(log_id, []).append(label)
+    return ret
+
+def write_error_labels(cur, log_id, error_labels):
+    """
+    replace the error labels of a log (LogErrorLabels table and the legacy
+    comma-separated Logs.ErrorLabels column)
+    :param error_labels: list of error label ids
+    """
+    error_labels = sorted(set(error_labels))
+    cur.execute('delete from LogErrorLabels where LogId = ?', [log_id])
+    cur.executemany('insert into LogErrorLabels (LogId, Label) values (?, ?)',
+                    [(log_id, label) for label in error_labels])
+    cur.execute('update Logs set ErrorLabels = ? where Id = ?',
+                [','.join(map(str, error_labels)), log_id])
+
+# child tables of a log (with a LogId column)
+_LOG_RELATION_TABLES = ['LogFlightModes', 'LogErrorLabels', 'LogParameters',
+                        'LogParameterChanges', 'LogMetrics']
+
+def delete_log_relations(cur, log_id):
+    """ delete all the child table entries of a log """
+    delete_logs_relations(cur, [log_id])
+
+def delete_logs_relations(cur, log_ids):
+    """ delete all the child table entries of a set of logs """
+    for chunk in sql_chunks(log_ids):
+        for table in _LOG_RELATION_TABLES:
+            cur.execute('delete from {} where LogId in ({})'.format(
+                table, ','.join('?' * len(chunk))), chunk)
@@ -0,0 +1,246 @@
+""" per-process SQLite connection pool """
+
+import os
+import sqlite3
+import threading
+from timeit import default_timer as timer
+
+#pylint: disable=too-many-instance-attributes,invalid-name
+
+
+class PoolStatistics:
+    """ wait time & query latency instrumentation of a connection pool """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.num_connects = 0
+        self.num_acquires = {'read': 0, 'write': 0}
+        self.wait_time = {'read': 0., 'write': 0.}
+        self.max_wait_time = {'read': 0., 'write': 0.}
+        self.num_queries = 0
+        self.query_time = 0.
+        self.max_query_time = 0.
+        self.max_query = ''
+
+    def add_wait(self, kind, wait_time):
+        """ record the time spent waiting for a connection """
+        with self._lock:
+            self.num_acquires[kind] += 1
+            self.wait_time[kind] += wait_time
+            self.max_wait_time[kind] = max(self.max_wait_time[kind], wait_time)
+
+    def add_query(self, sql, query_time):
+        """ record the latency of a query """
+        with self._lock:
+            self.num_queries += 1
+            self.query_time += query_time
+            if query_time > self.max_query_time:
+                self.max_query_time = query_time
+                self.max_query = sql
+
+    def __str__(self):
+        ret = 'DB pool: {:} connects'.format(self.num_connects)
+        for kind in ('read', 'write'):
+            num = self.num_acquires[kind]
+            ret += ', {:}: {:} acquires, avg wait {:.3} ms, max wait {:.3} ms'.format(
+                kind, num, 1000 * self.wait_time[kind] / max(num, 1),
+                1000 * self.max_wait_time[kind])
+        ret += ', {:} queries, avg {:.3} ms, max {:.3} ms ({:})'.format(
+            self.num_queries, 1000 * self.query_time / max(self.num_queries, 1),
+            1000 * self.max_query_time, self.max_query[:80])
+        return ret
+
+
+class _TimedCursor(sqlite3.Cursor):
+    """ cursor that records the query latency in the pool statistics """
+
+    def execute(self, sql, parameters=()):
+        """ execute a query """
+        start_time = timer()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self.connection.statistics.add_query(sql, timer() - start_time)
+
+    def executemany(self, sql, seq_of_parameters):
+        """ execute a query for each set of parameters """
+        start_time = timer()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self.connection.statistics.add_query(sql, timer() - start_time)
+
+
+class PooledConnection(sqlite3.Connection):
+    """
+    SQLite connection that belongs to a ConnectionPool: close() returns it to
+    the pool instead of closing it. Since the connection is long-lived, its
+    prepared statement cache is reused across requests.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pool = None
+        self.read_only = False
+        self.statistics = None
+        self.last_used = timer()
+
+    #pylint: disable=arguments-differ,useless-parent-delegation
+    def cursor(self, factory=_TimedCursor):
+        """ create a cursor (with query timing by default) """
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        """ execute a query with a new cursor """
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        """ execute a query for each set of parameters with a new cursor """
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def close(self):
+        """ return the connection to the pool """
+        if self.pool is None:
+            super().close()
+        else:
+            self.pool.release(self)
+
+    def discard(self):
+        """ really close the connection """
+        self.pool = None
+        super().close()
+
+
+class ConnectionPool:
+    """
+    Pool of SQLite connections to a single DB file.
+    Read connections are shared (up to pool_size idle connections are kept,
+    more are opened on demand), while there is a single writer connection
+    that is serialized by a lock (SQLite only allows one writer anyway).
+    """
+
+    # idle time after which a connection is checked before handing it out
+    HEALTH_CHECK_INTERVAL = 60
+
+    def __init__(self, filename, pool_size, cached_statements=256, timeout=30):
+        self._filename = filename
+        self._pool_size = pool_size
+        self._cached_statements = cached_statements
+        self._timeout = timeout
+        self._lock = threading.Lock()
+        self._idle_readers = []
+        self._writer = None
+        self._writer_lock = threading.RLock()
+        self._writer_depth = 0
+        self.statistics = PoolStatistics()
+
+    def _connect(self, read_only):
+        con = sqlite3.connect(self._filename,
+                              detect_types=sqlite3.PARSE_DECLTYPES,
+                              timeout=self._timeout,
+                              cached_statements=self._cached_statements,
+                              check_same_thread=False,
+                              factory=PooledConnection)
+        con.statistics = self.statistics
+        result = con.execute('PRAGMA journal_mode=WAL').fetchone()
+        if result is None or result[0].lower() != 'wal':
+            print('Warning: failed to enable WAL mode, got: {}'.format(result))
+        con.execute('PRAGMA busy_timeout={:}'.format(int(self._timeout * 1000)))
+        if read_only:
+            con.execute('PRAGMA query_only=ON')
+        con.read_only = read_only
+        con.pool = self
+        self.statistics.num_connects += 1
+        return con
+
+    def _check_health(self, con):
+        """ :return: True if the connection is still usable """
+        if timer() - con.last_used < self.HEALTH_CHECK_INTERVAL:
+            return True
+        try:
+            con.execute('SELECT 1').fetchone()
+            return True
+        except sqlite3.Error as error:
+            print('Discarding broken DB connection: {}'.format(error))
+            con.discard()
+            return False
+
+    def acquire(self, read_only=False):
+        """ get a connection from the pool. Use close() to give it back.
+        :param read_only: if True, get a shared connection that cannot write
+        """
+        start_time = timer()
+        if read_only:
+            con = None
+            while con is None:
+                with self._lock:
+                    con = self._idle_readers.pop() if self._idle_readers else None
+                if con is None:
+                    con = self._connect(True)
+                elif not self._check_health(con):
+                    con = None
+            self.statistics.add_wait('read', timer() - start_time)
+            return con
+
+        if not self._writer_lock.acquire(timeout=self._timeout): #pylint: disable=consider-using-with
+            raise sqlite3.OperationalError('timed out waiting for the DB writer connection')
+        try:
+            self._writer_depth += 1
+            if self._writer is None or not self._check_health(self._writer):
+                self._writer = self._connect(False)
+        except:
+            self._writer_depth -= 1
+            self._writer_lock.release()
+            raise
+        self.statistics.add_wait('write', timer() - start_time)
+        return self._writer
+
+    def release(self, con):
+        """ return a connection to the pool. Uncommitted changes are rolled
+        back (as they would be when closing a connection) """
+        con.last_used = timer()
+        if con.read_only:
+            if con.in_transaction:
+                con.rollback()
+            with self._lock:
+                if len(self._idle_readers) < self._pool_size:
+                    self._idle_readers.append(con)
+                    return
+            con.discard()
+            return
+
+        self._writer_depth -= 1
+        try:
+            if self._writer_depth == 0 and con.in_transaction:
+                con.rollback()
+        finally:
+            self._writer_lock.release()
+
+
+_pools = {}
+_pools_pid = None
+_inherited_pools = [] # keep references, so that GC does not close the parent's connections
+_pools_lock = threading.Lock()
+
+def get_connection_pool(filename, pool_size, pool_class=ConnectionPool):
+    """ get the connection pool of the current process for a DB file (or
+    another pool_class, e.g. for a DSN).
+    A forked worker process gets new pools (connections must not be shared
+    across processes). """
+    global _pools_pid #pylint: disable=global-statement
+    with _pools_lock:
+        if _pools_pid != os.getpid():
+            _inherited_pools.extend(_pools.values())
+            _pools.clear()
+            _pools_pid = os.getpid()
+        pool = _pools.get(filename)
+        if pool is None:
+            pool = pool_class(filename, pool_size)
+            _pools[filename] = pool
+        return pool
+
+def print_pool_info():
+    """ print the statistics of all connection pools of this process """
+    with _pools_lock:
+        for pool in _pools.values():
+            print(pool.statistics)
@@ -0,0 +1,201 @@
+""" per-process PostgreSQL connection pool (optional backend, needs psycopg2) """
+
+import re
+import threading
+from timeit import default_timer as timer
+
+from db_pool import PoolStatistics
+
+#pylint: disable=import-outside-toplevel,invalid-name
+
+
+# string literals & quoted identifiers (left as is), '?' and '%'
+_QUERY_TOKENS = re.compile(r"""('(?:[^']|'')*'|"(?:[^"]|"")*")|(\?)|(%)""")
+
+def _convert_query(sql):
+    """ convert a query from the qmark ('?') to the psycopg2 ('%s') paramstyle.
+    '?' inside string literals and quoted identifiers is not a parameter, while
+    '%' must be escaped everywhere. """
+    def replace(match):
+        if match.group(2):
+            return '%s'
+        if match.group(3):
+            return '%%'
+        return match.group(1).replace('%', '%%')
+    return _QUERY_TOKENS.sub(replace, sql)
+
+
+class _PostgresCursor:
+    """ DB-API cursor wrapper accepting qmark-style queries (like sqlite3) """
+
+    def __init__(self, cursor, statistics):
+        self._cursor = cursor
+        self._statistics = statistics
+
+    def execute(self, sql, parameters=()):
+        """ execute a query """
+        start_time = timer()
+        try:
+            self._cursor.execute(_convert_query(sql), tuple(parameters))
+        finally:
+            self._statistics.add_query(sql, timer() - start_time)
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        """ execute a query for each set of parameters """
+        start_time = timer()
+        try:
+            self._cursor.executemany(_convert_query(sql),
+                                     [tuple(p) for p in seq_of_parameters])
+        finally:
+            self._statistics.add_query(sql, timer() - start_time)
+        return self
+
+    def fetchone(self):
+        """ fetch the next row or None """
+        return self._cursor.fetchone()
+
+    def fetchall(self):
+        """ fetch all remaining rows """
+        return self._cursor.fetchall()
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    @property
+    def rowcount(self):
+        """ number of rows affected by the last query """
+        return self._cursor.rowcount
+
+    def close(self):
+        """ close the cursor """
+        self._cursor.close()
+
+
+class PostgresConnection:
+    """
+    Connection from a PostgresConnectionPool, with the same interface as the
+    sqlite3 connections used in the rest of the code: qmark parameters,
+    'with con:' commits or rolls back, and close() returns it to the pool.
+    """
+
+    def __init__(self, pool, connection, read_only):
+        self._pool = pool
+        self._connection = connection
+        self.read_only = read_only
+        self.IntegrityError = pool.psycopg2.IntegrityError
+
+    @property
+    def raw_connection(self):
+        """ the underlying psycopg2 connection """
+        return self._connection
+
+    @property
+    def in_transaction(self):
+        """ True if a transaction is active """
+        extensions = self._pool.psycopg2.extensions
+        return self._connection.get_transaction_status() != \
+            extensions.TRANSACTION_STATUS_IDLE
+
+    def cursor(self):
+        """ create a cursor """
+        return _PostgresCursor(self._connection.cursor(), self._pool.statistics)
+
+    def execute(self, sql, parameters=()):
+        """ execute a query with a new cursor """
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        """ execute a query for each set of parameters with a new cursor """
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        """ commit the current transaction """
+        self._connection.commit()
+
+    def rollback(self):
+        """ roll back the current transaction """
+        self._connection.rollback()
+
+    def close(self):
+        """ return the connection to the pool """
+        if self._connection is not None:
+            self._pool.release(self._connection, self.read_only)
+            self._connection = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+        return False
+
+
+class PostgresConnectionPool:
+    """
+    Pool of PostgreSQL connections, with the same interface as
+    db_pool.ConnectionPool. Read connections use read-only sessions. Writers
+    are not serialized (PostgreSQL handles concurrent writers), which allows
+    multiple app nodes to share the metadata. When all connections are in use,
+    acquire() waits for one to be released (up to timeout seconds).
+    """
+
+    def __init__(self, dsn, pool_size, timeout=30):
+        try:
+            import psycopg2
+            import psycopg2.pool
+        except ImportError as error:
+            raise ImportError('The PostgreSQL DB backend requires psycopg2 '
+                              '(pip install psycopg2-binary)') from error
+        self.psycopg2 = psycopg2
+        self.statistics = PoolStatistics()
+        self._timeout = timeout
+        # connections are opened on demand, up to 4x the number of idle ones
+        # kept by the SQLite pool
+        max_connections = 4 * max(pool_size, 1)
+        self._pools = {
+            kind: psycopg2.pool.ThreadedConnectionPool(0, max_connections, dsn)
+            for kind in ('read', 'write')}
+        # ThreadedConnectionPool.getconn() fails instead of waiting when all
+        # connections are used, so the callers wait for a free slot here
+        self._slots = {kind: threading.BoundedSemaphore(max_connections)
+                       for kind in ('read', 'write')}
+
+    def acquire(self, read_only=False):
+        """ get a connection from the pool. Use close() to give it back. """
+        kind = 'read' if read_only else 'write'
+        start_time = timer()
+        if not self._slots[kind].acquire(timeout=self._timeout): #pylint: disable=consider-using-with
+            raise self.psycopg2.pool.PoolError(
+                'timed out waiting for a DB {} connection'.format(kind))
+        try:
+            while True:
+                connection = self._pools[kind].getconn()
+                if not connection.closed:
+                    break
+                # health check: drop connections closed by the server
+                self._pools[kind].putconn(connection, close=True)
+        except:
+            self._slots[kind].release()
+            raise
+        if connection.readonly != read_only:
+            try:
+                connection.set_session(readonly=read_only)
+            except:
+                self.release(connection, read_only)
+                raise
+        self.statistics.add_wait(kind, timer() - start_time)
+        return PostgresConnection(self, connection, read_only)
+
+    def release(self, connection, read_only):
+        """ return a connection to the pool, rolling back uncommitted changes """
+        if not connection.closed:
+            connection.rollback()
+        kind = 'read' if read_only else 'write'
+        try:
+            self._pools[kind].putconn(connection, close=bool(connection.closed))
+        finally:
+            self._slots[kind].release()
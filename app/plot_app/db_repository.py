@@ -0,0 +1,689 @@
+""" Repository for the log metadata (Logs, LogsGenerated, LogMetrics,
+LogParameters and Vehicle tables).
+
+All metadata access of the handlers and scripts goes through here, so that the
+SQL works with every DB backend (see config.get_db_connection).
+"""
+
+from contextlib import contextmanager
+
+from config import get_db_connection, get_db_backend
+from db_entry import DBData, DBDataGenerated, DBVehicleData, read_flight_modes, \
+    write_flight_modes, read_error_labels, write_error_labels, delete_logs_relations, \
+    sql_chunks
+from log_metrics import LOG_METRICS_COLUMNS
+
+#pylint: disable=too-many-public-methods
+
+
+# columns of the Logs table that can be set by insert_log()
+LOGS_COLUMNS = ['Id', 'Title', 'Description', 'OriginalFilename', 'Date',
+                'AllowForAnalysis', 'Obfuscated', 'Source', 'Email', 'WindSpeed',
+                'Rating', 'Feedback', 'Type', 'VideoUrl', 'ErrorLabels', 'Public',
+                'Token', 'ContentHash', 'BlobId']
+
+LOGS_GENERATED_COLUMNS = ['Id', 'Duration', 'MavType', 'Estimator', 'AutostartId',
+                          'Hardware', 'Software', 'NumLoggedErrors',
+                          'NumLoggedWarnings', 'FlightModes', 'SoftwareVersion',
+                          'UUID', 'FlightModeDurations', 'StartTime',
+                          'GeneratedVersion']
+
+
+class _ColumnNames(set):
+    """ set of column names with case-insensitive lookup (PostgreSQL folds
+    unquoted identifiers to lower case) """
+
+    def __contains__(self, name):
+        return super().__contains__(name.lower())
+
+
+def get_table_columns(cur, table_name):
+    """ get the column names of a table (empty if the table does not exist)
+    :return: set-like object supporting case-insensitive 'in'
+    """
+    if get_db_backend() == 'postgresql':
+        cur.execute('SELECT column_name FROM information_schema.columns '
+                    'WHERE table_schema = current_schema() AND table_name = ?',
+                    [table_name.lower()])
+        return _ColumnNames(x[0].lower() for x in cur.fetchall())
+    cur.execute("PRAGMA table_info('{}')".format(table_name))
+    return _ColumnNames(x[1].lower() for x in cur.fetchall())
+
+
+def generated_from_tuple(db_tuple, flight_mode_rows):
+    """ create a DBDataGenerated from a 'select * from LogsGenerated' tuple
+    :param flight_mode_rows: rows from read_flight_modes() for that log
+    """
+    db_data_gen = DBDataGenerated()
+    db_data_gen.duration_s = db_tuple[1]
+    db_data_gen.mav_type = db_tuple[2]
+    db_data_gen.estimator = db_tuple[3]
+    db_data_gen.sys_autostart_id = db_tuple[4]
+    db_data_gen.sys_hw = db_tuple[5]
+    db_data_gen.ver_sw = db_tuple[6]
+    db_data_gen.num_logged_errors = db_tuple[7]
+    db_data_gen.num_logged_warnings = db_tuple[8]
+    db_data_gen.ver_sw_release = db_tuple[10]
+    db_data_gen.vehicle_uuid = db_tuple[11]
+    db_data_gen.start_time_utc = db_tuple[13]
+    db_data_gen.version = db_tuple[14]
+    db_data_gen.set_flight_modes(flight_mode_rows)
+    return db_data_gen
+
+
+def _check_log_metrics_column(column):
+    # column names are part of the SQL
+    if column not in LOG_METRICS_COLUMNS:
+        raise ValueError('Unknown LogMetrics column: ' + str(column))
+
+def get_log_metrics_where(metric_filters):
+    """ get the SQL conditions (for a query on the Logs table) of LogMetrics
+    filters
+    :param metric_filters: list of (LogMetrics column, min or None, max or
+                           None) tuples
+    :return: tuple (' AND ...' conditions, list of params)
+    """
+    where = ''
+    params = []
+    for column, min_value, max_value in metric_filters:
+        _check_log_metrics_column(column)
+        for value, operator in [(min_value, '>='), (max_value, '<=')]:
+            if value is not None:
+                where += ' AND Logs.Id IN (SELECT LogId FROM LogMetrics ' \
+                    'WHERE {} {} ?)'.format(column, operator)
+                params.append(value)
+    return where, params
+
+def get_log_metrics_order(column, descending):
+    """ get the SQL ORDER BY expression (for a query on the Logs table) to sort
+    by a LogMetrics column, with the logs without the metric at the end """
+    _check_log_metrics_column(column)
+    value = '(SELECT {} FROM LogMetrics WHERE LogId = Logs.Id)'.format(column)
+    return '{0} IS NULL, {0}{1}'.format(value, ' DESC' if descending else '')
+
+
+def _get_blob_ids(cur, log_ids):
+    """ :return: dict with key=log id and value=blob id of the logs found """
+    ret = {}
+    for chunk in sql_chunks(log_ids):
+        cur.execute('select Id, coalesce(BlobId, Id) from Logs where Id in ({})'.format(
+            ','.join('?' * len(chunk))), chunk)
+        ret.update(cur.fetchall())
+    return ret
+
+def _get_unreferenced_blob_ids(cur, blob_ids, ignored_log_ids):
+    """ :return: sorted list of the blob ids that are not referenced by any log
+    except the ones in ignored_log_ids """
+    referenced = set()
+    for chunk in sql_chunks(sorted(blob_ids)):
+        placeholders = ','.join('?' * len(chunk))
+        cur.execute('select Id, coalesce(BlobId, Id) from Logs where BlobId in ({0}) '
+                    'or (BlobId is null and Id in ({0}))'.format(placeholders),
+                    chunk + chunk)
+        referenced.update(blob_id for log_id, blob_id in cur.fetchall()
+                          if log_id not in ignored_log_ids)
+    return sorted(blob_ids - referenced)
+
+
+class MetadataRepository:
+    """ access to the log metadata """
+
+    @staticmethod
+    @contextmanager
+    def _cursor(read_only=False):
+        """ context manager for a cursor. For writers, the transaction is
+        committed at the end (or rolled back on an exception). """
+        con = get_db_connection(read_only=read_only)
+        try:
+            cur = con.cursor()
+            yield cur
+            cur.close()
+            if not read_only:
+                con.commit()
+        finally:
+            con.close()
+
+    # Logs
+
+    def insert_log(self, columns, vehicle_data=None):
+        """ insert a new log entry (and update the vehicle entry)
+        :param columns: dict of Logs column name (see LOGS_COLUMNS) to value
+        :param vehicle_data: DBVehicleData or None
+        """
+        unknown_columns = set(columns) - set(LOGS_COLUMNS)
+        if unknown_columns:
+            raise ValueError('Unknown Logs columns: {}'.format(unknown_columns))
+        names = list(columns)
+        with self._cursor() as cur:
+            cur.execute('insert into Logs ({}) values ({})'.format(
+                ', '.join(names), ', '.join('?' * len(names))),
+                        [columns[name] for name in names])
+            if vehicle_data is not None:
+                self._upsert_vehicle(cur, vehicle_data)
+
+    def insert_logs(self, entries):
+        """ insert a batch of new logs with the data extracted from their files
+        in a single transaction (used for bulk imports)
+        :param entries: list of dicts with the keys 'columns' (see insert_log),
+            and optionally 'generated' (DBDataGenerated), 'parameters' (tuple
+            (parameters, changes), see log_parameters.py), 'vehicle'
+            (DBVehicleData) and 'copy_from' (id of a log with the same content,
+            to copy the extracted data from; it may be in the same batch)
+        """
+        for entry in entries:
+            unknown_columns = set(entry['columns']) - set(LOGS_COLUMNS)
+            if unknown_columns:
+                raise ValueError('Unknown Logs columns: {}'.format(unknown_columns))
+        with self._cursor() as cur:
+            for entry in entries:
+                names = list(entry['columns'])
+                cur.execute('insert into Logs ({}) values ({})'.format(
+                    ', '.join(names), ', '.join('?' * len(names))),
+                            [entry['columns'][name] for name in names])
+                if entry.get('generated') is not None:
+                    self._insert_generated(cur, entry['columns']['Id'], entry['generated'])
+                if entry.get('parameters') is not None:
+                    self._insert_parameters(cur, entry['columns']['Id'], *entry['parameters'])
+                if entry.get('vehicle') is not None:
+                    self._upsert_vehicle(cur, entry['vehicle'])
+            # after all others, as the source might be in the same batch
+            for entry in entries:
+                if entry.get('copy_from') is not None:
+                    self._copy_log_data(cur, entry['copy_from'], entry['columns']['Id'])
+
+    def get_log_token(self, log_id):
+        """ get the security token of a log or None if not found """
+        with self._cursor(read_only=True) as cur:
+            cur.execute('select Token from Logs where Id = ?', [log_id])
+            db_tuple = cur.fetchone()
+        return None if db_tuple is None else db_tuple[0]
+
+    def get_original_filename(self, log_id):
+        """ get the uploaded file name of a log or None if not found """
+        with self._cursor(read_only=True) as cur:
+            cur.execute('select OriginalFilename from Logs where Id = ?', [log_id])
+            db_tuple = cur.fetchone()
+        return None if db_tuple is None else db_tuple[0]
+
+    def get_db_data(self, log_id):
+        """ get the DBData of a log or None if not found """
+        with self._cursor(read_only=True) as cur:
+            cur.execute('select Description, Feedback, Type, WindSpeed, Rating, VideoUrl, '
+                        'Source from Logs where Id = ?', [log_id])
+            db_tuple = cur.fetchone()
+            if db_tuple is None:
+                return None
+            db_data = DBData()
+            db_data.description = db_tuple[0]
+            db_data.feedback = db_tuple[1]
+            db_data.type = db_tuple[2]
+            db_data.wind_speed = db_tuple[3]
+            db_data.rating = db_tuple[4]
+            db_data.video_url = db_tuple[5]
+            db_data.source = db_tuple[6]
+            db_data.error_labels = read_error_labels(cur, [log_id]).get(log_id, [])
+        return db_data
+
+    def set_error_labels(self, log_id, error_labels):
+        """ replace the error labels of a log """
+        with self._cursor() as cur:
+            write_error_labels(cur, log_id, error_labels)
+
+    def get_logs(self, source=None, private_only=False, public_only=False,
+                 older_than=None):
+        """ get (Id, Date, Description) of all logs matching the filters
+        :param source: Source to match or None for all
+        :param older_than: datetime or None
+        """
+        where = []
+        params = []
+        if source is not None:
+            where.append('Source = ?')
+            params.append(source)
+        if private_only:
+            where.append('Public = 0')
+        if public_only:
+            where.append('Public = 1')
+        if older_than is not None:
+            where.append('Date < ?')
+            params.append(older_than)
+        sql = 'select Id, Date, Description from Logs'
+        if where:
+            sql += ' where ' + ' and '.join(where)
+        with self._cursor(read_only=True) as cur:
+            cur.execute(sql + ' order by Date desc', params)
+            return cur.fetchall()
+
+    def count_logs(self, source=None):
+        """ get the number of logs (with a given source) """
+        with self._cursor(read_only=True) as cur:
+            if source is None:
+                cur.execute('select count(Id) from Logs')
+            else:
+                cur.execute('select count(Id) from Logs where Source = ?', [source])
+            return cur.fetchone()[0]
+
+    def delete_logs(self, log_ids):
+        """ delete the DB entries (incl. generated data) of a list of logs in a
+        single transaction
+        :return: tuple (list of the log ids that were found, list of the log
+                 files (blob ids) that are not referenced anymore and can be
+                 deleted from the log storage)
+        """
+        log_ids = list(log_ids)
+        with self._cursor() as cur:
+            blob_ids = _get_blob_ids(cur, log_ids)
+            delete_logs_relations(cur, log_ids)
+            for chunk in sql_chunks(log_ids):
+                placeholders = ','.join('?' * len(chunk))
+                cur.execute('delete from LogsGenerated where Id in ({})'.format(
+                    placeholders), chunk)
+                cur.execute('delete from Logs where Id in ({})'.format(
+                    placeholders), chunk)
+            unreferenced = _get_unreferenced_blob_ids(cur, set(blob_ids.values()), set())
+        return [log_id for log_id in log_ids if log_id in blob_ids], unreferenced
+
+    def get_unreferenced_blob_ids(self, log_ids):
+        """ get the log files (blob ids) that delete_logs(log_ids) would
+        delete, without changing anything
+        :return: tuple (dict with key=log id and value=blob id of the logs
+                 that were found, list of blob ids)
+        """
+        log_ids = set(log_ids)
+        with self._cursor(read_only=True) as cur:
+            blob_ids = _get_blob_ids(cur, log_ids)
+            return blob_ids, _get_unreferenced_blob_ids(
+                cur, set(blob_ids.values()), log_ids)
+
+    def get_blob_id(self, log_id):
+        """ get the id of the stored log file of a log (duplicate uploads share
+        the file of the first upload) or None if not found """
+        with self._cursor(read_only=True) as cur:
+            cur.execute('select coalesce(BlobId, Id) from Logs where Id = ?', [log_id])
+            db_tuple = cur.fetchone()
+        return None if db_tuple is None else db_tuple[0]
+
+    def find_log_by_content_hash(self, content_hash):
+        """ find a log with the same file content, preferably one with
+        generated data
+        :return: tuple (log id, blob id) or None if not found
+        """
+        with self._cursor(read_only=True) as cur:
+            cur.execute('select Logs.Id, coalesce(Logs.BlobId, Logs.Id) from Logs '
+                        'left join LogsGenerated on LogsGenerated.Id = Logs.Id '
+                        'where Logs.ContentHash = ? '
+                        'order by case when LogsGenerated.Id is null then 1 else 0 end '
+                        'limit 1', [content_hash])
+            db_tuple = cur.fetchone()
+        return None if db_tuple is None else tuple(db_tuple)
+
+    def copy_log_data(self, source_log_id, log_id):
+        """ copy the data extracted from the log file (generated data, flight
+        modes & parameters) from another log with the same content
+        :return: True if the generated data was copied
+        """
+        with self._cursor() as cur:
+            return self._copy_log_data(cur, source_log_id, log_id)
+
+    @staticmethod
+    def _copy_log_data(cur, source_log_id, log_id):
+        columns = ', '.join(LOGS_GENERATED_COLUMNS[1:])
+        cur.execute('insert into LogsGenerated (Id, {0}) select ?, {0} '
+                    'from LogsGenerated where Id = ?'.format(columns),
+                    [log_id, source_log_id])
+        has_generated = cur.rowcount == 1
+        cur.execute('insert into LogFlightModes (LogId, Seq, Mode, Duration) '
+                    'select ?, Seq, Mode, Duration from LogFlightModes '
+                    'where LogId = ?', [log_id, source_log_id])
+        cur.execute('insert into LogMetrics (LogId, {0}) select ?, {0} from LogMetrics '
+                    'where LogId = ?'.format(', '.join(LOG_METRICS_COLUMNS)),
+                    [log_id, source_log_id])
+        cur.execute('insert into LogParameters (LogId, Name, Type, Value, '
+                    'SystemDefault, AirframeDefault) select ?, Name, Type, Value, '
+                    'SystemDefault, AirframeDefault from LogParameters '
+                    'where LogId = ?', [log_id, source_log_id])
+        cur.execute('insert into LogParameterChanges (LogId, Seq, Timestamp, '
+                    'Name, Value) select ?, Seq, Timestamp, Name, Value '
+                    'from LogParameterChanges where LogId = ?',
+                    [log_id, source_log_id])
+        return has_generated
+
+    def set_blob_id(self, log_id, blob_id):
+        """ set the id of the stored log file of a log """
+        with self._cursor() as cur:
+            cur.execute('update Logs set BlobId = ? where Id = ?', [blob_id, log_id])
+
+    def get_public_logs(self, flight_modes=None, error_labels=None,
+                        metric_filters=None, order_by=None):
+        """ get all public (non-CI) logs
+        :param flight_modes: list of flight modes, a log must contain all
+        :param error_labels: list of error labels, a log must contain all
+        :param metric_filters: list of (LogMetrics column, min or None, max or
+                               None) tuples, a log must match all
+        :param order_by: tuple (LogMetrics column, descending) or None. Logs
+                         without the metric are at the end.
+        :return: list of (log id, date, DBData, LogMetrics dict or None) tuples
+        """
+        # the filters are index lookups on the LogFlightModes, LogErrorLabels &
+        # LogMetrics tables
+        where = "WHERE Logs.Public = 1 AND NOT Logs.Source = 'CI'"
+        params = []
+        for flight_mode in flight_modes or []:
+            where += ' AND Logs.Id IN (SELECT LogId FROM LogFlightModes WHERE Mode = ?)'
+            params.append(flight_mode)
+        for error_label in error_labels or []:
+            where += ' AND Logs.Id IN (SELECT LogId FROM LogErrorLabels WHERE Label = ?)'
+            params.append(error_label)
+        metric_where, metric_params = get_log_metrics_where(metric_filters or [])
+        where += metric_where
+        params += metric_params
+        order = ''
+        if order_by is not None:
+            order = ' ORDER BY ' + get_log_metrics_order(*order_by)
+
+        ret = []
+        with self._cursor(read_only=True) as cur:
+            cur.execute('SELECT Logs.Id, Date, Description, WindSpeed, Rating, VideoUrl, '
+                        'Source, Feedback, Type, LogMetrics.LogId, {} FROM Logs '
+                        'LEFT JOIN LogMetrics ON LogMetrics.LogId = Logs.Id '.format(
+                            ', '.join('LogMetrics.' + column for column in LOG_METRICS_COLUMNS))
+                        + where + order, params)
+            db_tuples = cur.fetchall()
+            error_labels_dict = read_error_labels(cur, [db_tuple[0] for db_tuple in db_tuples])
+        for db_tuple in db_tuples:
+            db_data = DBData()
+            log_id = db_tuple[0]
+            db_data.description = db_tuple[2]
+            db_data.wind_speed = db_tuple[3]
+            db_data.rating = db_tuple[4]
+            db_data.video_url = db_tuple[5]
+            db_data.error_labels = error_labels_dict.get(log_id, [])
+            db_data.source = db_tuple[6]
+            db_data.feedback = db_tuple[7]
+            db_data.type = db_tuple[8]
+            metrics = None
+            if db_tuple[9] is not None:
+                metrics = dict(zip(LOG_METRICS_COLUMNS, db_tuple[10:]))
+            ret.append((log_id, db_tuple[1], db_data, metrics))
+        return ret
+
+    def search_public_logs(self, select_cols, where, params, order, limit, offset):
+        """ get a page of the public logs joined with LogsGenerated
+        :param select_cols: 'SELECT ... FROM Logs LEFT JOIN LogsGenerated ...'
+        :param where: WHERE clause (for the joined tables) with '?' params
+        :return: tuple of (total count, filtered count, list of db tuples,
+                 dict of flight mode rows per log id)
+        """
+        with self._cursor(read_only=True) as cur:
+            cur.execute("SELECT COUNT(*) FROM Logs WHERE Public = 1 AND NOT Source = 'CI'")
+            records_total = cur.fetchone()[0]
+
+            cur.execute('SELECT COUNT(*) FROM Logs '
+                        'LEFT JOIN LogsGenerated on Logs.Id=LogsGenerated.Id '
+                        + where, params)
+            records_filtered = cur.fetchone()[0]
+
+            cur.execute(select_cols + where + order + ' LIMIT ? OFFSET ?',
+                        params + [limit, offset])
+            db_tuples = cur.fetchall()
+            flight_modes_dict = read_flight_modes(cur, [db_tuple[0] for db_tuple in db_tuples])
+        return records_total, records_filtered, db_tuples, flight_modes_dict
+
+    def get_log_date_intervals(self, public, interval_s):
+        """ get the number of uploaded logs per time interval
+        :return: list of (date, count) tuples, ordered by date
+        """
+        if get_db_backend() == 'postgresql':
+            sql = ('select min(Date), count(*), '
+                   'floor(extract(epoch from Date) / ?) as interval_index '
+                   'from Logs where Public = ? '
+                   'group by interval_index order by interval_index')
+        else:
+            sql = ("select Date, count(*), "
+                   "cast(strftime('%s', Date) as integer) / ? as interval_index "
+                   "from Logs where Public = ? "
+                   "group by interval_index order by interval_index")
+        with self._cursor(read_only=True) as cur:
+            cur.execute(sql, [interval_s, 1 if public else 0])
+            return [(db_tuple[0], db_tuple[1]) for db_tuple in cur.fetchall()]
+
+    def get_public_logs_with_generated(self, since):
+        """ get the public, non-CI logs uploaded after a date, with their generated data
+        :return: list of (log tuple: (Id, Date, Source, Public, Rating),
+                 DBDataGenerated or None) tuples, ordered by date
+        """
+        ret = []
+        with self._cursor(read_only=True) as cur:
+            cur.execute("select Logs.Id, Logs.Date, Logs.Source, Logs.Public, Logs.Rating, "
+                        "LogsGenerated.* from Logs "
+                        "left join LogsGenerated on Logs.Id=LogsGenerated.Id "
+                        "where Logs.Public = 1 and Logs.Source != 'CI' and Logs.Date > ? "
+                        "order by Logs.Date", [since])
+            db_tuples = cur.fetchall()
+            flight_modes_dict = read_flight_modes(cur, [db_tuple[0] for db_tuple in db_tuples])
+        for db_tuple in db_tuples:
+            db_data_gen = None
+            if db_tuple[5] is not None:
+                db_data_gen = generated_from_tuple(
+                    db_tuple[5:], flight_modes_dict.get(db_tuple[0], []))
+            ret.append((db_tuple[:5], db_data_gen))
+        return ret
+
+    # LogsGenerated
+
+    def get_generated(self, log_id):
+        """ get the DBDataGenerated of a log or None if it does not exist """
+        with self._cursor(read_only=True) as cur:
+            cur.execute('select * from LogsGenerated where Id = ?', [log_id])
+            db_tuple = cur.fetchone()
+            if db_tuple is None:
+                return None
+            return generated_from_tuple(db_tuple, read_flight_modes(cur, [log_id]).get(log_id, []))
+
+    def get_log_metrics(self, log_id):
+        """ get the LogMetrics of a log
+        :return: dict with key=column, see log_metrics.compute_log_metrics(),
+                 or None if it does not exist
+        """
+        with self._cursor(read_only=True) as cur:
+            cur.execute('select {} from LogMetrics where LogId = ?'.format(
+                ', '.join(LOG_METRICS_COLUMNS)), [log_id])
+            db_tuple = cur.fetchone()
+        if db_tuple is None:
+            return None
+        return dict(zip(LOG_METRICS_COLUMNS, db_tuple))
+
+    def insert_generated(self, log_id, db_data_gen):
+        """ insert the generated data of a log
+        :return: False if it already existed
+        """
+        con = get_db_connection()
+        try:
+            cur = con.cursor()
+            self._insert_generated(cur, log_id, db_data_gen)
+            con.commit()
+            cur.close()
+        except con.IntegrityError:
+            # someone else already inserted it (race)
+            con.rollback()
+            return False
+        finally:
+            con.close()
+        return True
+
+    @staticmethod
+    def _insert_generated(cur, log_id, db_data_gen, replace=False):
+        """ :param replace: replace an existing (outdated) entry """
+        if replace:
+            cur.execute('delete from LogsGenerated where Id = ?', [log_id])
+            cur.execute('delete from LogFlightModes where LogId = ?', [log_id])
+            cur.execute('delete from LogMetrics where LogId = ?', [log_id])
+        cur.execute(
+            'insert into LogsGenerated (Id, Duration, '
+            'Mavtype, Estimator, AutostartId, Hardware, '
+            'Software, NumLoggedErrors, NumLoggedWarnings, '
+            'FlightModes, SoftwareVersion, UUID, FlightModeDurations, StartTime, '
+            'GeneratedVersion) values '
+            '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            [log_id, db_data_gen.duration_s, db_data_gen.mav_type,
+             db_data_gen.estimator, db_data_gen.sys_autostart_id,
+             db_data_gen.sys_hw, db_data_gen.ver_sw,
+             db_data_gen.num_logged_errors,
+             db_data_gen.num_logged_warnings,
+             ','.join(map(str, db_data_gen.flight_modes)),
+             db_data_gen.ver_sw_release, db_data_gen.vehicle_uuid,
+             db_data_gen.flight_mode_durations_str(),
+             db_data_gen.start_time_utc, db_data_gen.version])
+        # FlightModes & FlightModeDurations above are kept for compatibility,
+        # readers use the LogFlightModes table
+        write_flight_modes(cur, log_id, db_data_gen.flight_mode_durations)
+        if db_data_gen.metrics is not None:
+            cur.execute('insert into LogMetrics (LogId, {}) values (?, {})'.format(
+                ', '.join(LOG_METRICS_COLUMNS), ', '.join('?' * len(LOG_METRICS_COLUMNS))),
+                        [log_id] + [db_data_gen.metrics[column]
+                                    for column in LOG_METRICS_COLUMNS])
+
+    def get_logs_to_generate(self, version):
+        """ get the logs without LogsGenerated entry or with an entry of an
+        older version
+        :param version: current version (db_entry.GENERATED_VERSION)
+        :return: list of (log id, blob id) tuples, ordered by log id
+        """
+        with self._cursor(read_only=True) as cur:
+            cur.execute('select Logs.Id, coalesce(Logs.BlobId, Logs.Id) from Logs '
+                        'left join LogsGenerated on LogsGenerated.Id = Logs.Id '
+                        'where LogsGenerated.Id is null '
+                        'or LogsGenerated.GeneratedVersion < ? order by Logs.Id',
+                        [version])
+            return [tuple(db_tuple) for db_tuple in cur.fetchall()]
+
+    def insert_extracted_data(self, entries):
+        """ insert the generated data and/or parameters of multiple logs in a
+        single transaction. Existing (outdated) generated data is replaced.
+        :param entries: list of (log id, DBDataGenerated or None, (parameters,
+                        changes) or None) tuples
+        :return: False if some of the parameters already existed (nothing is
+                 inserted then)
+        """
+        con = get_db_connection()
+        try:
+            cur = con.cursor()
+            for log_id, db_data_gen, parameters in entries:
+                if db_data_gen is not None:
+                    self._insert_generated(cur, log_id, db_data_gen, replace=True)
+                if parameters is not None:
+                    self._insert_parameters(cur, log_id, *parameters)
+            con.commit()
+            cur.close()
+        except con.IntegrityError:
+            # someone else already inserted some of it (race)
+            con.rollback()
+            return False
+        finally:
+            con.close()
+        return True
+
+    # LogParameters
+
+    def get_parameters(self, log_id):
+        """ get the parameters of a log
+        :return: tuple (parameters, changes) (see log_parameters.py) or None if
+                 they were not extracted yet
+        """
+        with self._cursor(read_only=True) as cur:
+            cur.execute('select Name, Type, Value, SystemDefault, AirframeDefault '
+                        'from LogParameters where LogId = ? order by Name', [log_id])
+            parameters = cur.fetchall()
+            if len(parameters) == 0:
+                return None
+            cur.execute('select Timestamp, Name, Value from LogParameterChanges '
+                        'where LogId = ? order by Seq', [log_id])
+            changes = cur.fetchall()
+        return [tuple(p) for p in parameters], [tuple(c) for c in changes]
+
+    def get_logs_without_parameters(self):
+        """ get the logs without LogParameters entries
+        :return: list of (log id, blob id) tuples, ordered by log id
+        """
+        with self._cursor(read_only=True) as cur:
+            cur.execute('select Id, coalesce(BlobId, Id) from Logs where not exists '
+                        '(select 1 from LogParameters where LogId = Logs.Id) '
+                        'order by Id')
+            return [tuple(db_tuple) for db_tuple in cur.fetchall()]
+
+    def insert_parameters(self, log_id, parameters, changes):
+        """ insert the parameters of a log
+        :return: False if they already existed
+        """
+        con = get_db_connection()
+        try:
+            cur = con.cursor()
+            self._insert_parameters(cur, log_id, parameters, changes)
+            con.commit()
+            cur.close()
+        except con.IntegrityError:
+            # someone else already inserted them (race)
+            con.rollback()
+            return False
+        finally:
+            con.close()
+        return True
+
+    @staticmethod
+    def _insert_parameters(cur, log_id, parameters, changes):
+        cur.executemany('insert into LogParameters (LogId, Name, Type, Value, '
+                        'SystemDefault, AirframeDefault) values (?, ?, ?, ?, ?, ?)',
+                        [(log_id,) + tuple(p) for p in parameters])
+        cur.executemany('insert into LogParameterChanges (LogId, Seq, Timestamp, '
+                        'Name, Value) values (?, ?, ?, ?, ?)',
+                        [(log_id, i) + tuple(c) for i, c in enumerate(changes)])
+
+    # Vehicle
+
+    def get_vehicle(self, uuid):
+        """ get the DBVehicleData of a vehicle or None if not found """
+        with self._cursor(read_only=True) as cur:
+            cur.execute('select LatestLogId, Name, FlightTime '
+                        'from Vehicle where UUID = ?', [uuid])
+            db_tuple = cur.fetchone()
+        if db_tuple is None:
+            return None
+        vehicle_data = DBVehicleData()
+        vehicle_data.uuid = uuid
+        vehicle_data.log_id = db_tuple[0]
+        vehicle_data.name = db_tuple[1] or ''
+        try:
+            vehicle_data.flight_time = int(db_tuple[2])
+        except (TypeError, ValueError):
+            pass
+        return vehicle_data
+
+    def get_vehicle_names(self):
+        """ get a dict of vehicle UUID to name """
+        with self._cursor(read_only=True) as cur:
+            cur.execute('select UUID, Name from Vehicle')
+            return {db_tuple[0]: db_tuple[1] for db_tuple in cur.fetchall()}
+
+    def update_vehicle(self, vehicle_data):
+        """ insert or update a vehicle entry
+        :param vehicle_data: DBVehicleData
+        """
+        with self._cursor() as cur:
+            self._upsert_vehicle(cur, vehicle_data)
+
+    @staticmethod
+    def _upsert_vehicle(cur, vehicle_data):
+        # ON CONFLICT is supported by SQLite >= 3.24 & PostgreSQL
+        cur.execute('insert into Vehicle (UUID, LatestLogId, Name, FlightTime) '
+                    'values (?, ?, ?, ?) on conflict (UUID) do update set '
+                    'LatestLogId = excluded.LatestLogId, Name = excluded.Name, '
+                    'FlightTime = excluded.FlightTime',
+                    [vehicle_data.uuid, vehicle_data.log_id, vehicle_data.name,
+                     vehicle_data.flight_time])
+
+
+_repository = MetadataRepository()
+
+def get_metadata_repository():
+    """ get the MetadataRepository instance """
+    return _repository
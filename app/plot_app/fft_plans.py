@@ -0,0 +1,145 @@
+""" FFTW plan management: a plan cache & persistence of the FFTW wisdom """
+
+import json
+import os
+import threading
+import uuid
+from collections import OrderedDict
+
+import pyfftw
+
+#pylint: disable=invalid-name, global-statement
+
+# maximum size of the arrays of the plans cached per thread [bytes]. Larger
+# plans are not kept, but they are quick to create again from the wisdom.
+PLAN_CACHE_BYTES = 64 * 1024 * 1024
+
+# plans are not thread-safe (they own their input & output arrays), so each
+# thread has its own cache. The wisdom (the result of the planning) is shared.
+_thread_local = threading.local()
+
+_wisdom_file_name = None
+_saved_wisdom = None
+_wisdom_lock = threading.Lock()
+
+
+def _plan_bytes(plan):
+    return plan.input_array.nbytes + plan.output_array.nbytes
+
+
+def _get_plan(key, create):
+    """ get a plan from the cache of the current thread or create it """
+    plans = getattr(_thread_local, 'plans', None)
+    if plans is None:
+        plans = _thread_local.plans = OrderedDict()
+    plan = plans.get(key)
+    if plan is not None:
+        plans.move_to_end(key)
+        return plan
+
+    plan = create()
+    if key[-1] != 'FFTW_ESTIMATE':
+        # store new wisdom right away, in case the process does not shut
+        # down cleanly (e.g. a forked worker process)
+        save_wisdom()
+    if _plan_bytes(plan) <= PLAN_CACHE_BYTES:
+        plans[key] = plan
+        while sum(_plan_bytes(cached_plan) for cached_plan in plans.values()) > PLAN_CACHE_BYTES:
+            plans.popitem(last=False)
+    return plan
+
+
+def get_rfft_plan(shape, planner_effort='FFTW_MEASURE'):
+    """
+    get a (cached) plan for the real FFT along the last axis of a float64
+    array. Usage: fill plan.input_array and call plan(). The returned array is
+    owned by the plan (valid until the next call).
+    Use FFTW_MEASURE for shapes that repeat across logs (e.g. stacks of fixed
+    size windows): the planning takes up to a few 100 ms once, then the wisdom
+    is reused. For arbitrary lengths use FFTW_ESTIMATE, as measuring takes
+    seconds for long transforms.
+    """
+    def create():
+        return pyfftw.builders.rfft(pyfftw.empty_aligned(shape, dtype='float64'),
+                                    axis=-1, planner_effort=planner_effort)
+    return _get_plan(('rfft', tuple(shape), planner_effort), create)
+
+
+def get_irfft_plan(shape, n, planner_effort='FFTW_MEASURE'):
+    """
+    get a (cached) plan for the inverse real FFT along the last axis
+    :param shape: shape of the complex input (..., n // 2 + 1)
+    :param n: length of the output
+    Usage: plan(input) (the input is copied), see get_rfft_plan()
+    """
+    def create():
+        return pyfftw.builders.irfft(pyfftw.empty_aligned(shape, dtype='complex128'), n=n,
+                                     axis=-1, planner_effort=planner_effort)
+    return _get_plan(('irfft', tuple(shape), n, planner_effort), create)
+
+
+def next_fast_length(n):
+    """
+    get the smallest length >= n that has only 2, 3, 5 and 7 as prime factors
+    (FFTW is much faster for these than for lengths with large prime factors).
+    Zero-padding to it adds at most 7% of samples (below 1000 samples), 4%
+    (below 1e5) or 1.5% (above).
+    """
+    best = 1
+    while best < n:
+        best *= 2
+    power7 = 1
+    while power7 < best:
+        power5 = power7
+        while power5 < best:
+            power3 = power5
+            while power3 < best:
+                length = power3
+                while length < n:
+                    length *= 2
+                best = min(best, length)
+                power3 *= 3
+            power5 *= 5
+        power7 *= 7
+    return best
+
+
+def load_wisdom(file_name):
+    """
+    import the FFTW wisdom from a file (if it exists). New wisdom is stored to
+    the same file.
+    """
+    global _wisdom_file_name, _saved_wisdom
+    _wisdom_file_name = file_name
+    try:
+        with open(file_name, 'r', encoding='ascii') as wisdom_file:
+            wisdom = json.load(wisdom_file)
+        pyfftw.import_wisdom(tuple(w.encode('ascii') for w in wisdom))
+        _saved_wisdom = wisdom
+    except FileNotFoundError:
+        pass
+    except (ValueError, TypeError, OSError) as error:
+        print('Error: invalid FFTW wisdom file', file_name, error)
+
+
+def save_wisdom():
+    """ store the FFTW wisdom to the file given to load_wisdom() (if it changed) """
+    global _saved_wisdom
+    if _wisdom_file_name is None:
+        return
+    with _wisdom_lock:
+        wisdom = [w.decode('ascii') for w in pyfftw.export_wisdom()]
+        if wisdom == _saved_wisdom:
+            return
+        # write atomically, as several processes might store it concurrently
+        temp_file_name = os.path.join(os.path.dirname(_wisdom_file_name),
+                                      '.tmp-'+str(uuid.uuid4())+'.json')
+        try:
+            with open(temp_file_name, 'w', encoding='ascii') as wisdom_file:
+                json.dump(wisdom, wisdom_file)
+            os.replace(temp_file_name, _wisdom_file_name)
+            _saved_wisdom = wisdom
+        except OSError as error:
+            print('Error: failed to store the FFTW wisdom', _wisdom_file_name, error)
+            if os.path.exists(temp_file_name):
+                os.unlink(temp_file_name)
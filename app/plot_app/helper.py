@@ -1,5 +1,6 @@
 """ some helper methods that don't fit in elsewhere """
 import json
+import glob
 from timeit import default_timer as timer
 import time
 import re
@@ -14,16 +15,18 @@ from urllib.request import urlretrieve
 import xml.etree.ElementTree # airframe parsing
 import shutil
 import uuid
+import weakref
 
 from pyulog import *
 from pyulog.px4 import *
 from scipy.interpolate import interp1d
 
 from config_tables import *
-from config import get_log_filepath, get_airframes_filename, get_airframes_url, \
+from config import get_log_storage, get_airframes_filename, get_airframes_url, \
                    get_parameters_filename, get_parameters_url, \
                    get_log_cache_size, get_log_load_timeout, debug_print_timing, \
-                   get_releases_filename
+                   get_releases_filename, get_kml_filepath, get_pid_analysis_cache_filepath, \
+                   get_spectral_analysis_cache_filepath
 
 from Crypto.Cipher import ChaCha20
 from Crypto.PublicKey import RSA
@@ -71,13 +74,75 @@ def validate_log_id(log_id):
         return True
     return False
 
+def get_log_blob_id(log_id):
+    """ get the id under which the file of a log is stored. Duplicate uploads
+    share the file of the first upload, see Logs.BlobId.
+    :return: blob id or None if the log does not exist (e.g. it got deleted,
+             while its file is still used by a duplicate)
+    """
+    if _check_log_id_is_filename():
+        return log_id
+    # imported here, as db_repository depends on this module
+    from db_repository import get_metadata_repository #pylint: disable=import-outside-toplevel
+    return get_metadata_repository().get_blob_id(log_id)
+
 def get_log_filename(log_id):
-    """ return the ulog file name from a log id in the form:
+    """ return the (local) ulog file name from a log id in the form:
         xxxxxxxx-xxxx-xxxx-xxxx-xxxxxxxxxxxx
+    With object storage, the file is fetched into the local cache first.
+    If the file of the log does not exist, the returned file does not exist
+    either.
+    :raise FileNotFoundError: if the log does not exist in the DB
     """
     if _check_log_id_is_filename():
         return log_id
-    return os.path.join(get_log_filepath(), log_id + '.ulg')
+    blob_id = get_log_blob_id(log_id)
+    if blob_id is None:
+        raise FileNotFoundError('Log {} not found'.format(log_id))
+    return get_log_storage().get_local_filename(blob_id)
+
+def get_kml_filename(log_id):
+    """ get the file name of the (cached) KML file of a log. It is shared by
+    logs with the same file. """
+    return get_blob_kml_filename(get_log_blob_id(log_id))
+
+def get_blob_kml_filename(blob_id):
+    """ get the file name of the (cached) KML file of a stored log file """
+    return os.path.join(get_kml_filepath(), blob_id.replace('/', '.')+'.kml')
+
+def get_pid_analysis_cache_filename(blob_id, parameters_hash):
+    """ get the file name of the cached PID analysis results of a stored log
+    file, for a hash of the analysis parameters """
+    return os.path.join(get_pid_analysis_cache_filepath(),
+                        blob_id.replace('/', '.')+'.'+parameters_hash+'.npz')
+
+def get_spectral_analysis_cache_filename(blob_id):
+    """ get the file name of the cached spectral analysis results of a stored
+    log file (see spectral.SpectralAnalysis) """
+    return os.path.join(get_spectral_analysis_cache_filepath(),
+                        blob_id.replace('/', '.')+'.npz')
+
+def get_blob_cache_filenames(blob_id):
+    """ get the existing cache files generated from a stored log file """
+    pid_analysis_prefix = os.path.join(get_pid_analysis_cache_filepath(),
+                                       blob_id.replace('/', '.')+'.')
+    file_names = glob.glob(glob.escape(pid_analysis_prefix)+'*.npz')
+    for file_name in [get_spectral_analysis_cache_filename(blob_id),
+                      get_blob_kml_filename(blob_id)]:
+        if os.path.exists(file_name):
+            file_names.append(file_name)
+    return file_names
+
+def delete_log_file(blob_id):
+    """ delete a stored log file (see get_log_blob_id) and the files generated
+    from it. Only call this once no log references it anymore.
+    """
+    get_log_storage().delete(blob_id)
+    for file_name in get_blob_cache_filenames(blob_id):
+        try:
+            os.unlink(file_name)
+        except FileNotFoundError:
+            pass
 
 
 __last_failed_downloads = {} # dict with key=file name and a timestamp of last failed download
@@ -254,6 +319,62 @@ def map_projection(lat, lon, anchor_lat, anchor_lon):
     return x, y
 
 
+def simplify_polyline(points, tolerance):
+    """
+    Simplify a polyline with the Ramer-Douglas-Peucker algorithm.
+    All the ranges of a recursion level are split at once (vectorized).
+    :param points: array of shape (N, dims), e.g. positions in [m]
+    :param tolerance: maximum distance of a dropped point to the simplified line
+    :return: boolean mask of the points to keep (includes the first & last)
+    """
+    points = np.asarray(points, dtype=np.float64)
+    num_points = len(points)
+    keep = np.zeros(num_points, dtype=bool)
+    if num_points == 0:
+        return keep
+    keep[0] = keep[-1] = True
+    firsts = np.array([0])
+    lasts = np.array([num_points - 1])
+    while True:
+        has_inner = lasts - firsts >= 2
+        firsts = firsts[has_inner]
+        lasts = lasts[has_inner]
+        if len(firsts) == 0:
+            break
+        # the inner points of all ranges, concatenated
+        num_inner = lasts - firsts - 1
+        range_starts = np.cumsum(num_inner) - num_inner
+        point_idx = np.arange(range_starts[-1] + num_inner[-1])
+        point_idx += np.repeat(firsts + 1 - range_starts, num_inner)
+
+        segments = points[lasts] - points[firsts]
+        segment_lengths_sq = np.repeat(np.einsum('ij,ij->i', segments, segments), num_inner)
+        segments = np.repeat(segments, num_inner, axis=0)
+        offsets = points[point_idx]
+        offsets -= np.repeat(points[firsts], num_inner, axis=0)
+        # distance to the segment (not the infinite line), so that
+        # back-and-forth movements are preserved
+        t = np.divide(np.einsum('ij,ij->i', offsets, segments), segment_lengths_sq,
+                      out=np.zeros(len(point_idx)), where=segment_lengths_sq > 0)
+        np.clip(t, 0, 1, out=t)
+        segments *= t[:, np.newaxis]
+        offsets -= segments
+        distances_sq = np.einsum('ij,ij->i', offsets, offsets)
+
+        # split the ranges at their farthest point (the first one, if equal)
+        max_distances_sq = np.maximum.reduceat(distances_sq, range_starts)
+        split_idx = np.minimum.reduceat(
+            np.where(distances_sq == np.repeat(max_distances_sq, num_inner), point_idx,
+                     num_points),
+            range_starts)
+        split = max_distances_sq > tolerance * tolerance
+        split_idx = split_idx[split]
+        keep[split_idx] = True
+        firsts, lasts = (np.concatenate((firsts[split], split_idx)),
+                         np.concatenate((split_idx, lasts[split])))
+    return keep
+
+
 def html_long_word_force_break(text, max_length=15):
     """
     force line breaks for text that contains long words, suitable for HTML
@@ -357,7 +478,7 @@ def load_ulog_file(file_name):
                   'ekf2_timestamps', 'manual_control_switches', 'event',
                   'vehicle_imu_status', 'actuator_motors', 'actuator_servos',
                   'vehicle_thrust_setpoint', 'vehicle_torque_setpoint',
-                  'failsafe_flags', 'device_information']
+                  'failsafe_flags', 'device_information', 'camera_capture']
     try:
         with _log_load_timeout(get_log_load_timeout(), file_name):
             ulog = ULog(file_name, msg_filter, disable_str_exceptions=True)
@@ -519,18 +640,67 @@ def get_total_flight_time(ulog):
     get the total flight time from an ulog in seconds
     :return: integer or None if not set
     """
-    if ('LND_FLIGHT_T_HI' in ulog.initial_parameters and
-            'LND_FLIGHT_T_LO' in ulog.initial_parameters):
-        high = ulog.initial_parameters['LND_FLIGHT_T_HI']
+    return get_total_flight_time_from_parameters(ulog.initial_parameters)
+
+def get_total_flight_time_from_parameters(parameters):
+    """
+    get the total flight time in seconds from the (initial) parameters of a log
+    :param parameters: dict of parameter name to value
+    :return: integer or None if not set
+    """
+    if ('LND_FLIGHT_T_HI' in parameters and
+            'LND_FLIGHT_T_LO' in parameters):
+        high = int(parameters['LND_FLIGHT_T_HI'])
         if high < 0: # both are signed int32
             high += 2**32
-        low = ulog.initial_parameters['LND_FLIGHT_T_LO']
+        low = int(parameters['LND_FLIGHT_T_LO'])
         if low < 0:
             low += 2**32
         flight_time_s = ((high << 32) | low) / 1e6
         return flight_time_s
     return None
 
+# cached value changes: key=id of the ULog.Data (it is not hashable), value=dict
+# with key=tuple of field names. The entries are removed together with the
+# (cached) ULog.
+_value_changes_cache = {}
+
+def get_value_change_indices(dataset, field_names):
+    """
+    get the samples where the value of a set of fields changes (like
+    ULog.Data.list_value_changes(), but for several fields). The result is
+    cached per dataset, so it is computed once per loaded log.
+    :param dataset: ULog.Data
+    :param field_names: list of field names
+    :return: array of sample indices: the first sample with non-zero timestamp
+    and every following sample where at least one of the fields changes
+    (messages with timestamp = 0 are ignored)
+    """
+    field_names = tuple(field_names)
+    dataset_cache = _value_changes_cache.get(id(dataset))
+    if dataset_cache is None:
+        dataset_cache = _value_changes_cache[id(dataset)] = {}
+        weakref.finalize(dataset, _value_changes_cache.pop, id(dataset), None)
+    indices = dataset_cache.get(field_names)
+    if indices is None:
+        valid = np.flatnonzero(dataset.data['timestamp'] != 0)
+        changed = np.zeros(len(valid), dtype=bool)
+        changed[:1] = True
+        for field_name in field_names:
+            values = dataset.data[field_name][valid]
+            changed[1:] |= values[:-1] != values[1:]
+        indices = valid[changed]
+        dataset_cache[field_names] = indices
+    return indices
+
+def list_value_changes(dataset, field_name):
+    """
+    get a list of (timestamp, value) tuples, whenever the value changes (same as
+    ULog.Data.list_value_changes(), see get_value_change_indices())
+    """
+    indices = get_value_change_indices(dataset, [field_name])
+    return list(zip(dataset.data['timestamp'][indices], dataset.data[field_name][indices]))
+
 def get_flight_mode_changes(ulog):
     """
     get a list of flight mode changes
@@ -539,12 +709,55 @@ def get_flight_mode_changes(ulog):
     """
     try:
         cur_dataset = ulog.get_dataset('vehicle_status')
-        flight_mode_changes = cur_dataset.list_value_changes('nav_state')
+        flight_mode_changes = list_value_changes(cur_dataset, 'nav_state')
         flight_mode_changes.append((ulog.last_timestamp, -1))
     except (KeyError, IndexError) as error:
         flight_mode_changes = []
     return flight_mode_changes
 
+def get_vtol_states(ulog):
+    """
+    get the VTOL state changes & vehicle type
+    :return: tuple (vtol_states, is_vtol, is_vtol_tailsitter), with vtol_states
+    a list of (timestamp, state) tuples (states: 1=transition, 2=FW, 3=MC, the
+    last is the last log timestamp and state = -1) or None if not a VTOL.
+    """
+    vtol_states = None
+    is_vtol = False
+    is_vtol_tailsitter = False
+    try:
+        cur_dataset = ulog.get_dataset('vehicle_status')
+        if np.amax(cur_dataset.data['is_vtol']) == 1:
+            is_vtol = True
+            # check if is tailsitter
+            is_vtol_tailsitter = ('is_vtol_tailsitter' in cur_dataset.data and
+                                  np.amax(cur_dataset.data['is_vtol_tailsitter']) == 1)
+            # find mode after transitions (states: 1=transition, 2=FW, 3=MC)
+            if 'vehicle_type' in cur_dataset.data:
+                vehicle_type_field = 'vehicle_type'
+                vtol_state_mapping = {2: 2, 1: 3}
+                # a VTOL can change state also w/o in_transition_mode set
+                # (e.g. in Manual mode)
+                change_fields = ['in_transition_mode', 'vehicle_type']
+            else: # COMPATIBILITY: old logs (https://github.com/PX4/Firmware/pull/11918)
+                vehicle_type_field = 'is_rotary_wing'
+                vtol_state_mapping = {0: 2, 1: 3}
+                change_fields = ['in_transition_mode']
+            timestamps = cur_dataset.data['timestamp']
+            indices = get_value_change_indices(cur_dataset, change_fields)
+            vtol_states = list(zip(timestamps[indices],
+                                   cur_dataset.data['in_transition_mode'][indices]))
+            # after a transition: use the vehicle type of the next sample
+            finished = np.flatnonzero(cur_dataset.data['in_transition_mode'][indices] == 0)
+            next_indices = np.searchsorted(timestamps, timestamps[indices[finished]]) + 1
+            vehicle_types = cur_dataset.data[vehicle_type_field][next_indices]
+            for i, vehicle_type in zip(finished, vehicle_types):
+                vtol_states[i] = (vtol_states[i][0], vtol_state_mapping[vehicle_type])
+            vtol_states.append((ulog.last_timestamp, -1))
+    except (KeyError, IndexError) as error:
+        vtol_states = None
+    return vtol_states, is_vtol, is_vtol_tailsitter
+
 def print_cache_info():
     """ print information about the ulog cache """
     print(load_ulog_file.cache_info())
@@ -564,36 +777,83 @@ def validate_error_ids(err_ids):
 
     return True
 
-def decrypt_ulge_payload(payload: bytes, private_key_path: str) -> bytes:
-    """Decrypt an uploaded .ulge file payload and return decrypted .ulg bytes."""
-
-    if not os.path.exists(private_key_path):
-        raise FileNotFoundError(f"Private key not found at {private_key_path}")
-
-    magic = b"ULogEnc"
-    header_size = 22
-
-    if payload[:7] != magic:
-        raise ValueError("Invalid header magic")
-    if payload[7] != 1:
-        raise ValueError("Unsupported header version")
-    if payload[16] != 4:
-        raise ValueError("Unsupported key algorithm")
+class ULogEncDecryptor:
+    """
+    Incremental decryption of a .ulge file: feed the encrypted data in chunks
+    of any size and get the decrypted .ulg data back. Only the header is
+    buffered, so memory usage does not depend on the file size.
+    """
 
-    key_size = payload[19] << 8 | payload[18]
-    nonce_size = payload[21] << 8 | payload[20]
+    MAGIC = b"ULogEnc"
+    HEADER_SIZE = 22
+
+    def __init__(self, private_key_path: str):
+        if not os.path.exists(private_key_path):
+            raise FileNotFoundError(f"Private key not found at {private_key_path}")
+        self._private_key_path = private_key_path
+        self._header = b""
+        self._cipher = None
+
+    def _parse_header(self):
+        """ create the cipher once the whole header is buffered
+        :return: the encrypted data following the header (or None if the header
+                 is still incomplete)
+        """
+        header = self._header
+        if len(header) < self.HEADER_SIZE:
+            return None
+        if header[:7] != self.MAGIC:
+            raise ValueError("Invalid header magic")
+        if header[7] != 1:
+            raise ValueError("Unsupported header version")
+        if header[16] != 4:
+            raise ValueError("Unsupported key algorithm")
+
+        key_size = header[19] << 8 | header[18]
+        nonce_size = header[21] << 8 | header[20]
+        data_offset = self.HEADER_SIZE + key_size + nonce_size
+        if len(header) < data_offset:
+            return None
+
+        cipher_text = header[self.HEADER_SIZE:self.HEADER_SIZE + key_size]
+        nonce = header[self.HEADER_SIZE + key_size:data_offset]
+
+        with open(self._private_key_path, 'rb') as f:
+            rsa_key = RSA.import_key(f.read())
+            cipher_rsa = PKCS1_OAEP.new(rsa_key, SHA256)
+            try:
+                sym_key = cipher_rsa.decrypt(cipher_text)
+            except ValueError as e:
+                raise ValueError("Decryption failed: possibly incorrect private key or corrupt file.") from e
+
+        self._cipher = ChaCha20.new(key=sym_key, nonce=nonce)
+        self._header = None
+        return header[data_offset:]
+
+    def decrypt(self, data: bytes) -> bytes:
+        """ decrypt the next chunk of the file
+        :return: decrypted data (empty while the header is incomplete)
+        :raise ValueError: if the header is invalid
+        """
+        if self._cipher is None:
+            self._header += bytes(data)
+            data = self._parse_header()
+            if data is None:
+                return b""
+        return self._cipher.decrypt(data)
+
+    def finalize(self):
+        """ call after the last chunk
+        :raise ValueError: if the file ended within the header
+        """
+        if self._cipher is None:
+            raise ValueError("Incomplete header")
 
-    cipher_text = payload[header_size:header_size + key_size]
-    nonce = payload[header_size + key_size:header_size + key_size + nonce_size]
-    encrypted_data = payload[header_size + key_size + nonce_size:]
 
-    with open(private_key_path, 'rb') as f:
-        rsa_key = RSA.import_key(f.read())
-        cipher_rsa = PKCS1_OAEP.new(rsa_key, SHA256)
-        try:
-            sym_key = cipher_rsa.decrypt(cipher_text)
-        except ValueError as e:
-            raise ValueError("Decryption failed: possibly incorrect private key or corrupt file.") from e
+def decrypt_ulge_payload(payload: bytes, private_key_path: str) -> bytes:
+    """Decrypt an uploaded .ulge file payload and return decrypted .ulg bytes."""
 
-    cipher = ChaCha20.new(key=sym_key, nonce=nonce)
-    return cipher.decrypt(encrypted_data)
+    decryptor = ULogEncDecryptor(private_key_path)
+    decrypted_data = decryptor.decrypt(payload)
+    decryptor.finalize()
+    return decrypted_data
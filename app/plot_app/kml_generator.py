@@ -0,0 +1,148 @@
+"""
+Module for generating KML files (GPS track colored by flight mode)
+"""
+
+import os
+import shutil
+import uuid
+from xml.sax.saxutils import escape
+
+import numpy as np
+
+from config_tables import flight_modes_table
+from helper import get_flight_mode_changes, simplify_polyline, load_ulog_file
+
+#pylint: disable=invalid-name
+
+# KML track simplification: maximum deviation from the logged track [m]
+KML_TOLERANCE = 0.5
+
+
+def _kml_color(flight_mode):
+    """ flight mode color for KML files, in the form 'aabbggrr' """
+    if flight_mode not in flight_modes_table: flight_mode = 0
+
+    color_str = flight_modes_table[flight_mode][1][1:] # color in form 'ff00aa'
+
+    # increase brightness to match colors with template
+    rgb = [min(int(color_str[2*x:2*x+2], 16) + 40, 255) for x in range(3)]
+    color_str = "".join(map(lambda x: format(x, '02x'), rgb))
+
+    return 'ff'+color_str[4:6]+color_str[2:4]+color_str[0:2] # KML uses aabbggrr
+
+
+def _get_position_data(ulog, topic_name):
+    """ get the position of a topic in [deg] & [m], with timestamps
+    :return: tuple (timestamp, lon, lat, alt) or None if not available
+    """
+    datasets = [d for d in ulog.data_list if d.name == topic_name and d.multi_id == 0]
+    if len(datasets) == 0:
+        return None
+    data = datasets[0].data
+
+    # 'longitude_deg' is used in newer PX4 versions
+    lon = data['lon'] if 'lon' in data else data['longitude_deg']
+    lat = data['lat'] if 'lat' in data else data['latitude_deg']
+    alt = data['alt'] if 'alt' in data else data['altitude_msl_m']
+    timestamp = data['timestamp']
+    if 'fix_type' in data:
+        indices = data['fix_type'] > 2 # use only data with a fix
+        lon, lat, alt, timestamp = lon[indices], lat[indices], alt[indices], timestamp[indices]
+
+    # scale if it's an integer type
+    if np.issubdtype(lon.dtype, np.integer):
+        lon = lon / 1e7 # to degrees
+        lat = lat / 1e7
+        alt = alt / 1e3 # to meters
+    return timestamp, lon, lat, alt
+
+
+def _write_coordinates(kml_file, lon, lat, alt):
+    kml_file.write('\n'.join('{:.8f},{:.8f},{:.3f}'.format(*p) for p in zip(lon, lat, alt)))
+
+
+def write_kml(ulog, kml_file, position_topic_name='vehicle_global_position',
+              camera_trigger_topic_name='camera_capture', line_width=2):
+    """
+    Write the track of a loaded ULog as KML: one line string per flight mode
+    segment, simplified to KML_TOLERANCE, plus the camera trigger points.
+    The output is streamed to kml_file.
+    :raise KeyError: if there is no position data
+    """
+    position_data = _get_position_data(ulog, position_topic_name)
+    if position_data is None or len(position_data[0]) == 0:
+        raise KeyError(position_topic_name+' not found in data')
+    timestamp, lon, lat, alt = position_data
+
+    # flight mode of each position sample
+    flight_mode_changes = get_flight_mode_changes(ulog)
+    if len(flight_mode_changes) > 1:
+        change_timestamps = np.array([t for t, _ in flight_mode_changes[:-1]])
+        change_modes = np.array([mode for _, mode in flight_mode_changes[:-1]])
+        mode_idx = np.maximum(np.searchsorted(change_timestamps, timestamp,
+                                              side='right') - 1, 0)
+        flight_modes = change_modes[mode_idx]
+    else:
+        flight_modes = np.zeros(len(timestamp), dtype=int)
+    # flight mode segments. The first point of a segment is also added to the
+    # previous one, so that the track is continuous
+    segment_starts = np.concatenate(([0], np.flatnonzero(np.diff(flight_modes)) + 1))
+    segment_ends = np.concatenate((segment_starts[1:] + 1, [len(timestamp)]))
+
+    # local coordinates in [m] for the simplification
+    lat_rad = np.deg2rad(lat)
+    lon_rad = np.deg2rad(lon)
+    earth_radius = 6371000
+    points = np.column_stack((
+        (lon_rad - lon_rad[0]) * np.cos(lat_rad[0]) * earth_radius,
+        (lat_rad - lat_rad[0]) * earth_radius,
+        alt))
+
+    kml_file.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                   '<kml xmlns="http://www.opengis.net/kml/2.2">\n<Document>\n')
+    for start, end in zip(segment_starts, segment_ends):
+        flight_mode = int(flight_modes[start])
+        keep = simplify_polyline(points[start:end], KML_TOLERANCE)
+        indices = np.flatnonzero(keep) + start
+        kml_file.write(
+            '<Placemark><name>{:}</name>'
+            '<Style><LineStyle><color>{:}</color><width>{:}</width></LineStyle></Style>'
+            '<LineString><altitudeMode>absolute</altitudeMode><coordinates>\n'.format(
+                escape(position_topic_name + ':' + str(flight_mode)),
+                _kml_color(flight_mode), line_width))
+        _write_coordinates(kml_file, lon[indices], lat[indices], alt[indices])
+        kml_file.write('\n</coordinates></LineString></Placemark>\n')
+
+    # camera triggers
+    datasets = [d for d in ulog.data_list
+                if d.name == camera_trigger_topic_name and d.multi_id == 0]
+    if len(datasets) > 0:
+        _, trigger_lon, trigger_lat, trigger_alt = \
+            _get_position_data(ulog, camera_trigger_topic_name)
+        for i, sequence in enumerate(datasets[0].data['seq']):
+            kml_file.write('<Placemark><name>Camera Trigger {:}</name>'
+                           '<Point><altitudeMode>absolute</altitudeMode>'
+                           '<coordinates>'.format(sequence))
+            _write_coordinates(kml_file, trigger_lon[i:i+1], trigger_lat[i:i+1],
+                               trigger_alt[i:i+1])
+            kml_file.write('</coordinates></Point></Placemark>\n')
+
+    kml_file.write('</Document>\n</kml>\n')
+
+
+def generate_kml_file(ulog, kml_file_name):
+    """ write the KML file of a loaded ULog. It is written to a temporary file
+    first and then moved, so that readers never see a partial file. """
+    temp_file_name = kml_file_name+'.'+str(uuid.uuid4())
+    try:
+        with open(temp_file_name, 'w', encoding='utf-8', buffering=256*1024) as kml_file:
+            write_kml(ulog, kml_file)
+        shutil.move(temp_file_name, kml_file_name, copy_function=shutil.copyfile)
+    finally:
+        if os.path.exists(temp_file_name):
+            os.unlink(temp_file_name)
+
+
+def generate_kml_file_from_log(ulog_file_name, kml_file_name):
+    """ write the KML file of a log, reusing the loaded ULog if cached """
+    generate_kml_file(load_ulog_file(ulog_file_name), kml_file_name)
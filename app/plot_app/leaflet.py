@@ -1,15 +1,26 @@
 """ Data extraction/conversion methods to get the flight path that is passed to
 a Leaflet map via jinja arguments """
 
+import numpy as np
+
 from colors import HTML_color_to_RGB
 from config_tables import flight_modes_table
-from helper import get_lat_lon_alt_deg
+from helper import get_lat_lon_alt_deg, simplify_polyline
 
-#pylint: disable=consider-using-enumerate
+# minimum interval between the used GPS samples [s]
+MINIMUM_INTERVAL_S = 0.1
+# track simplification: the tolerance is the track extent divided by this
+# (pixels), but at least MINIMUM_TOLERANCE_M [m] (GPS accuracy)
+MAP_RESOLUTION = 4096
+MINIMUM_TOLERANCE_M = 0.5
+# maximum number of points passed to the map
+MAX_NUM_POINTS = 5000
 
 def ulog_to_polyline(ulog, flight_mode_changes):
     """ extract flight mode colors and position data from the log
-        :return: tuple(position data list, flight modes)
+        :return: tuple(position data list, flight modes). The position data is
+        decimated in time & simplified (Ramer-Douglas-Peucker), flight modes is
+        a list of [color, index of the first position] and a final ['', length]
     """
     def rgb_colors(flight_mode):
         """ flight mode color from a flight mode """
@@ -27,26 +38,63 @@ def ulog_to_polyline(ulog, flight_mode_changes):
     pos_lat, pos_lon, _ = get_lat_lon_alt_deg(ulog, cur_data)
     pos_t = cur_data.data['timestamp']
 
+    # use only finite positions (a NaN would make the track extent & the
+    # simplification tolerance NaN)
+    indices = np.isfinite(pos_lat) & np.isfinite(pos_lon)
     if 'fix_type' in cur_data.data:
-        indices = cur_data.data['fix_type'] > 2  # use only data with a fix
-        pos_lon = pos_lon[indices]
-        pos_lat = pos_lat[indices]
-        pos_t = pos_t[indices]
-
-    pos_datas = []
-    flight_modes = []
-    last_t = 0
-    minimum_interval_s = 0.1
-    current_flight_mode_idx = 0
-    for i in range(len(pos_lon)):
-        curr_t = pos_t[i]
-        if (curr_t - last_t) / 1e6 > minimum_interval_s:
-            pos_datas.append([float(pos_lat[i]), float(pos_lon[i])])
-            last_t = curr_t
-            while current_flight_mode_idx < len(flight_mode_changes) - 1 and \
-                    flight_mode_changes[current_flight_mode_idx][0] <= curr_t:
-                current_flight_mode = flight_mode_changes[current_flight_mode_idx][1]
-                current_flight_mode_idx += 1
-                flight_modes.append([rgb_colors(current_flight_mode), i])
-    flight_modes.append(['', len(pos_lon)])
+        indices &= cur_data.data['fix_type'] > 2  # use only data with a fix
+    pos_lon = pos_lon[indices]
+    pos_lat = pos_lat[indices]
+    pos_t = pos_t[indices]
+    if len(pos_t) == 0:
+        return ([], [['', 0]])
+
+    # time decimation: first sample of every minimum interval
+    interval_idx = (pos_t - pos_t[0]) // int(MINIMUM_INTERVAL_S * 1e6)
+    indices = np.flatnonzero(np.diff(interval_idx, prepend=-1))
+    pos_t, pos_lat, pos_lon = pos_t[indices], pos_lat[indices], pos_lon[indices]
+
+    # flight mode of each sample (the first mode for samples before it)
+    if len(flight_mode_changes) > 1:
+        change_timestamps = np.array([t for t, _ in flight_mode_changes[:-1]])
+        change_modes = np.array([mode for _, mode in flight_mode_changes[:-1]])
+        mode_idx = np.maximum(np.searchsorted(change_timestamps, pos_t,
+                                              side='right') - 1, 0)
+        sample_modes = change_modes[mode_idx]
+    else:
+        sample_modes = np.zeros(len(pos_t), dtype=int)
+    # flight mode segments. A segment is drawn starting from the last point of
+    # the previous one (so that the track is continuous), so both are kept.
+    segment_starts = np.concatenate(([0], np.flatnonzero(np.diff(sample_modes)) + 1))
+    range_starts = np.maximum(segment_starts - 1, 0)
+    range_ends = np.append(segment_starts[1:], len(pos_t))
+
+    # simplify the track in local coordinates [m], with a tolerance relative to
+    # its extent: about a pixel when zoomed in a few times. Increase it until
+    # the number of points is bounded (simplifying the previous result, so the
+    # deviation is at most the sum of the tolerances, < 2x the last one).
+    lat_rad = np.deg2rad(pos_lat)
+    lon_rad = np.deg2rad(pos_lon)
+    earth_radius = 6371000
+    points = np.column_stack(((lon_rad - lon_rad[0]) * np.cos(lat_rad[0]) * earth_radius,
+                              (lat_rad - lat_rad[0]) * earth_radius))
+    extent = np.max(np.ptp(points, axis=0))
+    tolerance = max(extent / MAP_RESOLUTION, MINIMUM_TOLERANCE_M)
+    segments = [np.arange(start, end) for start, end in zip(range_starts, range_ends)]
+    while True:
+        segments = [segment[simplify_polyline(points[segment], tolerance)]
+                    for segment in segments]
+        keep = np.zeros(len(pos_t), dtype=bool)
+        keep[np.concatenate(segments)] = True
+        if np.count_nonzero(keep) <= MAX_NUM_POINTS or tolerance > extent:
+            break
+        tolerance *= 2
+
+    # index of the first point of each segment in the output
+    output_idx = np.cumsum(keep)
+    flight_modes = [[rgb_colors(int(sample_modes[start])),
+                     int(output_idx[range_start]) if start > 0 else 0]
+                    for start, range_start in zip(segment_starts, range_starts)]
+    pos_datas = np.round(np.column_stack((pos_lat[keep], pos_lon[keep])), 7).tolist()
+    flight_modes.append(['', len(pos_datas)])
     return (pos_datas, flight_modes)
@@ -0,0 +1,161 @@
+"""
+Flight summary metrics of a log (distance, speeds, attitude, battery and
+vibration): computed once when the log is added and stored in the LogMetrics
+table, for the info table of the plot page and to sort & filter logs.
+"""
+
+import numpy as np
+
+# LogMetrics columns and their names in the JSON APIs and filter arguments
+LOG_METRICS = [
+    ('TotalDistance', 'total_distance_m'),
+    ('MaxAltitudeDiff', 'max_altitude_diff_m'),
+    ('MeanSpeed', 'mean_speed_m_s'), # not for VTOL's
+    ('MeanSpeedMC', 'mean_speed_mc_m_s'), # VTOL only
+    ('MeanSpeedFW', 'mean_speed_fw_m_s'), # VTOL only
+    ('MaxSpeed', 'max_speed_m_s'),
+    ('MaxSpeedHorizontal', 'max_speed_horizontal_m_s'),
+    ('MaxSpeedUp', 'max_speed_up_m_s'),
+    ('MaxSpeedDown', 'max_speed_down_m_s'),
+    ('MaxTiltAngle', 'max_tilt_angle_deg'),
+    ('MaxRotationSpeed', 'max_rotation_speed_deg_s'),
+    ('MeanCurrent', 'mean_current_a'), # not for VTOL's
+    ('MeanCurrentMC', 'mean_current_mc_a'), # VTOL only
+    ('MeanCurrentFW', 'mean_current_fw_a'), # VTOL only
+    ('MaxCurrent', 'max_current_a'),
+    ('DischargedMah', 'discharged_mah'),
+    ('MaxVibration', 'max_vibration_m_s2'), # max accel vibration metric of all IMU's
+    ]
+
+LOG_METRICS_COLUMNS = [column for column, _ in LOG_METRICS]
+
+# topics the metrics are computed from
+LOG_METRICS_TOPICS = ['vehicle_local_position', 'vehicle_attitude', 'battery_status',
+                      'vehicle_imu_status', 'vehicle_status']
+
+
+def _get_vtol_means_per_mode(vtol_states, timestamps, data):
+    """
+    get the mean values separated by MC and FW mode for some
+    data vector
+    :return: tuple of (mean mc, mean fw)
+    """
+    state_timestamps = np.array([timestamp for timestamp, _ in vtol_states])
+    states = np.array([state for _, state in vtol_states])
+    # state of each sample: the last state change before it
+    state_indices = np.searchsorted(state_timestamps, timestamps, side='left') - 1
+    sample_states = np.where(state_indices >= 0, states[np.maximum(state_indices, 0)], -1)
+    data_mc = data[sample_states == 3]
+    data_fw = data[sample_states == 2]
+    mean_mc = float(np.mean(data_mc)) if len(data_mc) > 0 else None
+    mean_fw = float(np.mean(data_fw)) if len(data_fw) > 0 else None
+    return (mean_mc, mean_fw)
+
+
+def _position_metrics(ulog, vtol_states, metrics):
+    local_pos = ulog.get_dataset('vehicle_local_position')
+    pos_x = local_pos.data['x']
+    pos_y = local_pos.data['y']
+    pos_z = local_pos.data['z']
+    pos_xyz_valid = np.multiply(local_pos.data['xy_valid'], local_pos.data['z_valid']) > 0
+    local_vel_valid = np.multiply(local_pos.data['v_xy_valid'],
+                                  local_pos.data['v_z_valid']) > 0
+    vel_x = local_pos.data['vx'][local_vel_valid]
+    vel_y = local_pos.data['vy'][local_vel_valid]
+    vel_z = local_pos.data['vz'][local_vel_valid]
+
+    # total distance (between consecutive valid samples)
+    if len(pos_x) > 1:
+        consecutive_valid = pos_xyz_valid[1:] & pos_xyz_valid[:-1]
+        distances = np.sqrt(np.square(np.diff(pos_x)) + np.square(np.diff(pos_y)) +
+                            np.square(np.diff(pos_z)))
+        metrics['TotalDistance'] = float(np.sum(distances[consecutive_valid]))
+
+    if len(pos_z) > 0:
+        metrics['MaxAltitudeDiff'] = float(np.amax(pos_z) - np.amin(pos_z))
+
+    if len(vel_x) > 0:
+        speed_vector = np.sqrt(np.square(vel_x) + np.square(vel_y) + np.square(vel_z))
+        if vtol_states is None:
+            metrics['MeanSpeed'] = float(np.mean(speed_vector))
+        else:
+            metrics['MeanSpeedMC'], metrics['MeanSpeedFW'] = _get_vtol_means_per_mode(
+                vtol_states, local_pos.data['timestamp'][local_vel_valid], speed_vector)
+        metrics['MaxSpeed'] = float(np.amax(speed_vector))
+        metrics['MaxSpeedHorizontal'] = float(np.amax(
+            np.sqrt(np.square(vel_x) + np.square(vel_y))))
+        metrics['MaxSpeedUp'] = float(np.amax(-vel_z))
+        metrics['MaxSpeedDown'] = float(np.amax(vel_z))
+
+
+def _attitude_metrics(ulog, metrics):
+    vehicle_attitude = ulog.get_dataset('vehicle_attitude')
+    # roll & pitch are only added by the plot page, so use the quaternion
+    q = [vehicle_attitude.data['q['+str(i)+']'] for i in range(4)]
+    if len(q[0]) > 0:
+        # tilt = angle between [0,0,1] and [0,0,1] rotated by q
+        # (cos(tilt) = cos(roll) * cos(pitch))
+        cos_tilt = 1.0 - 2.0 * (np.square(q[1]) + np.square(q[2]))
+        tilt_angle = np.arccos(np.clip(cos_tilt, -1, 1))*180/np.pi
+        metrics['MaxTiltAngle'] = float(np.amax(tilt_angle))
+
+    rollspeed = vehicle_attitude.data['rollspeed']
+    pitchspeed = vehicle_attitude.data['pitchspeed']
+    yawspeed = vehicle_attitude.data['yawspeed']
+    if len(rollspeed) > 0:
+        max_rot_speed = np.amax(np.sqrt(np.square(rollspeed) +
+                                        np.square(pitchspeed) +
+                                        np.square(yawspeed)))
+        metrics['MaxRotationSpeed'] = float(max_rot_speed*180/np.pi)
+
+
+def _battery_metrics(ulog, vtol_states, metrics):
+    battery_status = ulog.get_dataset('battery_status')
+    battery_current = battery_status.data['current_a']
+    if len(battery_current) > 0:
+        metrics['MaxCurrent'] = float(np.amax(battery_current))
+        if vtol_states is None:
+            metrics['MeanCurrent'] = float(np.mean(battery_current))
+        else:
+            metrics['MeanCurrentMC'], metrics['MeanCurrentFW'] = _get_vtol_means_per_mode(
+                vtol_states, battery_status.data['timestamp'], battery_current)
+    if 'discharged_mah' in battery_status.data:
+        discharged = battery_status.data['discharged_mah']
+        discharged = discharged[np.isfinite(discharged)]
+        if len(discharged) > 0 and np.amax(discharged) > 0:
+            metrics['DischargedMah'] = float(np.amax(discharged))
+
+
+def _vibration_metrics(ulog, metrics):
+    max_vibrations = [np.amax(imu_status.data['accel_vibration_metric'])
+                      for imu_status in ulog.data_list
+                      if imu_status.name == 'vehicle_imu_status' and
+                      'accel_vibration_metric' in imu_status.data and
+                      len(imu_status.data['accel_vibration_metric']) > 0]
+    if len(max_vibrations) > 0:
+        metrics['MaxVibration'] = float(max(max_vibrations))
+
+
+def compute_log_metrics(ulog, vtol_states):
+    """
+    compute the summary metrics of a loaded ULog
+    :param vtol_states: VTOL states, see helper.get_vtol_states()
+    :return: dict with key=LogMetrics column and value=float or None if not
+             available
+    """
+    metrics = dict.fromkeys(LOG_METRICS_COLUMNS)
+    # each group is skipped if its topic or a field is missing
+    for compute_metrics in [lambda: _position_metrics(ulog, vtol_states, metrics),
+                            lambda: _attitude_metrics(ulog, metrics),
+                            lambda: _battery_metrics(ulog, vtol_states, metrics),
+                            lambda: _vibration_metrics(ulog, metrics)]:
+        try:
+            compute_metrics()
+        except (KeyError, IndexError, ValueError):
+            pass
+    return metrics
+
+
+def log_metrics_to_json_dict(metrics):
+    """ :return: dict with the API names of the metrics """
+    return {name: metrics.get(column) for column, name in LOG_METRICS}
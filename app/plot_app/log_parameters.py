@@ -0,0 +1,152 @@
+"""
+Log parameters: extracted from the ULog once (stored in the LogParameters &
+LogParameterChanges tables) and rendered into the export formats from there.
+"""
+
+import csv
+import io
+import json
+
+from db_repository import get_metadata_repository
+from helper import load_ulog_file, is_running_locally
+
+# MAV_PARAM_TYPE values used in QGC .params files
+PARAM_TYPE_INT32 = 6
+PARAM_TYPE_REAL32 = 9
+
+
+def extract_parameters(ulog):
+    """
+    get the parameters of a loaded ULog
+    :return: tuple (parameters, changes), with parameters a list of
+             (name, type, value, system default, airframe default) tuples
+             sorted by name (defaults are None if not in the log), and changes a
+             list of (timestamp, name, value) tuples
+    """
+    system_defaults = {}
+    airframe_defaults = {}
+    if ulog.has_default_parameters:
+        system_defaults = ulog.get_default_parameters(0)
+        airframe_defaults = ulog.get_default_parameters(1)
+    parameters = []
+    for name in sorted(ulog.initial_parameters):
+        value = ulog.initial_parameters[name]
+        param_type = PARAM_TYPE_INT32 if isinstance(value, int) else PARAM_TYPE_REAL32
+        parameters.append((name, param_type, value, system_defaults.get(name),
+                           airframe_defaults.get(name)))
+    changes = [(int(timestamp), name, value)
+               for timestamp, name, value in ulog.changed_parameters]
+    return parameters, changes
+
+
+def store_parameters(log_id, ulog):
+    """ extract the parameters of a loaded ULog and store them in the DB
+    :return: tuple (parameters, changes), see extract_parameters()
+    """
+    parameters, changes = extract_parameters(ulog)
+    get_metadata_repository().insert_parameters(log_id, parameters, changes)
+    return parameters, changes
+
+
+def get_log_parameters(log_id, log_file_name):
+    """ get the parameters of a log from the DB. Logs uploaded before the
+    parameters were stored in the DB are extracted from the log file (once).
+    :return: tuple (parameters, changes), see extract_parameters()
+    """
+    if is_running_locally(): # log_id is the file name, there's no DB entry
+        return extract_parameters(load_ulog_file(log_file_name))
+    result = get_metadata_repository().get_parameters(log_id)
+    if result is None:
+        result = store_parameters(log_id, load_ulog_file(log_file_name))
+    return result
+
+
+def _format_value(param_type, value):
+    if param_type == PARAM_TYPE_INT32:
+        return str(int(value))
+    return str(float(value))
+
+
+def _is_default(parameter, use_log_defaults, default_parameters):
+    """ check if a parameter is set to its default value.
+    :param use_log_defaults: if True, use the defaults from the log, otherwise
+                             default_parameters (see helper.get_default_parameters)
+    """
+    name, _, value, system_default, airframe_default = parameter
+    if use_log_defaults:
+        default = airframe_default if airframe_default is not None else system_default
+        return default is None or value == default
+    if name not in default_parameters:
+        return False
+    default_param = default_parameters[name]
+    try:
+        if default_param['type'] == 'FLOAT':
+            return abs(float(default_param['default']) - float(value)) < 0.00001
+        return int(default_param['default']) == int(value)
+    except (TypeError, ValueError):
+        return False
+
+
+def has_log_defaults(parameters):
+    """ check if the log contains the parameter defaults """
+    return any(p[3] is not None or p[4] is not None for p in parameters)
+
+
+def render_qgc_params(parameters, non_default_only=False, default_parameters=None):
+    """ render parameters in the QGC .params format
+    :param non_default_only: only include parameters that differ from the
+           defaults in the log (or default_parameters if the log has none)
+    :return: str
+    """
+    log_defaults = has_log_defaults(parameters)
+    lines = []
+    for parameter in parameters:
+        if non_default_only and _is_default(parameter, log_defaults,
+                                            default_parameters or {}):
+            continue
+        name, param_type, value, _, _ = parameter
+        # sysid, compid, name, value, type
+        lines.append('1\t1\t{}\t{}\t{}\n'.format(
+            name, _format_value(param_type, value), param_type))
+    return ''.join(lines)
+
+
+def render_csv(parameters):
+    """ render parameters as CSV (with defaults)
+    :return: str
+    """
+    output = io.StringIO()
+    writer = csv.writer(output, lineterminator='\n')
+    writer.writerow(['name', 'value', 'type', 'system_default', 'airframe_default'])
+    for name, param_type, value, system_default, airframe_default in parameters:
+        writer.writerow([
+            name, _format_value(param_type, value),
+            'INT32' if param_type == PARAM_TYPE_INT32 else 'FLOAT',
+            '' if system_default is None else _format_value(param_type, system_default),
+            '' if airframe_default is None else _format_value(param_type, airframe_default)])
+    return output.getvalue()
+
+
+def render_json(parameters, changes):
+    """ render parameters (incl. the changes during the log) as JSON
+    :return: str
+    """
+    param_types = {}
+    json_parameters = []
+    for name, param_type, value, system_default, airframe_default in parameters:
+        param_types[name] = param_type
+        is_int = param_type == PARAM_TYPE_INT32
+        convert = int if is_int else float
+        json_parameters.append({
+            'name': name,
+            'value': convert(value),
+            'type': 'INT32' if is_int else 'FLOAT',
+            'system_default': None if system_default is None else convert(system_default),
+            'airframe_default': None if airframe_default is None else convert(airframe_default),
+            })
+    json_changes = [{
+        'timestamp': timestamp,
+        'name': name,
+        'value': int(value) if param_types.get(name) == PARAM_TYPE_INT32 else float(value),
+        } for timestamp, name, value in changes]
+    return json.dumps({'parameters': json_parameters, 'changed_parameters': json_changes})
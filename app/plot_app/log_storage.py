@@ -0,0 +1,318 @@
+""" log file storage backends: local filesystem & S3-compatible object storage """
+
+import os
+import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+#pylint: disable=import-outside-toplevel,invalid-name,too-many-arguments
+
+
+class LocalFileCache:
+    """
+    Size-bounded directory of files with LRU eviction. It can be shared
+    between processes: the last access time is tracked via the file mtime and
+    files are added with an atomic rename.
+    """
+
+    # files accessed more recently than this [s] are never evicted, so that a
+    # file name returned by get() stays valid while the caller reads it
+    MIN_AGE = 60
+
+    def __init__(self, path, max_size):
+        """
+        :param path: cache directory
+        :param max_size: maximum total size in bytes
+        """
+        self._path = path
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def get_filename(self, key):
+        """ get the file name of a cache entry (it might not exist) """
+        return os.path.join(self._path, key)
+
+    def get(self, key):
+        """ :return: the file name of a cache entry or None if not cached """
+        file_name = self.get_filename(key)
+        try:
+            os.utime(file_name)
+        except FileNotFoundError:
+            return None
+        return file_name
+
+    def new_temp_filename(self):
+        """ get a file name for a new entry (on the same filesystem as the
+        cache, pass it to add() once written) """
+        return os.path.join(self._path, '.tmp-' + str(uuid.uuid4()))
+
+    def add(self, key, file_name):
+        """ move a file into the cache and evict old entries if needed
+        :return: the file name of the cache entry
+        """
+        cache_file_name = self.get_filename(key)
+        os.replace(file_name, cache_file_name)
+        self.evict()
+        return cache_file_name
+
+    def remove(self, key):
+        """ remove an entry (if cached) """
+        try:
+            os.unlink(self.get_filename(key))
+        except FileNotFoundError:
+            pass
+
+    def evict(self):
+        """ remove the least recently used entries until the cache size is
+        within the limit """
+        with self._lock:
+            entries = []
+            total_size = 0
+            with os.scandir(self._path) as it:
+                for entry in it:
+                    if entry.name.startswith('.tmp-') or not entry.is_file():
+                        continue
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError: # removed by another process
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    total_size += stat.st_size
+            if total_size <= self._max_size:
+                return
+            min_mtime = time.time() - self.MIN_AGE
+            for mtime, size, file_name in sorted(entries):
+                if total_size <= self._max_size or mtime > min_mtime:
+                    break
+                try:
+                    os.unlink(file_name)
+                except FileNotFoundError:
+                    pass
+                total_size -= size
+
+
+class FilesystemLogStorage:
+    """ log files stored in a local directory (or a mounted network FS) """
+
+    def __init__(self, path):
+        self._path = path
+
+    def get_local_filename(self, log_id):
+        """ get the local file name of a log (it might not exist) """
+        return os.path.join(self._path, log_id + '.ulg')
+
+    def exists(self, log_id):
+        """ check if a log file exists """
+        return os.path.exists(self.get_local_filename(log_id))
+
+    def get_size(self, log_id):
+        """ :return: size of a log file in bytes or None if it does not exist """
+        try:
+            return os.path.getsize(self.get_local_filename(log_id))
+        except FileNotFoundError:
+            return None
+
+    def get_staging_filename(self, log_id):
+        """ get the file name to write a new log file to, before calling
+        commit() """
+        return self.get_local_filename(log_id)
+
+    def commit(self, log_id, file_name):
+        """ store a new log file written to get_staging_filename() """
+        final_file_name = self.get_local_filename(log_id)
+        if file_name != final_file_name:
+            shutil.move(file_name, final_file_name, copy_function=shutil.copyfile)
+
+    def delete(self, log_id):
+        """ delete a log file
+        :return: True if it existed
+        """
+        try:
+            os.unlink(self.get_local_filename(log_id))
+        except FileNotFoundError:
+            return False
+        return True
+
+
+class S3LogStorage:
+    """
+    log files stored in an S3-compatible object storage (AWS S3, MinIO, ...).
+    Logs are read through a local LocalFileCache, so that hot logs are served
+    from local disk. Cold logs are fetched with parallel ranged GET requests.
+    """
+
+    def __init__(self, client, bucket, prefix, cache, num_connections=8,
+                 chunk_size=8*1024*1024):
+        """
+        :param client: boto3 S3 client (or an object with the same interface)
+        :param cache: LocalFileCache
+        """
+        self._client = client
+        self._bucket = bucket
+        self._prefix = prefix
+        self._cache = cache
+        self._num_connections = max(num_connections, 1)
+        self._chunk_size = max(chunk_size, 1024*1024)
+        self._lock = threading.Lock()
+        self._fetch_locks = {} # log_id -> [lock, num users]
+
+    def _get_key(self, log_id):
+        return self._prefix + log_id + '.ulg'
+
+    @staticmethod
+    def _is_not_found(error):
+        code = str(error.response.get('Error', {}).get('Code', ''))
+        return code in ('404', 'NoSuchKey', 'NotFound')
+
+    def _head(self, log_id):
+        """ :return: head_object() response or None if not found """
+        try:
+            return self._client.head_object(Bucket=self._bucket, Key=self._get_key(log_id))
+        except self._client.exceptions.ClientError as error:
+            if self._is_not_found(error):
+                return None
+            raise
+
+    def _download(self, log_id, file_name):
+        """ download a log file with parallel ranged requests
+        :return: False if it does not exist
+        """
+        head = self._head(log_id)
+        if head is None:
+            return False
+        size = head['ContentLength']
+        key = self._get_key(log_id)
+        fd = os.open(file_name, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, size)
+
+            def fetch_range(start):
+                end = min(start + self._chunk_size, size) - 1
+                # IfMatch: fail instead of mixing ranges of different versions
+                body = self._client.get_object(
+                    Bucket=self._bucket, Key=key, IfMatch=head['ETag'],
+                    Range='bytes={:}-{:}'.format(start, end))['Body']
+                offset = start
+                for data in iter(lambda: body.read(1024*1024), b''):
+                    data = memoryview(data)
+                    while len(data) > 0:
+                        num_written = os.pwrite(fd, data, offset)
+                        offset += num_written
+                        data = data[num_written:]
+                if offset != end + 1:
+                    raise IOError('Incomplete download of {:} ({:}-{:})'.format(
+                        key, start, end))
+
+            starts = range(0, size, self._chunk_size)
+            if len(starts) <= 1:
+                for start in starts:
+                    fetch_range(start)
+            else:
+                num_workers = min(self._num_connections, len(starts))
+                with ThreadPoolExecutor(max_workers=num_workers) as executor:
+                    list(executor.map(fetch_range, starts))
+        finally:
+            os.close(fd)
+        return True
+
+    def get_local_filename(self, log_id):
+        """ get the local file name of a log, downloading it into the cache if
+        needed. If the log does not exist, the returned file does not exist
+        either. """
+        file_name = self._cache.get(log_id)
+        if file_name is not None:
+            return file_name
+
+        # only one download per log at a time (per process)
+        with self._lock:
+            lock_entry = self._fetch_locks.setdefault(log_id, [threading.Lock(), 0])
+            lock_entry[1] += 1
+        try:
+            with lock_entry[0]:
+                file_name = self._cache.get(log_id)
+                if file_name is not None:
+                    return file_name
+                temp_file_name = self._cache.new_temp_filename()
+                try:
+                    if self._download(log_id, temp_file_name):
+                        return self._cache.add(log_id, temp_file_name)
+                finally:
+                    if os.path.exists(temp_file_name):
+                        os.unlink(temp_file_name)
+                return self._cache.get_filename(log_id)
+        finally:
+            with self._lock:
+                lock_entry[1] -= 1
+                if lock_entry[1] == 0:
+                    del self._fetch_locks[log_id]
+
+    def exists(self, log_id):
+        """ check if a log file exists """
+        if self._cache.get(log_id) is not None:
+            return True
+        return self._head(log_id) is not None
+
+    def get_size(self, log_id):
+        """ :return: size of a log file in bytes or None if it does not exist """
+        head = self._head(log_id)
+        return None if head is None else head['ContentLength']
+
+    def get_staging_filename(self, log_id):
+        """ get the file name to write a new log file to, before calling
+        commit() """
+        return self._cache.new_temp_filename()
+
+    def commit(self, log_id, file_name):
+        """ upload a new log file written to get_staging_filename(). The file
+        is kept in the cache, as it is likely to be viewed right away. """
+        self._client.upload_file(file_name, self._bucket, self._get_key(log_id))
+        self._cache.add(log_id, file_name)
+
+    def delete(self, log_id):
+        """ delete a log file
+        :return: True if it existed
+        """
+        existed = self.exists(log_id)
+        self._client.delete_object(Bucket=self._bucket, Key=self._get_key(log_id))
+        self._cache.remove(log_id)
+        return existed
+
+
+def create_s3_client(endpoint_url, access_key_id, secret_access_key, max_connections):
+    """ create a boto3 S3 client. Empty arguments use the boto3 defaults
+    (e.g. credentials from the environment) """
+    try:
+        import boto3
+        from botocore.config import Config
+    except ImportError as error:
+        raise ImportError('The S3 log storage requires boto3 '
+                          '(pip install boto3)') from error
+    return boto3.session.Session().client(
+        's3', endpoint_url=endpoint_url or None,
+        aws_access_key_id=access_key_id or None,
+        aws_secret_access_key=secret_access_key or None,
+        config=Config(max_pool_connections=max(max_connections, 10)))
+
+
+_storages = {}
+_storages_pid = None
+_storages_lock = threading.Lock()
+
+def get_log_storage_instance(key, create_function):
+    """ get the log storage of the current process for a configuration key,
+    creating it with create_function() on first use.
+    A forked worker process gets new instances (S3 clients must not be shared
+    across processes). """
+    global _storages_pid #pylint: disable=global-statement
+    with _storages_lock:
+        if _storages_pid != os.getpid():
+            _storages.clear()
+            _storages_pid = os.getpid()
+        storage = _storages.get(key)
+        if storage is None:
+            storage = create_function()
+            _storages[key] = storage
+        return storage
@@ -15,8 +15,10 @@ from helper import *
 from config import *
 from colors import HTML_color_to_RGB
 from db_entry import *
+from db_repository import get_metadata_repository
 from configured_plots import generate_plots
 from pid_analysis_plots import get_pid_analysis_plots
+from spectral import SpectralAnalysis
 from statistics_plots import StatisticsPlots
 
 #pylint: disable=invalid-name, redefined-outer-name
@@ -128,42 +130,16 @@ else:
         # read the data from DB
         db_data = DBData()
         vehicle_data = None
+        log_metrics = None
         try:
-            con = get_db_connection()
-            cur = con.cursor()
-            cur.execute('select Description, Feedback, Type, WindSpeed, Rating, VideoUrl, '
-                        'ErrorLabels from Logs where Id = ?', [log_id])
-            db_tuple = cur.fetchone()
-            if db_tuple is not None:
-                db_data.description = db_tuple[0]
-                db_data.feedback = db_tuple[1]
-                db_data.type = db_tuple[2]
-                db_data.wind_speed = db_tuple[3]
-                db_data.rating = db_tuple[4]
-                db_data.video_url = db_tuple[5]
-                db_data.error_labels = sorted(
-                    [int(x) for x in db_tuple[6].split(',') if len(x) > 0]) \
-                    if db_tuple[6] else []
+            repository = get_metadata_repository()
+            db_data = repository.get_db_data(log_id) or db_data
+            log_metrics = repository.get_log_metrics(log_id)
 
             # vehicle data
             if 'sys_uuid' in ulog.msg_info_dict:
                 sys_uuid = escape(ulog.msg_info_dict['sys_uuid'])
-
-                cur.execute('select LatestLogId, Name, FlightTime '
-                            'from Vehicle where UUID = ?', [sys_uuid])
-                db_tuple = cur.fetchone()
-                if db_tuple is not None:
-                    vehicle_data = DBVehicleData()
-                    vehicle_data.log_id = db_tuple[0]
-                    if len(db_tuple[1]) > 0:
-                        vehicle_data.name = db_tuple[1]
-                    try:
-                        vehicle_data.flight_time = int(db_tuple[2])
-                    except:
-                        pass
-
-            cur.close()
-            con.close()
+                vehicle_data = repository.get_vehicle(sys_uuid)
         except:
             print("DB access failed:", sys.exc_info()[0], sys.exc_info()[1])
 
@@ -192,7 +168,7 @@ else:
             try:
                 link_to_main_plots = '?log='+log_id
                 plots = get_pid_analysis_plots(ulog, px4_ulog, db_data,
-                                               link_to_main_plots)
+                                               link_to_main_plots, get_log_blob_id(log_id))
 
                 title = 'Flight Review - '+px4_ulog.get_mav_type()
 
@@ -230,8 +206,12 @@ else:
             link_to_pid_analysis_page = '?plots=pid_analysis&log='+log_id
 
             try:
+                spectral_analysis = SpectralAnalysis(
+                    get_spectral_analysis_cache_filename(get_log_blob_id(log_id)))
                 plots = generate_plots(ulog, px4_ulog, db_data, vehicle_data,
-                                       link_to_3d_page, link_to_pid_analysis_page)
+                                       link_to_3d_page, link_to_pid_analysis_page,
+                                       log_metrics, spectral_analysis)
+                spectral_analysis.save()
 
                 title = 'Flight Review - '+px4_ulog.get_mav_type()
 
@@ -3,14 +3,15 @@ Module for generating overview map
 """
 
 import os
+import shutil
 #pylint: disable=ungrouped-imports
 import matplotlib
 matplotlib.use('Agg')
 import smopy
 import matplotlib.pyplot as plt
 
-from config import get_log_filepath, get_overview_img_filepath
-from helper import load_ulog_file, get_lat_lon_alt_deg
+from config import get_overview_img_filepath
+from helper import load_ulog_file, get_lat_lon_alt_deg, get_log_filename
 
 MAXTILES = 16
 def get_zoom(input_box, z=18):
@@ -27,7 +28,7 @@ def get_zoom(input_box, z=18):
 def generate_overview_img_from_id(log_id):
     ''' This function will load file and save overview from/into configured directories
         '''
-    ulog_file = os.path.join(get_log_filepath(), log_id+'.ulg')
+    ulog_file = get_log_filename(log_id)
     ulog = load_ulog_file(ulog_file)
     generate_overview_img(ulog, log_id)
 
@@ -71,3 +72,20 @@ def generate_overview_img(ulog, log_id):
         # Ignore. Eg. if topic not found
         print('Error generating overview file: '+ output_filename+' - No GPS?')
 
+
+def copy_overview_img(source_log_id, log_id):
+    ''' Reuse the overview of another log with the same content (hard linked
+        if possible)
+        :return: True if the source log has an overview
+        '''
+    source_filename = os.path.join(get_overview_img_filepath(), source_log_id+'.png')
+    output_filename = os.path.join(get_overview_img_filepath(), log_id+'.png')
+    if not os.path.exists(source_filename):
+        return False
+    try:
+        os.link(source_filename, output_filename)
+    except FileExistsError:
+        pass
+    except OSError:
+        shutil.copyfile(source_filename, output_filename)
+    return True
@@ -3,12 +3,14 @@
 import colorsys
 
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 
 from bokeh.models import Range1d, Span, LinearColorMapper, ColumnDataSource, LabelSet
 from scipy.interpolate import interp1d
 from scipy.ndimage.filters import gaussian_filter1d
 
-from config import colors3
+from config import colors3, get_pid_analysis_memory_budget
+from fft_plans import get_rfft_plan, get_irfft_plan
 from plotting import DataPlot
 
 # keep the same formatting as the original code
@@ -57,7 +59,44 @@ class Trace:
             }
         if d_err is not None: data['d_err'] = d_err
         if debug is not None: data['debug'] = debug
-        self.time, self.data = self.equalize_data(time, data)
+        self._init_stacks(name, *self.equalize_data(time, data))
+        self._init_response(wiener_deconvolution([self.stacks['input']], [self.stacks['gyro']],
+                                                 self.window, self.cutfreq, self.dt, self.rlen)[0])
+
+    @classmethod
+    def from_axes(cls, names, time, gyro_rates, gyro_setpoints, throttle):
+        """Analyze several axes with the same sampling times and throttle at once.
+        The data is resampled once and the deconvolution of all axes runs as a
+        single batch (much faster than a Trace per axis).
+
+        :param names: list of axis names
+        :param gyro_rates: list of np arrays, one per axis (see __init__)
+        :param gyro_setpoints: list of np arrays, one per axis
+        :return: list of Trace objects
+        """
+        data = {'throttle': throttle}
+        for i in range(len(names)):
+            data['gyro'+str(i)] = gyro_rates[i]
+            data['input'+str(i)] = gyro_setpoints[i]
+        time, data = cls.equalize_data(time, data)
+        traces = []
+        for i, name in enumerate(names):
+            trace = cls.__new__(cls)
+            trace._init_stacks(name, time, {'gyro': data['gyro'+str(i)],
+                                            'input': data['input'+str(i)],
+                                            'throttle': data['throttle']})
+            traces.append(trace)
+        deconvolved = wiener_deconvolution([trace.stacks['input'] for trace in traces],
+                                           [trace.stacks['gyro'] for trace in traces],
+                                           traces[0].window, cls.cutfreq, traces[0].dt,
+                                           traces[0].rlen)
+        for trace, deconvolved_sm in zip(traces, deconvolved):
+            trace._init_response(deconvolved_sm)
+        return traces
+
+    def _init_stacks(self, name, time, data):
+        """ set the resampled data and the window stacks """
+        self.time, self.data = time, data
         self.gyro = self.data['gyro']
         self.input = self.data['input']
         self.throttle = self.data['throttle']
@@ -76,7 +115,10 @@ class Trace:
 
         self.stacks = self.winstacker({'time':[],'input':[],'gyro':[], 'throttle':[]}, self.flen, Trace.superpos)                                  # [[time, input, output],]
         self.window = np.hanning(self.flen)                                     #self.tukeywin(self.flen, self.tuk_alpha)
-        self.spec_sm, self.avr_t, self.avr_in, self.max_in, self.max_thr = self.stack_response(self.stacks, self.window)
+
+    def _init_response(self, deconvolved_sm):
+        """ compute the step response & noise analysis from the deconvolved stacks """
+        self.spec_sm, self.avr_t, self.avr_in, self.max_in, self.max_thr = self.stack_response(self.stacks, self.window, deconvolved_sm)
         self.low_mask, self.high_mask = self.low_high_mask(self.max_in, self.threshold)       #calcs masks for high and low inputs according to threshold
         self.toolow_mask = self.low_high_mask(self.max_in, 20)[1]          #mask for ignoring noisy low input
 
@@ -108,6 +150,11 @@ class Trace:
             else:
                 self.filter_trans = self.noise_gyro['hist2d'].mean(axis=1)*0.
 
+    @property
+    def has_high_rates(self):
+        """ whether there is enough high input rate data (resp_high is set) """
+        return self.high_mask.sum() > 0
+
     @staticmethod
     def low_high_mask(signal, threshold):
         low = np.copy(signal)
@@ -121,7 +168,8 @@ class Trace:
 
         return low, high
 
-    def to_mask(self, clipped):
+    @staticmethod
+    def to_mask(clipped):
         clipped-=clipped.min()
         clipped_max = clipped.max()
         if clipped_max > 1e-10: # avoid division by zero
@@ -183,9 +231,10 @@ class Trace:
         :return: tuple of (time, data)
         """
         newtime = np.linspace(time[0], time[-1], len(time), dtype=np.float64)
-        output = {}
-        for key in data:
-            output[key] = interp1d(time, data[key])(newtime)
+        # interpolate all at once (a single search of the sample positions)
+        keys = list(data.keys())
+        resampled = interp1d(time, np.vstack([data[key] for key in keys]))(newtime)
+        output = {key: resampled[i] for i, key in enumerate(keys)}
         return (newtime, output)
 
 
@@ -198,44 +247,25 @@ class Trace:
 
     def winstacker(self, stackdict, flen, superpos):
         ### makes stack of windows for deconvolution
+        ### the stacks are read-only strided views of the data (no copies), they
+        ### get materialized when multiplied with the window before the FFT
         tlen = len(self.time)
         shift = int(flen/superpos)
-        wins = int((tlen-flen)/shift)
-        for i in np.arange(wins):
-            for key in stackdict.keys():
-                stackdict[key].append(self.data[key][i * shift:i * shift + flen])
-        for k in stackdict.keys():
-            #print('key',k)
-            #print(len(stackdict[k]))
-            stackdict[k]=np.array(stackdict[k], dtype=np.float64)
+        wins = max(int((tlen-flen)/shift), 0)
+        for key in stackdict.keys():
+            data = np.asarray(self.data[key], dtype=np.float64)
+            if wins == 0:
+                stackdict[key] = np.empty((0, flen), dtype=np.float64)
+            else:
+                stackdict[key] = sliding_window_view(data, flen)[:wins * shift:shift]
         return stackdict
 
-    def wiener_deconvolution(self, input, output, cutfreq):      # input/output are two-dimensional
-        pad = 1024 - (len(input[0]) % 1024)                     # padding to power of 2, increases transform speed
-        input = np.pad(input, [[0,0],[0,pad]], mode='constant')
-        output = np.pad(output, [[0, 0], [0, pad]], mode='constant')
-        H = np.fft.fft(input, axis=-1)
-        G = np.fft.fft(output,axis=-1)
-        freq = np.abs(np.fft.fftfreq(len(input[0]), self.dt))
-        sn = self.to_mask(np.clip(np.abs(freq), cutfreq-1e-9, cutfreq))
-        len_lpf=np.sum(np.ones_like(sn)-sn)
-        sn=self.to_mask(gaussian_filter1d(sn,len_lpf/6.))
-        sn= 10.*(-sn+1.+1e-9)       # +1e-9 to prohibit 0/0 situations
-        Hcon = np.conj(H)
-        deconvolved_sm = np.real(np.fft.ifft(G * Hcon / (H * Hcon + 1./sn),axis=-1))
-        return deconvolved_sm
-
-    def stack_response(self, stacks, window):
-        inp = stacks['input'] * window
-        outp = stacks['gyro'] * window
-        thr = stacks['throttle'] * window
-
-        deconvolved_sm = self.wiener_deconvolution(inp, outp, self.cutfreq)[:, :self.rlen]
-        delta_resp = deconvolved_sm.cumsum(axis=1)
-
-        max_thr = np.abs(np.abs(thr)).max(axis=1)
-        avr_in = np.abs(np.abs(inp)).mean(axis=1)
-        max_in = np.max(np.abs(inp), axis=1)
+    def stack_response(self, stacks, window, deconvolved_sm):
+        ### deconvolved_sm: the wiener_deconvolution() of the stacks (cumsum'ed in place)
+        delta_resp = np.cumsum(deconvolved_sm, axis=1, out=deconvolved_sm)
+
+        max_thr = windowed_abs_stats(stacks['throttle'], window)[0]
+        max_in, avr_in = windowed_abs_stats(stacks['input'], window)
         avr_t = stacks['time'].mean(axis=1)
 
         return delta_resp, avr_t, avr_in, max_in, max_thr
@@ -262,18 +292,12 @@ class Trace:
         f_amp_freq, f_amp_hist =np.histogram(full_freq_f, weights=np.abs(full_spec_f.real).flatten(), bins=int(full_freq_f[-1]))
         r_amp_freq, r_amp_hist = np.histogram(full_freq_r, weights=np.abs(full_spec_r.real).flatten(), bins=int(full_freq_r[-1]))
 
-    def hist2d(self, x, y, weights, bins):   #bins[nx,ny]
-        ### generates a 2d hist from input 1d axis for x,y. repeats them to match shape of weights X*Y (data points)
+    def hist2d(self, x, y, hist2d):
+        ### normalizes a 2d hist (see stack_histogram2d) of the rows of a stack against x (per row), y (per column)
         ### x will be 0-100%
-        freqs = np.repeat(np.array([y], dtype=np.float64), len(x), axis=0)
-        throts = np.repeat(np.array([x], dtype=np.float64), len(y), axis=0).transpose()
         throt_hist_avr, throt_scale_avr = np.histogram(x, 101, [0, 100])
 
-        hist2d = np.histogram2d(throts.flatten(), freqs.flatten(),
-                                range=[[0, 100], [y[0], y[-1]]],
-                                bins=bins, weights=weights.flatten(), normed=False)[0].transpose()
-
-        hist2d = np.array(abs(hist2d), dtype=np.float64)
+        hist2d = np.abs(hist2d)
         hist2d_norm = np.copy(hist2d)
         hist2d_norm /=  (throt_hist_avr + 1e-9)
 
@@ -282,17 +306,25 @@ class Trace:
 
     def stackspectrum(self, time, throttle, trace, window):
         ### calculates spectrogram from stack of windows against throttle.
+        ### the spectra are computed & accumulated in chunks of windows (within the memory budget)
         # slicing off last 2s to get rid of landing
-        gyro = trace[:-int(Trace.noise_superpos*2./Trace.noise_framelen),:] * window
-        thr = throttle[:-int(Trace.noise_superpos*2./Trace.noise_framelen),:] * window
+        gyro = trace[:-int(Trace.noise_superpos*2./Trace.noise_framelen),:]
+        thr = throttle[:-int(Trace.noise_superpos*2./Trace.noise_framelen),:]
         time = time[:-int(Trace.noise_superpos*2./Trace.noise_framelen),:]
 
-        freq, spec = self.spectrum(time[0], gyro)
-
-        weights = abs(spec.real)
-        avr_thr = np.abs(thr).max(axis=1)
+        avr_thr = windowed_abs_stats(thr, window)[0]
+        num_windows = len(gyro)
+        freq = self.spectrum(time[0], gyro[:1] * window)[0]
+        bins = [101, len(freq)//4]
+        hist = np.zeros((bins[1], bins[0]), dtype=np.float64)
+        chunk = _num_chunk_rows(len(freq) * _SPECTRUM_BYTES_PER_FREQUENCY, num_windows)
+        for start in range(0, num_windows, chunk):
+            spec = self.spectrum(time[0], gyro[start:start + chunk] * window)[1]
+            weights = abs(spec.real)
+            stack_histogram2d(avr_thr[start:start + chunk, np.newaxis], freq, weights,
+                              [[0, 100], [freq[0], freq[-1]]], bins, out=hist)
 
-        hist2d=self.hist2d(avr_thr, freq,weights,[101,len(freq)/4])
+        hist2d=self.hist2d(avr_thr, freq, hist.astype(np.float32))
 
         filt_width = 3  # width of gaussian smoothing for hist data
         hist2d_sm = gaussian_filter1d(hist2d['hist2d_norm'], filt_width, axis=1, mode='constant')
@@ -311,12 +343,11 @@ class Trace:
         filt_width = 7  # width of gaussian smoothing for hist data
 
         resp_y = np.linspace(vertrange[0], vertrange[-1], vertbins, dtype=np.float64)
-        times = np.repeat(np.array([self.time_resp],dtype=np.float64), len(values), axis=0)
-        weights = np.repeat(weights, len(values[0]))
 
-        hist2d = np.histogram2d(times.flatten(), values.flatten(),
-                                range=[[self.time_resp[0], self.time_resp[-1]], vertrange],
-                                bins=[len(times[0]), vertbins], weights=weights.flatten())[0].transpose()
+        # x: the response time of each column, weights: one per window (row)
+        hist2d = stack_histogram2d(self.time_resp, values, np.asarray(weights)[:, np.newaxis],
+                                   [[self.time_resp[0], self.time_resp[-1]], vertrange],
+                                   [len(self.time_resp), vertbins])
         ### shift outer edges by +-1e-5 (10us) bacause of dtype32. Otherwise different precisions lead to artefacting.
         ### solution to this --> somethings strage here. In outer most edges some bins are doubled, some are empty.
         ### Hence sometimes produces "divide by 0 error" in "/=" operation.
@@ -325,9 +356,9 @@ class Trace:
             hist2d_sm = gaussian_filter1d(hist2d, filt_width, axis=0, mode='constant')
             hist2d_sm /= np.max(hist2d_sm, 0)
 
-
-            pixelpos = np.repeat(resp_y.reshape(len(resp_y), 1), len(times[0]), axis=1)
-            avr = np.average(pixelpos, 0, weights=hist2d_sm * hist2d_sm)
+            # weighted average of the pixel positions (resp_y) of each column
+            pixel_weights = hist2d_sm * hist2d_sm
+            avr = resp_y.dot(pixel_weights) / pixel_weights.sum(axis=0)
         else:
             hist2d_sm = hist2d
             avr = np.zeros_like(self.time_resp)
@@ -346,10 +377,204 @@ class Trace:
         return (average, np.sqrt(variance))
 
 
+class TraceResult:
+    """ The results of a Trace that are plotted by plot_pid_response(), without
+    the input data & stacks. They can be stored in a dict of numpy arrays (e.g.
+    with np.savez), see to_arrays() & from_arrays().
+    """
+    resplen = Trace.resplen
+
+    def __init__(self, name, time_resp, resp_low, resp_high=None):
+        """
+        :param resp_low, resp_high: results of Trace.weighted_mode_avr(), i.e.
+                                    (avr, std, [time_resp, resp_y, hist2d_sm])
+        """
+        self.name = name
+        self.time_resp = time_resp
+        self.resp_low = resp_low
+        self.resp_high = resp_high
+        self.has_high_rates = resp_high is not None
+
+    @classmethod
+    def from_trace(cls, trace):
+        return cls(trace.name, trace.time_resp, trace.resp_low,
+                   trace.resp_high if trace.has_high_rates else None)
+
+    def to_arrays(self, prefix):
+        """ :return: dict of numpy arrays, with keys starting with prefix """
+        arrays = {prefix+'name': np.array(self.name), prefix+'time_resp': self.time_resp}
+        for key, resp in [('low', self.resp_low), ('high', self.resp_high)]:
+            if resp is not None:
+                avr, std, (_, resp_y, hist2d_sm) = resp
+                arrays[prefix+key+'_avr'] = avr
+                arrays[prefix+key+'_std'] = std
+                arrays[prefix+key+'_resp_y'] = resp_y
+                # only used as image, float32 is precise enough
+                arrays[prefix+key+'_hist2d_sm'] = hist2d_sm.astype(np.float32)
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays, prefix):
+        """ :param arrays: dict of numpy arrays as returned by to_arrays() """
+        time_resp = arrays[prefix+'time_resp']
+        responses = {}
+        for key in ['low', 'high']:
+            if prefix+key+'_avr' in arrays:
+                responses[key] = (arrays[prefix+key+'_avr'], arrays[prefix+key+'_std'],
+                                  [time_resp, arrays[prefix+key+'_resp_y'],
+                                   arrays[prefix+key+'_hist2d_sm']])
+        return cls(str(arrays[prefix+'name']), time_resp, responses['low'],
+                   responses.get('high'))
+
+
+# approximate number of bytes of temporary arrays per value of a stack (used
+# to split the computations into chunks of windows within the memory budget)
+_HISTOGRAM_BYTES_PER_VALUE = 48
+_DECONVOLUTION_BYTES_PER_SAMPLE = 64
+_SPECTRUM_BYTES_PER_FREQUENCY = 64
+_WINDOWED_BYTES_PER_VALUE = 16
+
+
+def _num_chunk_rows(bytes_per_row, num_rows):
+    """ :return: number of rows (windows) to process at once """
+    return int(np.clip(get_pid_analysis_memory_budget() // max(bytes_per_row, 1), 1, max(num_rows, 1)))
+
+
+def windowed_abs_stats(stack, window):
+    """Maximum & mean of the absolute values of each window of a stack, after
+    applying the window function. The windowed stack is computed in chunks of
+    windows (within the memory budget).
+
+    :param stack: 2D array (windows x samples)
+    :return: tuple of (max, mean) arrays, one value per window
+    """
+    num_rows, num_cols = stack.shape
+    max_values = np.empty(num_rows, dtype=np.float64)
+    mean_values = np.empty(num_rows, dtype=np.float64)
+    chunk = _num_chunk_rows(num_cols * _WINDOWED_BYTES_PER_VALUE, num_rows)
+    for start in range(0, num_rows, chunk):
+        windowed = np.abs(stack[start:start + chunk] * window)
+        windowed.max(axis=1, out=max_values[start:start + chunk])
+        windowed.mean(axis=1, out=mean_values[start:start + chunk])
+    return max_values, mean_values
+
+
+def uniform_bin_indices(values, first_edge, last_edge, num_bins):
+    """Bin indices of values for equally sized bins, computed directly instead
+    of searching the bin edges. Same bins as np.histogram: the last bin includes
+    the right edge.
+
+    :return: array of bin indices (np.intp), -1 for values outside the range
+    """
+    values = np.asarray(values)
+    edges = np.linspace(first_edge, last_edge, num_bins + 1)
+    valid = (values >= first_edge) & (values <= last_edge)
+    indices = np.where(valid, (values - first_edge) * (num_bins / (last_edge - first_edge)), 0.)
+    indices = indices.astype(np.intp)
+    np.minimum(indices, num_bins - 1, out=indices)
+    # correct rounding errors at the bin edges
+    indices -= values < edges[indices]
+    indices += (values >= edges[indices + 1]) & (indices != num_bins - 1)
+    indices[~valid] = -1
+    return indices
+
+
+def stack_histogram2d(x, y, weights, ranges, bins, out=None):
+    """Weighted 2D histogram of the values of a stack of windows. Same as
+    np.histogram2d(x, y, bins, ranges, weights=weights)[0].transpose() on the
+    flattened stack, but the inputs are broadcast instead of repeated, and the
+    bins are accumulated in chunks of windows (within the memory budget).
+
+    :param x, y, weights: arrays broadcastable to the stack shape (windows x samples),
+                          i.e. a 2D stack, a column (windows x 1) or a row (samples)
+    :param ranges: [[xmin, xmax], [ymin, ymax]]
+    :param bins: [nx, ny]
+    :param out: optional 2D float64 array (ny x nx) to add the histogram to, to
+                accumulate the histograms of several chunks of a stack
+    :return: 2D float32 array (ny x nx), or out if given
+    """
+    num_rows, num_cols = np.broadcast_shapes(np.shape(x), np.shape(y), np.shape(weights))
+    nx, ny = bins
+    hist = np.zeros(ny * nx, dtype=np.float64) if out is None else out.reshape(-1)
+    chunk = _num_chunk_rows(num_cols * _HISTOGRAM_BYTES_PER_VALUE, num_rows)
+    for start in range(0, num_rows, chunk):
+        def rows(a):
+            return a[start:start + chunk] if np.ndim(a) == 2 else a
+        x_indices = uniform_bin_indices(rows(x), ranges[0][0], ranges[0][1], nx)
+        y_indices = uniform_bin_indices(rows(y), ranges[1][0], ranges[1][1], ny)
+        valid = (x_indices >= 0) & (y_indices >= 0)
+        flat_indices = y_indices * nx + x_indices
+        hist += np.bincount(flat_indices[valid], minlength=hist.size,
+                            weights=np.broadcast_to(rows(weights), valid.shape)[valid])
+    if out is not None:
+        return out
+    return hist.reshape(ny, nx).astype(np.float32)
+
+
+def wiener_deconvolution(inputs, outputs, window, cutfreq, dt, num_samples):
+    """Wiener deconvolution of a batch of window stacks, using real FFT's with
+    cached FFTW plans (all axes in one transform). The windows are processed in
+    chunks to stay within the memory budget.
+
+    :param inputs: list of input (setpoint) stacks, 2D arrays (windows x samples)
+                   with the same shape, e.g. Trace.stacks['input'] of each axis
+    :param outputs: list of the matching output (gyro) stacks
+    :param window: window applied to each stack row
+    :param dt: sampling interval [s]
+    :param num_samples: number of samples of the response to return
+    :return: 3D array (axes x windows x num_samples)
+    """
+    num_windows, flen = inputs[0].shape
+    pad = 1024 - (flen % 1024)                     # padding to power of 2, increases transform speed
+    n = flen + pad
+    chunk = _num_chunk_rows(len(inputs) * n * _DECONVOLUTION_BYTES_PER_SAMPLE, num_windows)
+    # a power of 2, so that the plans are reused for logs of similar length
+    chunk = min(chunk, 1 << max(num_windows - 1, 0).bit_length())
+    fft = get_rfft_plan((2, len(inputs), chunk, n))
+    ifft = get_irfft_plan((len(inputs), chunk, n // 2 + 1), n)
+    stacked = fft.input_array
+    stacked[..., flen:] = 0.
+
+    freq = np.abs(np.fft.fftfreq(n, dt))
+    sn = Trace.to_mask(np.clip(np.abs(freq), cutfreq-1e-9, cutfreq))
+    len_lpf=np.sum(np.ones_like(sn)-sn)
+    sn=Trace.to_mask(gaussian_filter1d(sn,len_lpf/6.))
+    sn= 10.*(-sn+1.+1e-9)       # +1e-9 to prohibit 0/0 situations
+    # real(ifft(G * Hcon / (H * Hcon + 1./sn))) with the full spectrum is the
+    # inverse real FFT of the half spectrum with the weights of the positive &
+    # negative frequencies averaged (the smoothed sn is not exactly symmetric
+    # at the lowest frequencies)
+    half = np.arange(n // 2 + 1)
+    inv_sn_pos = 1. / sn[half]
+    inv_sn_neg = 1. / sn[-half]
+    asymmetric = np.nonzero(inv_sn_pos != inv_sn_neg)[0]
+
+    deconvolved = np.empty((len(inputs), num_windows, num_samples), dtype=np.float64)
+    for start in range(0, num_windows, chunk):
+        count = min(chunk, num_windows - start)
+        # rows beyond count (last chunk) contain stale data and are ignored
+        for i in range(len(inputs)):
+            np.multiply(inputs[i][start:start + count], window, out=stacked[0, i, :count, :flen])
+            np.multiply(outputs[i][start:start + count], window, out=stacked[1, i, :count, :flen])
+        spectra = fft()
+        H = spectra[0, :, :count]
+        G = spectra[1, :, :count]
+
+        power = np.square(H.real)
+        power += np.square(H.imag)
+        weights = np.reciprocal(power + inv_sn_pos)
+        weights[..., asymmetric] = 0.5 * (weights[..., asymmetric] +
+                                          1. / (power[..., asymmetric] + inv_sn_neg[asymmetric]))
+        spectrum = np.multiply(G, np.conj(H), out=G)
+        spectrum *= weights
+        deconvolved[:, start:start + count] = ifft(spectra[1])[..., :count, :num_samples]
+    return deconvolved
+
+
 def plot_pid_response(trace, data, plot_config, label='Rate'):
     """Plot PID response for one axis
 
-    :param trace: Trace object
+    :param trace: Trace or TraceResult object
     :param data: ULog.data_list
     """
 
@@ -386,7 +611,7 @@ def plot_pid_response(trace, data, plot_config, label='Rate'):
     # y start and range comes from weighted_mode_avr(, , [-1.5, 3.5])
     p.image([image], x=0, y=-1.5, dw=trace.resplen, dh=5, color_mapper=color_mapper)
 
-    has_high_rates = trace.high_mask.sum() > 0
+    has_high_rates = trace.has_high_rates
     low_rates_label = ''
     if has_high_rates:
         low_rates_label = ' (<500 deg/s)'
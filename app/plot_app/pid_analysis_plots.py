@@ -1,27 +1,229 @@
 """ This contains PID analysis plots """
+import hashlib
+import os
+import uuid
+
 from bokeh.io import curdoc
 from bokeh.models.widgets import Div
 from bokeh.layouts import column
 from scipy.interpolate import interp1d
 
-from config import plot_width, plot_config, colors3
-from helper import get_flight_mode_changes, ActuatorControls
-from pid_analysis import Trace, plot_pid_response
+from config import plot_width, plot_config, colors3, get_pid_analysis_cache_filepath
+from helper import get_flight_mode_changes, ActuatorControls, \
+    get_pid_analysis_cache_filename
+from pid_analysis import Trace, TraceResult, plot_pid_response
 from plotting import *
 from plotted_tables import get_heading_html
 
 #pylint: disable=cell-var-from-loop, undefined-loop-variable,
 
-def get_pid_analysis_plots(ulog, px4_ulog, db_data, link_to_main_plots):
+# version of the analysis results: increase it when the analysis changes, so
+# that cached results are recomputed
+PID_ANALYSIS_VERSION = 2
+
+# minimum gyro rate [Hz] of a log for the analysis to be computed in the
+# background after the upload
+PID_ANALYSIS_PRECOMPUTE_MIN_RATE = 200
+
+
+def _resample(time_array, data, desired_time):
+    """ resample data at a given time to a vector of desired_time """
+    data_f = interp1d(time_array, data, fill_value='extrapolate')
+    return data_f(desired_time)
+
+
+def _get_rate_topic(ulog):
+    """ :return: tuple (rate topic name, list of the roll, pitch & yaw field names) """
+    # COMPATIBILITY support for old logs
+    if any(elem.name == 'vehicle_angular_velocity' for elem in ulog.data_list):
+        return 'vehicle_angular_velocity', ['xyz[0]', 'xyz[1]', 'xyz[2]']
+    return 'rate_ctrl_status', ['rollspeed', 'pitchspeed', 'yawspeed']
+
+
+def _get_roll_pitch(dataset, field_name_suffix=''):
+    """ get roll & pitch from the quaternion of a dataset, like
+    PX4ULog.add_roll_pitch_yaw(), but without adding them to the dataset (the
+    ULog is shared with the plot page)
+    :return: dict with keys 'roll' and 'pitch' [rad]
+    """
+    q = [dataset.data['q'+field_name_suffix+'['+str(i)+']'] for i in range(4)]
+    return {'roll': np.arctan2(2.0 * (q[0] * q[1] + q[2] * q[3]),
+                               1.0 - 2.0 * (q[1] * q[1] + q[2] * q[2])),
+            'pitch': np.arcsin(2.0 * (q[0] * q[2] - q[3] * q[1]))}
+
+
+def _get_actuator_controls(ulog):
+    dynamic_control_alloc = any(elem.name in ('actuator_motors', 'actuator_servos')
+                                for elem in ulog.data_list)
+    return ActuatorControls(ulog, dynamic_control_alloc, 0)
+
+
+def compute_pid_analysis(ulog):
+    """
+    run the PID analysis (step responses) of a log. This is the slow part of
+    the PID analysis page.
+    :return: dict with keys 'rate' and 'attitude' and values: list of
+             TraceResult, 'missing_data', 'failed' or None if not analyzed
+    """
+    rate_topic_name, rate_field_names = _get_rate_topic(ulog)
+    actuator_controls_0 = _get_actuator_controls(ulog)
+    results = {'rate': None, 'attitude': None}
+
+    try:
+        # Rate
+        rate_data = ulog.get_dataset(rate_topic_name)
+        gyro_time = rate_data.data['timestamp']
+
+        vehicle_rates_setpoint = ulog.get_dataset('vehicle_rates_setpoint')
+        actuator_controls_0_data = ulog.get_dataset(actuator_controls_0.thrust_sp_topic)
+        throttle = _resample(actuator_controls_0_data.data['timestamp'],
+                             actuator_controls_0.thrust * 100, gyro_time)
+    except (KeyError, IndexError, ValueError) as error:
+        print(type(error), ":", error)
+        results['rate'] = 'missing_data'
+        return results
+
+    # all axes are analyzed in one batch
+    try:
+        axes = ['roll', 'pitch', 'yaw']
+        gyro_rates = [np.rad2deg(rate_data.data[field_name])
+                      for field_name in rate_field_names]
+        setpoints = [_resample(vehicle_rates_setpoint.data['timestamp'],
+                               np.rad2deg(vehicle_rates_setpoint.data[axis]), gyro_time)
+                     for axis in axes]
+        results['rate'] = [TraceResult.from_trace(trace) for trace in Trace.from_axes(
+            axes, gyro_time / 1e6, gyro_rates, setpoints, throttle)]
+    except Exception as e:
+        print(type(e), "rate:", e)
+        results['rate'] = 'failed'
+        return results
+
+    try:
+        # Attitude (optional)
+        vehicle_attitude = ulog.get_dataset('vehicle_attitude')
+        attitude_time = vehicle_attitude.data['timestamp']
+        vehicle_attitude_setpoint = ulog.get_dataset('vehicle_attitude_setpoint')
+        attitudes = _get_roll_pitch(vehicle_attitude)
+        attitude_setpoints = _get_roll_pitch(vehicle_attitude_setpoint, '_d')
+    except (KeyError, IndexError, ValueError) as error:
+        print(type(error), ":", error)
+        results['attitude'] = 'missing_data'
+        return results
+
+    # don't analyze yaw, as yaw is mostly controlled directly by rate
+    try:
+        throttle = _resample(actuator_controls_0_data.data['timestamp'],
+                             actuator_controls_0.thrust * 100, attitude_time)
+        axes = ['roll', 'pitch']
+        attitudes_estimated = [np.rad2deg(attitudes[axis]) for axis in axes]
+        setpoints = [_resample(vehicle_attitude_setpoint.data['timestamp'],
+                               np.rad2deg(attitude_setpoints[axis]), attitude_time)
+                     for axis in axes]
+        results['attitude'] = [TraceResult.from_trace(trace) for trace in Trace.from_axes(
+            axes, attitude_time / 1e6, attitudes_estimated, setpoints, throttle)]
+    except Exception as e:
+        print(type(e), "attitude:", e)
+        results['attitude'] = 'failed'
+    return results
+
+
+def _get_parameters_hash():
+    """ hash of the analysis version & parameters (cached results with a
+    different hash are not used) """
+    parameters = [PID_ANALYSIS_VERSION, Trace.framelen, Trace.resplen, Trace.cutfreq,
+                  Trace.superpos, Trace.threshold]
+    return hashlib.sha1(repr(parameters).encode()).hexdigest()[:16]
+
+
+def _load_pid_analysis(file_name):
+    """ load cached results of compute_pid_analysis()
+    :return: results or None if not cached (or the file is invalid)
+    """
+    try:
+        with np.load(file_name, allow_pickle=False) as arrays:
+            results = {}
+            for key in ['rate', 'attitude']:
+                status = str(arrays[key])
+                if status == 'ok':
+                    results[key] = [TraceResult.from_arrays(arrays, key+str(i)+'_')
+                                    for i in range(int(arrays[key+'_count']))]
+                else:
+                    results[key] = None if status == 'none' else status
+            return results
+    except FileNotFoundError:
+        return None
+    except (KeyError, ValueError, OSError) as error:
+        print('Error: invalid PID analysis cache file', file_name, error)
+        return None
+
+
+def _store_pid_analysis(file_name, results):
+    """ store the results of compute_pid_analysis() """
+    arrays = {}
+    for key, value in results.items():
+        if isinstance(value, list):
+            arrays[key] = np.array('ok')
+            arrays[key+'_count'] = np.array(len(value))
+            for i, trace in enumerate(value):
+                arrays.update(trace.to_arrays(key+str(i)+'_'))
+        else:
+            arrays[key] = np.array('none' if value is None else value)
+    # write atomically, as results might be stored concurrently
+    temp_file_name = os.path.join(get_pid_analysis_cache_filepath(),
+                                  '.tmp-'+str(uuid.uuid4())+'.npz')
+    try:
+        np.savez_compressed(temp_file_name, **arrays)
+        os.replace(temp_file_name, file_name)
+    except OSError as error:
+        print('Error: failed to store the PID analysis', file_name, error)
+        if os.path.exists(temp_file_name):
+            os.unlink(temp_file_name)
+
+
+def get_pid_analysis(ulog, blob_id):
+    """
+    get the results of compute_pid_analysis(), from the cache if available
+    :param blob_id: id of the stored log file (see helper.get_log_blob_id)
+    """
+    file_name = get_pid_analysis_cache_filename(blob_id, _get_parameters_hash())
+    results = _load_pid_analysis(file_name)
+    if results is None:
+        results = compute_pid_analysis(ulog)
+        # a failure might be temporary (e.g. out of memory), so it is retried
+        if 'failed' not in results.values():
+            _store_pid_analysis(file_name, results)
+    return results
+
+
+def has_high_rate_gyro_data(ulog):
+    """ check if a log has gyro data with at least PID_ANALYSIS_PRECOMPUTE_MIN_RATE """
+    try:
+        timestamps = ulog.get_dataset(_get_rate_topic(ulog)[0]).data['timestamp']
+    except (KeyError, IndexError, ValueError):
+        return False
+    if len(timestamps) < 2:
+        return False
+    delta_t = np.median(np.diff(timestamps)) * 1e-6
+    return 0 < delta_t <= 1 / PID_ANALYSIS_PRECOMPUTE_MIN_RATE
+
+
+def precompute_pid_analysis(ulog, blob_id):
+    """ compute & cache the PID analysis of a log if it has high-rate gyro data
+    and is not cached yet (meant to run in the background after an upload) """
+    try:
+        if has_high_rate_gyro_data(ulog):
+            get_pid_analysis(ulog, blob_id)
+    except Exception as e:
+        print('Error: PID analysis precomputation failed:', type(e), e)
+
+
+def get_pid_analysis_plots(ulog, px4_ulog, db_data, link_to_main_plots, blob_id=None):
     """
     get all bokeh plots shown on the PID analysis page
+    :param blob_id: id of the stored log file, to cache the analysis results
+                    (None: do not use the cache)
     :return: list of bokeh plots
     """
-    def _resample(time_array, data, desired_time):
-        """ resample data at a given time to a vector of desired_time """
-        data_f = interp1d(time_array, data, fill_value='extrapolate')
-        return data_f(desired_time)
-
     page_intro = """
 <p>
 This page shows step response plots for the PID controller. The step
@@ -37,7 +239,8 @@ Documentation with some examples can be found <a
 href="https://github.com/Plasmatree/PID-Analyzer/wiki/Influence-of-parameters">here</a>.
 </p>
 <p>
-The analysis may take a while...
+The analysis is usually computed in the background after the upload. If it is
+not available yet, it may take a while to compute...
 </p>
     """
     curdoc().template_variables['title_html'] = get_heading_html(
@@ -50,47 +253,31 @@ The analysis may take a while...
     x_range_offset = (ulog.last_timestamp - ulog.start_timestamp) * 0.05
     x_range = Range1d(ulog.start_timestamp - x_range_offset, ulog.last_timestamp + x_range_offset)
 
-    # COMPATIBILITY support for old logs
-    if any(elem.name == 'vehicle_angular_velocity' for elem in data):
-        rate_topic_name = 'vehicle_angular_velocity'
-        rate_field_names = ['xyz[0]', 'xyz[1]', 'xyz[2]']
-    else: # old
-        rate_topic_name = 'rate_ctrl_status'
-        rate_field_names = ['rollspeed', 'pitchspeed', 'yawspeed']
-    dynamic_control_alloc = any(elem.name in ('actuator_motors', 'actuator_servos')
-                                for elem in data)
-    actuator_controls_0 = ActuatorControls(ulog, dynamic_control_alloc, 0)
+    rate_topic_name, rate_field_names = _get_rate_topic(ulog)
+    actuator_controls_0 = _get_actuator_controls(ulog)
 
-    # required PID response data
-    pid_analysis_error = False
-    try:
-        # Rate
-        rate_data = ulog.get_dataset(rate_topic_name)
-        gyro_time = rate_data.data['timestamp']
+    if blob_id is None:
+        results = compute_pid_analysis(ulog)
+    else:
+        results = get_pid_analysis(ulog, blob_id)
 
-        vehicle_rates_setpoint = ulog.get_dataset('vehicle_rates_setpoint')
-        actuator_controls_0_data = ulog.get_dataset(actuator_controls_0.thrust_sp_topic)
-        throttle = _resample(actuator_controls_0_data.data['timestamp'],
-                             actuator_controls_0.thrust * 100, gyro_time)
-        time_seconds = gyro_time / 1e6
-    except (KeyError, IndexError, ValueError) as error:
-        print(type(error), ":", error)
-        pid_analysis_error = True
+    def _analysis_failed(error_text):
+        div = Div(text="<p><b>Error</b>: "+error_text+"</p>", width=int(plot_width*0.9))
+        plots.insert(0, column(div, width=int(plot_width*0.9)))
+
+    if results['rate'] == 'missing_data':
         div = Div(text="<p><b>Error</b>: missing topics or data for PID analysis "
                   "(required topics: vehicle_angular_velocity, vehicle_rates_setpoint, "
                   "vehicle_attitude, vehicle_attitude_setpoint and "
                   "actuator_controls_0).</p>", width=int(plot_width*0.9))
         plots.append(column(div, width=int(plot_width*0.9)))
-
-    has_attitude = True
-    try:
-        # Attitude (optional)
-        vehicle_attitude = ulog.get_dataset('vehicle_attitude')
-        attitude_time = vehicle_attitude.data['timestamp']
-        vehicle_attitude_setpoint = ulog.get_dataset('vehicle_attitude_setpoint')
-    except (KeyError, IndexError, ValueError) as error:
-        print(type(error), ":", error)
-        has_attitude = False
+    elif results['rate'] == 'failed':
+        _analysis_failed("PID analysis failed. Possible "
+                         "error causes are: logged data rate is too low, or there "
+                         "is not enough motion for the analysis.")
+    rate_traces = {}
+    if isinstance(results['rate'], list):
+        rate_traces = {trace.name: trace for trace in results['rate']}
 
     for index, axis in enumerate(['roll', 'pitch', 'yaw']):
         axis_name = axis.capitalize()
@@ -145,49 +332,18 @@ The analysis may take a while...
         if data_plot.finalize() is not None: plots.append(data_plot.bokeh_plot)
 
         # PID response
-        if not pid_analysis_error:
-            try:
-                gyro_rate = np.rad2deg(rate_data.data[rate_field_names[index]])
-                setpoint = _resample(vehicle_rates_setpoint.data['timestamp'],
-                                     np.rad2deg(vehicle_rates_setpoint.data[axis]),
-                                     gyro_time)
-                trace = Trace(axis, time_seconds, gyro_rate, setpoint, throttle)
-                plots.append(plot_pid_response(trace, ulog.data_list, plot_config).bokeh_plot)
-            except Exception as e:
-                print(type(e), axis, ":", e)
-                div = Div(text="<p><b>Error</b>: PID analysis failed. Possible "
-                          "error causes are: logged data rate is too low, or there "
-                          "is not enough motion for the analysis.</p>",
-                          width=int(plot_width*0.9))
-                plots.insert(0, column(div, width=int(plot_width*0.9)))
-                pid_analysis_error = True
+        if axis in rate_traces:
+            plots.append(plot_pid_response(rate_traces[axis], ulog.data_list,
+                                           plot_config).bokeh_plot)
 
     # attitude
-    if not pid_analysis_error and has_attitude:
-        throttle = _resample(actuator_controls_0_data.data['timestamp'],
-                             actuator_controls_0.thrust * 100, attitude_time)
-        time_seconds = attitude_time / 1e6
-    # don't plot yaw, as yaw is mostly controlled directly by rate
-    for index, axis in enumerate(['roll', 'pitch']):
-        axis_name = axis.capitalize()
-
-        # PID response
-        if not pid_analysis_error and has_attitude:
-            try:
-                attitude_estimated = np.rad2deg(vehicle_attitude.data[axis])
-                setpoint = _resample(vehicle_attitude_setpoint.data['timestamp'],
-                                     np.rad2deg(vehicle_attitude_setpoint.data[axis+'_d']),
-                                     attitude_time)
-                trace = Trace(axis, time_seconds, attitude_estimated, setpoint, throttle)
-                plots.append(plot_pid_response(trace, ulog.data_list, plot_config,
-                                               'Angle').bokeh_plot)
-            except Exception as e:
-                print(type(e), axis, ":", e)
-                div = Div(text="<p><b>Error</b>: Attitude PID analysis failed. Possible "
-                          "error causes are: logged data rate is too low/data missing, "
-                          "or there is not enough motion for the analysis.</p>",
-                          width=int(plot_width*0.9))
-                plots.insert(0, column(div, width=int(plot_width*0.9)))
-                pid_analysis_error = True
+    if results['attitude'] == 'failed':
+        _analysis_failed("Attitude PID analysis failed. Possible "
+                         "error causes are: logged data rate is too low/data missing, "
+                         "or there is not enough motion for the analysis.")
+    elif isinstance(results['attitude'], list):
+        for trace in results['attitude']:
+            plots.append(plot_pid_response(trace, ulog.data_list, plot_config,
+                                           'Angle').bokeh_plot)
 
     return plots
@@ -1,7 +1,6 @@
 """ methods to generate various tables used in configured_plots.py """
 
 from html import escape
-from math import sqrt
 import datetime
 
 import numpy as np
@@ -16,39 +15,11 @@ from helper import (
     get_total_flight_time, error_labels_table
     )
 from events import get_logged_events
+from log_metrics import compute_log_metrics
 
 #pylint: disable=consider-using-enumerate,too-many-statements
 
 
-def _get_vtol_means_per_mode(vtol_states, timestamps, data):
-    """
-    get the mean values separated by MC and FW mode for some
-    data vector
-    :return: tuple of (mean mc, mean fw)
-    """
-    vtol_state_index = 0
-    current_vtol_state = -1
-    sum_mc = 0
-    counter_mc = 0
-    sum_fw = 0
-    counter_fw = 0
-    for i in range(len(timestamps)):
-        if timestamps[i] > vtol_states[vtol_state_index][0]:
-            current_vtol_state = vtol_states[vtol_state_index][1]
-            vtol_state_index += 1
-        if current_vtol_state == 2: # FW
-            sum_fw += data[i]
-            counter_fw += 1
-        elif current_vtol_state == 3: # MC
-            sum_mc += data[i]
-            counter_mc += 1
-    mean_mc = None
-    if counter_mc > 0: mean_mc = sum_mc / counter_mc
-    mean_fw = None
-    if counter_fw > 0: mean_fw = sum_fw / counter_fw
-    return (mean_mc, mean_fw)
-
-
 def get_heading_html(ulog, px4_ulog, db_data, link_to_3d_page,
                      additional_links=None, title_suffix=''):
     """
@@ -81,10 +52,13 @@ def get_heading_html(ulog, px4_ulog, db_data, link_to_3d_page,
         title_html += "<h5>"+db_data.description+"</h5>"
     return title_html
 
-def get_info_table_html(ulog, px4_ulog, db_data, vehicle_data, vtol_states):
+def get_info_table_html(ulog, px4_ulog, db_data, vehicle_data, vtol_states,
+                        log_metrics=None):
     """
     Get the html (as string) for a table with additional text info,
     such as logging duration, max speed etc.
+    :param log_metrics: LogMetrics of the log from the DB, computed from the
+                        log if None (see log_metrics.compute_log_metrics())
     """
 
     ### Setup the text for the left table with various information ###
@@ -224,111 +198,55 @@ SDLOG_UTC_OFFSET: {}'''.format(utctimestamp.strftime('%d-%m-%Y %H:%M'), utc_offs
 
 
     ### Setup the text for the right table: estimated numbers (e.g. max speed) ###
+    if log_metrics is None:
+        log_metrics = compute_log_metrics(ulog, vtol_states)
     table_text_right = []
-    try:
-
-        local_pos = ulog.get_dataset('vehicle_local_position')
-        pos_x = local_pos.data['x']
-        pos_y = local_pos.data['y']
-        pos_z = local_pos.data['z']
-        pos_xyz_valid = np.multiply(local_pos.data['xy_valid'], local_pos.data['z_valid'])
-        local_vel_valid_indices = np.argwhere(np.multiply(local_pos.data['v_xy_valid'],
-                                                          local_pos.data['v_z_valid']) > 0)
-        vel_x = local_pos.data['vx'][local_vel_valid_indices]
-        vel_y = local_pos.data['vy'][local_vel_valid_indices]
-        vel_z = local_pos.data['vz'][local_vel_valid_indices]
-
-        # total distance (take only valid indexes)
-        total_dist_m = 0
-        last_index = -2
-        for valid_index in np.argwhere(pos_xyz_valid > 0):
-            index = valid_index[0]
-            if index == last_index + 1:
-                dx = pos_x[index] - pos_x[last_index]
-                dy = pos_y[index] - pos_y[last_index]
-                dz = pos_z[index] - pos_z[last_index]
-                total_dist_m += sqrt(dx*dx + dy*dy + dz*dz)
-            last_index = index
-        if total_dist_m < 1:
-            pass # ignore
-        elif total_dist_m > 1000:
-            table_text_right.append(('Distance', "{:.2f} km".format(total_dist_m/1000)))
-        else:
-            table_text_right.append(('Distance', "{:.1f} m".format(total_dist_m)))
 
-        if len(pos_z) > 0:
-            max_alt_diff = np.amax(pos_z) - np.amin(pos_z)
-            table_text_right.append(('Max Altitude Difference', "{:.0f} m".format(max_alt_diff)))
-
-        table_text_right.append(('', '')) # spacing
-
-        # Speed
-        if len(vel_x) > 0:
-            max_h_speed = np.amax(np.sqrt(np.square(vel_x) + np.square(vel_y)))
-            speed_vector = np.sqrt(np.square(vel_x) + np.square(vel_y) + np.square(vel_z))
-            max_speed = np.amax(speed_vector)
-            if vtol_states is None:
-                mean_speed = np.mean(speed_vector)
-                table_text_right.append(('Average Speed', "{:.1f} km/h".format(mean_speed*3.6)))
-            else:
-                local_pos_timestamp = local_pos.data['timestamp'][local_vel_valid_indices]
-                speed_vector = speed_vector.reshape((len(speed_vector),))
-                mean_speed_mc, mean_speed_fw = _get_vtol_means_per_mode(
-                    vtol_states, local_pos_timestamp, speed_vector)
-                if mean_speed_mc is not None:
-                    table_text_right.append(
-                        ('Average Speed MC', "{:.1f} km/h".format(mean_speed_mc*3.6)))
-                if mean_speed_fw is not None:
-                    table_text_right.append(
-                        ('Average Speed FW', "{:.1f} km/h".format(mean_speed_fw*3.6)))
-            table_text_right.append(('Max Speed', "{:.1f} km/h".format(max_speed*3.6)))
-            table_text_right.append(('Max Speed Horizontal', "{:.1f} km/h".format(max_h_speed*3.6)))
-            table_text_right.append(('Max Speed Up', "{:.1f} km/h".format(np.amax(-vel_z)*3.6)))
-            table_text_right.append(('Max Speed Down', "{:.1f} km/h".format(-np.amin(-vel_z)*3.6)))
-
-            table_text_right.append(('', '')) # spacing
-
-        vehicle_attitude = ulog.get_dataset('vehicle_attitude')
-        roll = vehicle_attitude.data['roll']
-        pitch = vehicle_attitude.data['pitch']
-        if len(roll) > 0:
-            # tilt = angle between [0,0,1] and [0,0,1] rotated by roll and pitch
-            tilt_angle = np.arccos(np.multiply(np.cos(pitch), np.cos(roll)))*180/np.pi
-            table_text_right.append(('Max Tilt Angle', "{:.1f} deg".format(np.amax(tilt_angle))))
-
-        rollspeed = vehicle_attitude.data['rollspeed']
-        pitchspeed = vehicle_attitude.data['pitchspeed']
-        yawspeed = vehicle_attitude.data['yawspeed']
-        if len(rollspeed) > 0:
-            max_rot_speed = np.amax(np.sqrt(np.square(rollspeed) +
-                                            np.square(pitchspeed) +
-                                            np.square(yawspeed)))
-            table_text_right.append(('Max Rotation Speed', "{:.1f} deg/s".format(
-                max_rot_speed*180/np.pi)))
+    total_dist_m = log_metrics['TotalDistance']
+    if total_dist_m is None or total_dist_m < 1:
+        pass # ignore
+    elif total_dist_m > 1000:
+        table_text_right.append(('Distance', "{:.2f} km".format(total_dist_m/1000)))
+    else:
+        table_text_right.append(('Distance', "{:.1f} m".format(total_dist_m)))
+
+    if log_metrics['MaxAltitudeDiff'] is not None:
+        table_text_right.append(('Max Altitude Difference', "{:.0f} m".format(
+            log_metrics['MaxAltitudeDiff'])))
+
+    table_text_right.append(('', '')) # spacing
+
+    # Speed
+    if log_metrics['MaxSpeed'] is not None:
+        for metric, label in [('MeanSpeed', 'Average Speed'),
+                              ('MeanSpeedMC', 'Average Speed MC'),
+                              ('MeanSpeedFW', 'Average Speed FW'),
+                              ('MaxSpeed', 'Max Speed'),
+                              ('MaxSpeedHorizontal', 'Max Speed Horizontal'),
+                              ('MaxSpeedUp', 'Max Speed Up'),
+                              ('MaxSpeedDown', 'Max Speed Down')]:
+            if log_metrics[metric] is not None:
+                table_text_right.append((label, "{:.1f} km/h".format(log_metrics[metric]*3.6)))
 
         table_text_right.append(('', '')) # spacing
 
-        battery_status = ulog.get_dataset('battery_status')
-        battery_current = battery_status.data['current_a']
-        if len(battery_current) > 0:
-            max_current = np.amax(battery_current)
-            if max_current > 0.1:
-                if vtol_states is None:
-                    mean_current = np.mean(battery_current)
-                    table_text_right.append(('Average Current', "{:.1f} A".format(mean_current)))
-                else:
-                    mean_current_mc, mean_current_fw = _get_vtol_means_per_mode(
-                        vtol_states, battery_status.data['timestamp'], battery_current)
-                    if mean_current_mc is not None:
-                        table_text_right.append(
-                            ('Average Current MC', "{:.1f} A".format(mean_current_mc)))
-                    if mean_current_fw is not None:
-                        table_text_right.append(
-                            ('Average Current FW', "{:.1f} A".format(mean_current_fw)))
-
-                table_text_right.append(('Max Current', "{:.1f} A".format(max_current)))
-    except:
-        pass # ignore (e.g. if topic not found)
+    if log_metrics['MaxTiltAngle'] is not None:
+        table_text_right.append(('Max Tilt Angle', "{:.1f} deg".format(
+            log_metrics['MaxTiltAngle'])))
+    if log_metrics['MaxRotationSpeed'] is not None:
+        table_text_right.append(('Max Rotation Speed', "{:.1f} deg/s".format(
+            log_metrics['MaxRotationSpeed'])))
+
+    table_text_right.append(('', '')) # spacing
+
+    max_current = log_metrics['MaxCurrent']
+    if max_current is not None and max_current > 0.1:
+        for metric, label in [('MeanCurrent', 'Average Current'),
+                              ('MeanCurrentMC', 'Average Current MC'),
+                              ('MeanCurrentFW', 'Average Current FW'),
+                              ('MaxCurrent', 'Max Current')]:
+            if log_metrics[metric] is not None:
+                table_text_right.append((label, "{:.1f} A".format(log_metrics[metric])))
 
 
     # generate the tables
@@ -2,9 +2,6 @@
 import copy
 
 import numpy as np
-import pyfftw
-import scipy
-import scipy.signal
 from bokeh import events
 # pylint: disable=line-too-long, arguments-differ, unused-import
 from bokeh.models import (
@@ -18,6 +15,7 @@ from bokeh.plotting import figure
 
 from config import debug_verbose_output
 from downsampling import DynamicDownsample
+from spectral import SpectralAnalysis
 from helper import (
     map_projection, WGS84_to_mercator, flight_modes_table, vtol_modes_table, get_lat_lon_alt_deg
 )
@@ -616,6 +614,12 @@ class DataPlot:
                 field_names_expanded.append(field_name)
         return field_names_expanded
 
+    @staticmethod
+    def _cacheable_field_names(field_names):
+        """ field names, with None for the fields computed by a function """
+        return [None if hasattr(field_name, '__call__') else field_name
+                for field_name in field_names]
+
 
     def add_span(self, field_name, accumulator_func=np.mean,
                  line_color='black', line_alpha=0.5):
@@ -792,18 +796,22 @@ class DataPlot2D(DataPlot):
 class DataPlotSpec(DataPlot):
     """
     A spectrogram plot.
-    This does not downsample dynamically.
+    This does not downsample dynamically: the spectrogram is computed for the
+    plot width (averaging the segments of each column).
 
     A spectrogram plot is only added to the plotting page if the sampling frequency of the dataset is higher than 100Hz.
     """
 
     def __init__(self, data, config, data_name, x_axis_label=None,
                  y_axis_label=None, title=None, plot_height='small',
-                 x_range=None, y_range=None, topic_instance=0):
+                 x_range=None, y_range=None, topic_instance=0, spectral_analysis=None):
+        """ :param spectral_analysis: SpectralAnalysis of the log (shared by
+        the plots), or None """
 
         super().__init__(data, config, data_name, x_axis_label=x_axis_label,
                                            y_axis_label=y_axis_label, title=title, plot_height=plot_height,
                                            x_range=x_range, y_range=y_range, topic_instance=topic_instance)
+        self._spectral_analysis = spectral_analysis or SpectralAnalysis()
 
     def add_graph(self, field_names, legends, window='hann', window_length=256, noverlap=128):
         """ add a spectrogram plot to the graph
@@ -830,9 +838,8 @@ class DataPlotSpec(DataPlot):
 
             # calculate the sampling frequency using the median inter-sample interval
             # to avoid bias from logging dropouts
-            dt_diff = np.diff(data_set[timestamp_key])
-            delta_t = np.median(dt_diff) * 1.0e-6
-            mean_delta_t = np.mean(dt_diff) * 1.0e-6
+            delta_t, mean_delta_t = self._spectral_analysis.get_sampling_interval(
+                self._cur_dataset, timestamp_key)
             if delta_t < 0.000001: # avoid division by zero
                 self._had_error = True
                 return
@@ -845,18 +852,15 @@ class DataPlotSpec(DataPlot):
 
             field_names_expanded = self._expand_field_names(field_names, data_set)
 
-            # calculate the spectrogram
-            psd = {}
-            for key in field_names_expanded:
-                frequency, time, psd[key] = scipy.signal.spectrogram(
-                    data_set[key], fs=sampling_frequency, window=window,
-                    nperseg=window_length, noverlap=noverlap, scaling='density')
-
-            # sum all psd's
-            key_it = iter(psd)
-            sum_psd = psd[next(key_it)]
-            for key in key_it:
-                sum_psd += psd[key]
+            # calculate the spectrogram (sum of all psd's), assuming maximal
+            # data points per pixel at full resolution
+            max_num_data_points = int(2.0*self._config['plot_width'])
+            frequency, time, psd = self._spectral_analysis.get_spectrograms(
+                self._cur_dataset, timestamp_key, self._cacheable_field_names(field_names),
+                [data_set[key] for key in field_names_expanded], sampling_frequency,
+                max_num_data_points, window=window, window_length=window_length,
+                noverlap=noverlap)
+            sum_psd = np.sum(psd, axis=0, dtype=np.float64)
 
             # offset = int(((1024/2.0)/250.0)*1e6)
             # scale time to microseconds and add start time as offset
@@ -878,13 +882,6 @@ class DataPlotSpec(DataPlot):
                 title += " " + legend
             title += " [dB]"
 
-            # assume maximal data points per pixel at full resolution
-            max_num_data_points = 2.0*self._config['plot_width']
-            if len(time) > max_num_data_points:
-                step_size = int(len(time) / max_num_data_points)
-                time = time[::step_size]
-                image[0] = image[0][:, ::step_size]
-
             color_mapper = LinearColorMapper(palette="Viridis256", low=np.amin(image), high=np.amax(image))
 
             self._p.y_range = Range1d(frequency[0], frequency[-1])
@@ -920,12 +917,15 @@ class DataPlotFFT(DataPlot):
 
     def __init__(self, data, config, data_name,
                  title=None, plot_height='small',
-                 x_range=None, y_range=None, topic_instance=0):
+                 x_range=None, y_range=None, topic_instance=0, spectral_analysis=None):
+        """ :param spectral_analysis: SpectralAnalysis of the log (shared by
+        the plots), or None """
 
         super().__init__(data, config, data_name, x_axis_label='Hz',
                                           y_axis_label='Amplitude', title=title, plot_height=plot_height,
                                           x_range=x_range, y_range=y_range, topic_instance=topic_instance)
         self._use_time_formatter = False
+        self._spectral_analysis = spectral_analysis or SpectralAnalysis()
 
     def add_graph(self, field_names, colors, legends):
         """ add an FFT plot to the graph
@@ -946,11 +946,11 @@ class DataPlotFFT(DataPlot):
                 timestamp_key = 'timestamp_sample'
 
             data_set[timestamp_key] = self._cur_dataset.data[timestamp_key]
-            data_len = len(data_set[timestamp_key])
 
             # calculate the sampling frequency using the median inter-sample interval
             # to avoid bias from logging dropouts
-            delta_t = np.median(np.diff(data_set[timestamp_key])) * 1.0e-6
+            delta_t, _ = self._spectral_analysis.get_sampling_interval(
+                self._cur_dataset, timestamp_key)
             sampling_frequency = 1.0 / delta_t
 
             if sampling_frequency < 100 or sampling_frequency == float("inf"): # require min sampling freq
@@ -959,37 +959,26 @@ class DataPlotFFT(DataPlot):
 
             field_names_expanded = self._expand_field_names(field_names, data_set)
 
-
-            # we use fftw instead of scipy.fft, because it is much faster for
-            # input lengths that factorize into large primes.
-            pyfftw.interfaces.cache.enable()
-
-            freqs = scipy.fftpack.fftfreq(data_len, delta_t)
             mean_start_freq = 40
+            # downsample if necessary
+            max_num_data_points = 3.0*self._config['plot_width']
             plot_data = []
-            for field_name, color, legend in zip(field_names_expanded, colors, legends):
-                # call FFTW with reduced setup effort (which is faster for our
-                # use-case with varying input lengths)
-                fft_values = 2/data_len*abs(pyfftw.interfaces.numpy_fft.fft(
-                    data_set[field_name], planner_effort='FFTW_ESTIMATE'))
-                mean_fft_value = np.mean(fft_values[np.argwhere(freqs >= mean_start_freq).flatten()])
+            for field_name, cache_name, color, legend in zip(
+                    field_names_expanded, self._cacheable_field_names(field_names),
+                    colors, legends):
+                freqs_plot, fft_plot_values, mean_fft_value, max_freq = \
+                    self._spectral_analysis.get_fft_amplitude(
+                        self._cur_dataset, timestamp_key, cache_name,
+                        data_set[field_name], delta_t, max_num_data_points, mean_start_freq)
                 legend = legend + " (mean above {:} Hz: {:.2f})".format(mean_start_freq, mean_fft_value)
-                plot_data.append((fft_values, mean_fft_value, legend, color))
-
-            for fft_values, mean_fft_value, legend, color in plot_data:
-                fft_plot_values = fft_values[:len(freqs)//2]
-                freqs_plot = freqs[:len(freqs)//2]
-                # downsample if necessary
-                max_num_data_points = 3.0*self._config['plot_width']
-                if len(fft_plot_values) > max_num_data_points:
-                    step_size = int(len(fft_plot_values) / max_num_data_points)
-                    fft_plot_values = fft_plot_values[::step_size]
-                    freqs_plot = freqs_plot[::step_size]
+                plot_data.append((freqs_plot, fft_plot_values, mean_fft_value, legend, color))
+
+            for freqs_plot, fft_plot_values, mean_fft_value, legend, color in plot_data:
                 self._p.line(freqs_plot, fft_plot_values, # pylint: disable=too-many-function-args
                              line_color=color, line_width=2, legend_label=legend, alpha=0.8)
             # plot the mean lines above the fft graphs
-            for fft_values, mean_fft_value, legend, color in plot_data:
-                self._p.line([mean_start_freq, np.max(freqs)], # pylint: disable=too-many-function-args
+            for _, _, mean_fft_value, legend, color in plot_data:
+                self._p.line([mean_start_freq, max_freq], # pylint: disable=too-many-function-args
                              [mean_fft_value, mean_fft_value],
                              line_color=color, line_width=2, legend_label=legend)
 
@@ -0,0 +1,259 @@
+""" Spectral analysis of high-rate sensor data (FFT's & spectrograms) """
+
+import os
+import uuid
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+import scipy.signal
+
+from fft_plans import get_rfft_plan, next_fast_length
+
+# number of segments (per channel) transformed at once
+_CHUNK_SEGMENTS = 512
+
+# version of the stored SpectralAnalysis results (increase when the computation
+# changes, to ignore previously stored results)
+SPECTRAL_ANALYSIS_VERSION = 2
+
+
+def compute_spectrogram(channels, sampling_frequency, num_columns, window='hann',
+                        window_length=256, noverlap=128, max_segments_per_column=16):
+    """
+    Compute the spectrogram (power spectral density) of a set of channels for
+    a given number of output columns.
+
+    The output resolution is planned first: the segments (same as
+    scipy.signal.spectrogram with scaling='density') are grouped into at most
+    num_columns columns, and each column is the average of the segments of its
+    time span (Welch's method per column). If a column spans more than
+    max_segments_per_column segments, only that many (evenly spread) are used,
+    so the runtime and memory are bounded by the output size, not by the log
+    length. All channels are transformed in one batched real FFT, in chunks of
+    segments (of a fixed size, so that the FFTW plan is reused).
+
+    :param channels: list of 1D arrays with the same length (equally sampled)
+    :param sampling_frequency: [Hz]
+    :param num_columns: maximum number of time columns
+    :param window: window type, see scipy.signal.get_window()
+    :param window_length: length of a segment in samples
+    :param noverlap: number of overlapping samples between segments
+    :return: tuple of (frequencies [Hz], column times [s] relative to the first
+             sample, psd 3D array (channels x frequencies x columns))
+    """
+    num_samples = len(channels[0])
+    window_length = min(window_length, num_samples)
+    if noverlap >= window_length:
+        raise ValueError('noverlap must be less than window_length')
+    step = window_length - noverlap
+    num_segments = (num_samples - noverlap) // step
+
+    # plan the output columns & the segments used for each column
+    segments_per_column = -(-num_segments // max(num_columns, 1))
+    num_columns = -(-num_segments // segments_per_column)
+    num_used = min(segments_per_column, max_segments_per_column)
+    column_starts = np.arange(num_columns) * segments_per_column
+    segment_indices = (column_starts[:, np.newaxis] +
+                       np.arange(num_used) * segments_per_column // num_used).ravel()
+    segment_columns = np.repeat(np.arange(num_columns), num_used)
+    used = segment_indices < num_segments # the last column can be shorter
+    segment_indices = segment_indices[used]
+    segment_columns = segment_columns[used]
+
+    # column time: center of its time span
+    column_ends = np.minimum(column_starts + segments_per_column, num_segments)
+    times = ((column_starts + column_ends - 1) / 2 * step + window_length / 2) / sampling_frequency
+
+    win = scipy.signal.get_window(window, window_length)
+    chunk = _CHUNK_SEGMENTS
+    fft = get_rfft_plan((len(channels), chunk, window_length))
+    frames = fft.input_array
+    psd = np.zeros((len(channels), num_columns, window_length // 2 + 1), dtype=np.float64)
+    for start in range(0, len(segment_indices), chunk):
+        indices = segment_indices[start:start + chunk]
+        count = len(indices)
+        # rows beyond count (last chunk) contain stale data and are ignored
+        for i, channel in enumerate(channels):
+            frames[i, :count] = sliding_window_view(channel, window_length)[indices * step]
+        frames[:, :count] -= frames[:, :count].mean(axis=-1, keepdims=True) # detrend
+        frames[:, :count] *= win
+        spectra = fft()[:, :count]
+        power = np.square(spectra.real)
+        power += np.square(spectra.imag)
+
+        # sum the segments of each column
+        columns = segment_columns[start:start + count]
+        boundaries = np.flatnonzero(np.diff(columns, prepend=-1))
+        psd[:, columns[boundaries]] += np.add.reduceat(power, boundaries, axis=1)
+
+    psd /= np.bincount(segment_columns, minlength=num_columns)[:, np.newaxis]
+    psd *= 1. / (sampling_frequency * np.sum(win * win))
+    # one-sided spectrum: double all but the DC (and Nyquist) frequency
+    psd[..., 1:(window_length + 1) // 2] *= 2.
+
+    frequencies = np.fft.rfftfreq(window_length, 1. / sampling_frequency)
+    return frequencies, times, psd.transpose(0, 2, 1)
+
+
+def compute_fft_amplitude(data, delta_t, max_num_points, mean_start_freq):
+    """
+    Compute the amplitude spectrum of the full-length FFT of a signal
+    :param delta_t: sampling interval [s]
+    :param max_num_points: the spectrum is downsampled to about that many points
+    :return: tuple of (frequencies [Hz], amplitudes, mean amplitude above
+             mean_start_freq, maximum frequency)
+    """
+    data_len = len(data)
+    # zero-pad to a length without large prime factors, for which the FFT is
+    # much faster (see next_fast_length()). The amplitudes are normalized with
+    # the data length, so they do not change, the spectrum is just sampled at
+    # slightly more frequencies.
+    fft_len = next_fast_length(data_len)
+    # call FFTW with reduced setup effort (which is faster for our
+    # use-case with varying input lengths)
+    fft = get_rfft_plan((fft_len,), planner_effort='FFTW_ESTIMATE')
+    fft.input_array[:data_len] = data
+    fft.input_array[data_len:] = 0.
+    # positive frequencies (without the Nyquist frequency)
+    fft_values = 2/data_len*np.abs(fft()[:(fft_len+1)//2])
+    freqs = np.arange(len(fft_values)) / (fft_len * delta_t)
+    mean_fft_value = np.mean(fft_values[freqs >= mean_start_freq])
+
+    fft_plot_values = fft_values[:fft_len//2]
+    freqs_plot = freqs[:fft_len//2]
+    # downsample if necessary
+    if len(fft_plot_values) > max_num_points:
+        step_size = int(len(fft_plot_values) / max_num_points)
+        fft_plot_values = fft_plot_values[::step_size]
+        freqs_plot = freqs_plot[::step_size]
+    return freqs_plot, fft_plot_values, mean_fft_value, freqs[-1]
+
+
+class SpectralAnalysis:
+    """
+    Spectral analysis of the topics of a log, shared by the FFT & spectrogram
+    plots: the sampling interval of a topic, the FFT and the spectrogram of a
+    field are computed once per log (and set of parameters). The results can
+    be stored in a file, so that repeated views of a log skip the computation.
+    Only fields given by name are cached (not the ones computed by a function).
+    """
+
+    def __init__(self, file_name=None):
+        """
+        :param file_name: npz file to load the results from & store them to
+                          (see save()), or None to not store them
+        """
+        self._file_name = file_name
+        self._results = {} # key: tuple of numpy arrays
+        self._modified = False
+        if file_name is not None:
+            self._load()
+
+    def _load(self):
+        try:
+            with np.load(self._file_name, allow_pickle=False) as arrays:
+                if int(arrays['version']) != SPECTRAL_ANALYSIS_VERSION:
+                    return
+                for name in arrays.files:
+                    if name != 'version':
+                        key, index = name.rsplit('#', 1)
+                        self._results.setdefault(key, {})[int(index)] = arrays[name]
+            self._results = {key: tuple(values[i] for i in range(len(values)))
+                             for key, values in self._results.items()}
+        except FileNotFoundError:
+            pass
+        except (KeyError, ValueError, OSError) as error:
+            print('Error: invalid spectral analysis cache file', self._file_name, error)
+            self._results = {}
+
+    def save(self):
+        """ store the results in the file, if new ones were computed """
+        if self._file_name is None or not self._modified:
+            return
+        arrays = {'version': np.array(SPECTRAL_ANALYSIS_VERSION)}
+        for key, values in self._results.items():
+            for i, value in enumerate(values):
+                arrays[key+'#'+str(i)] = value
+        # write atomically, as results might be stored concurrently
+        temp_file_name = os.path.join(os.path.dirname(self._file_name),
+                                      '.tmp-'+str(uuid.uuid4())+'.npz')
+        try:
+            np.savez_compressed(temp_file_name, **arrays)
+            os.replace(temp_file_name, self._file_name)
+            self._modified = False
+        except OSError as error:
+            print('Error: failed to store the spectral analysis', self._file_name, error)
+            if os.path.exists(temp_file_name):
+                os.unlink(temp_file_name)
+
+    def _get(self, key, compute):
+        """ get cached results or compute them (a tuple of numpy arrays) """
+        if key not in self._results:
+            self._results[key] = tuple(np.asarray(value) for value in compute())
+            self._modified = True
+        return self._results[key]
+
+    @staticmethod
+    def _topic_key(dataset, timestamp_key):
+        return '{}|{}|{}'.format(dataset.name, dataset.multi_id, timestamp_key)
+
+    def get_sampling_interval(self, dataset, timestamp_key):
+        """
+        :param dataset: ULog.Data of the topic
+        :return: tuple of (median, mean) interval between the samples [s]
+        """
+        def compute():
+            dt_diff = np.diff(dataset.data[timestamp_key])
+            return np.median(dt_diff) * 1.0e-6, np.mean(dt_diff) * 1.0e-6
+        delta_t, mean_delta_t = self._get('interval|'+self._topic_key(dataset, timestamp_key),
+                                          compute)
+        return float(delta_t), float(mean_delta_t)
+
+    def get_spectrograms(self, dataset, timestamp_key, field_names, channels,
+                         sampling_frequency, num_columns, **kwargs):
+        """
+        get the spectrograms of a set of fields (see compute_spectrogram())
+        :param field_names: list of field names, with None for the ones
+                            computed by a function (not cached)
+        :param channels: list of the data of the fields
+        :param kwargs: window parameters for compute_spectrogram()
+        :return: tuple of (frequencies [Hz], column times [s], list of psd 2D
+                 arrays (frequencies x columns), one per field)
+        """
+        params = '|'.join([self._topic_key(dataset, timestamp_key), str(sampling_frequency),
+                           str(num_columns)] +
+                          ['{}={}'.format(k, v) for k, v in sorted(kwargs.items())])
+        keys = ['spectrogram|{}|{}'.format(params, name) if name is not None else None
+                for name in field_names]
+        missing = [i for i, key in enumerate(keys) if key not in self._results]
+        frequencies, times, psd = None, None, {}
+        if len(missing) > 0:
+            # compute all missing fields at once
+            frequencies, times, missing_psd = compute_spectrogram(
+                [channels[i] for i in missing], sampling_frequency, num_columns, **kwargs)
+            for i, field_psd in zip(missing, missing_psd):
+                psd[i] = field_psd
+                if keys[i] is not None:
+                    # only used as image, float32 is precise enough
+                    self._results[keys[i]] = (frequencies, times, field_psd.astype(np.float32))
+                    self._modified = True
+        for i, key in enumerate(keys):
+            if i not in psd:
+                frequencies, times, psd[i] = self._results[key]
+        return frequencies, times, [psd[i] for i in range(len(keys))]
+
+    def get_fft_amplitude(self, dataset, timestamp_key, field_name, data, delta_t,
+                          max_num_points, mean_start_freq):
+        """
+        get the FFT of a field (see compute_fft_amplitude())
+        :param field_name: field name or None if computed by a function (not cached)
+        """
+        def compute():
+            return compute_fft_amplitude(data, delta_t, max_num_points, mean_start_freq)
+        if field_name is None:
+            return compute()
+        freqs, values, mean_value, max_freq = self._get(
+            'fft|{}|{}|{}|{}|{}'.format(self._topic_key(dataset, timestamp_key), delta_t,
+                                       max_num_points, mean_start_freq, field_name),
+            compute)
+        return freqs, values, float(mean_value), float(max_freq)
@@ -1,4 +1,5 @@
 """ Class for statistics plots page """
+import datetime
 from dateutil.relativedelta import relativedelta
 
 import numpy as np
@@ -11,7 +12,7 @@ from bokeh.models import (
     )
 
 from plotting import TOOLS, ACTIVE_SCROLL_TOOLS
-from config import get_db_connection
+from db_repository import get_metadata_repository
 from helper import get_airframe_data, flight_modes_table
 
 
@@ -39,15 +40,15 @@ class _Log:
 
         self.is_release = False
 
-    def set_generated(self, db_tuple):
-        """ set from a LogsGenerated DB tuple """
-        self.duration = db_tuple[1]
-        self.autostart_id = db_tuple[4]
-        self.hardware = db_tuple[5]
-        self.uuid = db_tuple[11]
+    def set_generated(self, db_data_gen):
+        """ set from a DBDataGenerated object """
+        self.duration = db_data_gen.duration_s
+        self.autostart_id = db_data_gen.sys_autostart_id
+        self.hardware = db_data_gen.sys_hw
+        self.uuid = db_data_gen.vehicle_uuid
         # the version has typically the form 'v<i>.<j>.<k> <l>', where <l>
         # is the firmware release type enum (0=dev, 64=alpha, 128=beta, 192=rc, 255=release)
-        version = db_tuple[10].split(' ')
+        version = db_data_gen.ver_sw_release.split(' ')
         self.sw_version = version[0]
         release_type_suffix = {64: '-alpha', 128: '-beta', 192: '-rc', 255: ''}
         if len(version) > 1:
@@ -65,8 +66,7 @@ class _Log:
         else:
             self.is_release = False
 
-        self.flight_mode_durations = \
-            [tuple(map(int, x.split(':'))) for x in db_tuple[12].split(',') if len(x) > 0]
+        self.flight_mode_durations = db_data_gen.flight_mode_durations
 
 
 class StatisticsPlots:
@@ -87,100 +87,64 @@ class StatisticsPlots:
         self._public_logs = []
 
         # read from the DB
-        con = get_db_connection()
-        try:
-            cur = con.cursor()
-
-            cur.execute("select count(Id) from Logs")
-            db_tuple = cur.fetchone()
-            if db_tuple is not None:
-                self._num_logs_total = db_tuple[0]
-
-            cur.execute("select count(Id) from Logs where Source = 'CI'")
-            db_tuple = cur.fetchone()
-            if db_tuple is not None:
-                self._num_logs_ci = db_tuple[0]
-
-            # Get all log dates of specific types within 6 hour intervals
-            cur.execute('''
-select
-    Date,
-    count(*) cnt,
-    datetime((strftime('%s', Date) / (6 * 60 * 60)) * 6 * 60 * 60, 'unixepoch') new_date
-from Logs
-where Public = 1
-group by new_date
-order by new_date
-''')
-            self._public_log_dates_intervals = cur.fetchall()
-            cur.execute('''
-select
-    Date,
-    count(*) cnt,
-    datetime((strftime('%s', Date) / (6 * 60 * 60)) * 6 * 60 * 60, 'unixepoch') new_date
-from Logs
-where Public = 0
-group by new_date
-order by new_date
-''')
-            self._private_log_dates_intervals = cur.fetchall()
-
-            # Get all public logs within the last few months
-            cur.execute("select Id, Date, Source, Public, Rating from Logs where Public = 1 "
-                        "and Source != 'CI' and "
-                        "Date > date('now', '-90 day') order by Date")
-            db_tuples = cur.fetchall()
-            for db_tuple in db_tuples:
-                log = _Log(db_tuple)
-
-                cur.execute('select * from LogsGenerated where Id = ?', [log.log_id])
-                db_tuple = cur.fetchone()
-
-                if db_tuple is None:
-                    if self._verbose_output:
-                        print("Error: no generated data")
-                    continue
-
-                log.set_generated(db_tuple)
-
-                # filter bogus entries
-                if log.sw_version == 'v0.0.0':
-                    if self._verbose_output:
-                        print('Warning: %s with version=v0.0.0' % log.log_id)
-                    continue
-                if log.duration > 7*24*3600: # probably bogus timestamp(s)
-                    if self._verbose_output:
-                        print('Warning: %s with very high duration %i' %
-                              (log.log_id, log.duration))
-                    continue
+        repository = get_metadata_repository()
+        self._num_logs_total = repository.count_logs()
+        self._num_logs_ci = repository.count_logs('CI')
+
+        # Get all log dates of specific types within 6 hour intervals
+        self._public_log_dates_intervals = \
+            repository.get_log_date_intervals(True, 6 * 60 * 60)
+        self._private_log_dates_intervals = \
+            repository.get_log_date_intervals(False, 6 * 60 * 60)
+
+        # Get all public logs within the last few months
+        since = datetime.datetime.now() - datetime.timedelta(days=90)
+        for db_tuple, db_data_gen in repository.get_public_logs_with_generated(since):
+            log = _Log(db_tuple)
+
+            if db_data_gen is None:
+                if self._verbose_output:
+                    print("Error: no generated data")
+                continue
+
+            log.set_generated(db_data_gen)
+
+            # filter bogus entries
+            if log.sw_version == 'v0.0.0':
+                if self._verbose_output:
+                    print('Warning: %s with version=v0.0.0' % log.log_id)
+                continue
+            if log.duration > 7*24*3600: # probably bogus timestamp(s)
+                if self._verbose_output:
+                    print('Warning: %s with very high duration %i' %
+                          (log.log_id, log.duration))
+                continue
+
+            if log.sw_version == '':
+                # FIXME: does that still occur and if so why?
+                if self._verbose_output:
+                    print('Warning: %s version not set' % log.log_id)
+                continue
+
+            if log.autostart_id == 0:
+                if self._verbose_output:
+                    print('Warning: %s with autostart_id=0' % log.log_id)
+                continue
 
-                if log.sw_version == '':
-                    # FIXME: does that still occur and if so why?
-                    if self._verbose_output:
-                        print('Warning: %s version not set' % log.log_id)
-                    continue
-
-                if log.autostart_id == 0:
+            try:
+                ver_major = int(log.sw_version[1:].split('.')[0])
+                if ver_major >= 3 or ver_major == 0:
                     if self._verbose_output:
-                        print('Warning: %s with autostart_id=0' % log.log_id)
-                    continue
-
-                try:
-                    ver_major = int(log.sw_version[1:].split('.')[0])
-                    if ver_major >= 3 or ver_major == 0:
-                        if self._verbose_output:
-                            print('Warning: %s with large/small version %s' %
-                                  (log.log_id, log.sw_version))
-                        continue
-                except:
+                        print('Warning: %s with large/small version %s' %
+                              (log.log_id, log.sw_version))
                     continue
+            except:
+                continue
 
-                self._public_logs.append(log)
-                self._num_flight_hours_total += log.duration
+            self._public_logs.append(log)
+            self._num_flight_hours_total += log.duration
 
-            self._num_flight_hours_total /= 3600
-        finally:
-            con.close()
+        self._num_flight_hours_total /= 3600
 
 
     def get_data_for_plotting(self, groups_value_getter, empty_value=0,
@@ -236,7 +200,7 @@ order by new_date
             dates_list_subsampled = []
             counts_subsampled = []
             count_total = 0
-            for date, count, _ in data_points:
+            for date, count in data_points:
                 dates_list_subsampled.append(date)
                 count_total += count
                 counts_subsampled.append(count_total)
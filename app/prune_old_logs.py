@@ -2,101 +2,163 @@
 
 # Script to delete old log files & DB entries matching a certain criteria
 
-import sqlite3
 import sys
 import os
 import argparse
 import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 # this is needed for the following imports
 sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'plot_app'))
-from plot_app.config import get_db_connection, get_overview_img_filepath
-from plot_app.helper import get_log_filename
-
-
-parser = argparse.ArgumentParser(description='Remove old log files & DB entries')
-
-parser.add_argument('--max-age', action='store', type=int, default=30,
-                    help='maximum age in days (delete logs older than this, default=30)')
-parser.add_argument('--source', action='store', default='CI',
-                    help='Source DB entry tag to match (empty=all, default=CI)')
-parser.add_argument('--interactive', '-i', action='store_true', default=False,
-                    help='Interative mode: ask whether to delete the entries')
-parser.add_argument('--private', action='store_true', default=False,
-                    help='Select private logs only')
-
-args = parser.parse_args()
-
-
-max_age = args.max_age
-source = args.source
-interactive = args.interactive
-private = args.private
-
-con = get_db_connection()
-with con:
-    cur = con.cursor()
-    log_ids_to_remove = []
-
-    private_filter = ''
-
-    if len(source) == 0:
-        if private:
-            private_filter = 'where public = 0'
-        cur.execute(f'select Id, Date, Description from Logs {private_filter}')
-    else:
-        if private:
-            private_filter = 'and public = 0'
-        cur.execute(f'select Id, Date, Description from Logs where Source = ? {private_filter}', [source])
-
-    db_tuples = cur.fetchall()
+from plot_app.config import get_overview_img_filepath, get_kml_filepath, get_log_storage
+from plot_app.helper import delete_log_file, get_blob_cache_filenames
+from plot_app.db_entry import sql_chunks
+from plot_app.db_repository import get_metadata_repository
+
+#pylint: disable=invalid-name
+
+
+def _get_file_size(file_name):
+    """ :return: size of a file in bytes (0 if it does not exist) """
+    try:
+        return os.path.getsize(file_name)
+    except FileNotFoundError:
+        return 0
+
+
+def _remove_log_file(blob_id, dry_run):
+    """ remove a stored log file and the files cached for it (KML, PID analysis)
+    :return: tuple (log file size, cache files size) in bytes
+    """
+    log_file_size = get_log_storage().get_size(blob_id) or 0
+    cache_size = sum(_get_file_size(file_name)
+                     for file_name in get_blob_cache_filenames(blob_id))
+    if not dry_run:
+        delete_log_file(blob_id)
+    return log_file_size, cache_size
+
+
+def _remove_file(file_name, dry_run):
+    """ :return: size of the removed file in bytes (0 if it did not exist) """
+    size = _get_file_size(file_name)
+    if size > 0 and not dry_run:
+        try:
+            os.unlink(file_name)
+        except FileNotFoundError:
+            return 0
+    return size
+
+
+def _remove_log_artifacts(log_id, dry_run):
+    """ remove the files generated for a log: the overview (preview) image and
+    a KML file named after the log (from before KML files were shared by logs
+    with the same content; it is only a cache, so removing it is safe)
+    :return: tuple (overview image size, cache files size) in bytes
+    """
+    return (_remove_file(os.path.join(get_overview_img_filepath(), log_id+'.png'), dry_run),
+            _remove_file(os.path.join(get_kml_filepath(), log_id+'.kml'), dry_run))
+
+
+class _RemovedFiles:
+    """ number & total size of the removed files, by type """
+
+    def __init__(self):
+        self.num_log_files = 0
+        self.log_files_size = 0
+        self.cache_size = 0
+        self.overview_images_size = 0
+
+    def remove(self, executor, log_ids, blob_ids, dry_run):
+        """ remove the files of a set of logs in parallel """
+        log_files = executor.map(lambda blob_id: _remove_log_file(blob_id, dry_run),
+                                 blob_ids)
+        log_artifacts = executor.map(
+            lambda log_id: _remove_log_artifacts(log_id, dry_run), log_ids)
+        for log_file_size, cache_size in log_files:
+            self.num_log_files += 1
+            self.log_files_size += log_file_size
+            self.cache_size += cache_size
+        for overview_image_size, cache_size in log_artifacts:
+            self.overview_images_size += overview_image_size
+            self.cache_size += cache_size
+
+    def print_report(self, prefix):
+        """ print the totals """
+        def mb(num_bytes):
+            return '{:.1f} MB'.format(num_bytes / 1024 / 1024)
+        print('{} {} log files ({}), cache files ({}) & overview images ({}), '
+              'in total {}'.format(prefix, self.num_log_files, mb(self.log_files_size),
+                                   mb(self.cache_size), mb(self.overview_images_size),
+                                   mb(self.log_files_size + self.cache_size +
+                                      self.overview_images_size)))
+
+
+def main():
+    """ prune the logs """
+    parser = argparse.ArgumentParser(description='Remove old log files & DB entries')
+
+    parser.add_argument('--max-age', action='store', type=int, default=30,
+                        help='maximum age in days (delete logs older than this, default=30)')
+    parser.add_argument('--source', action='store', default='CI',
+                        help='Source DB entry tag to match (empty=all, default=CI)')
+    parser.add_argument('--interactive', '-i', action='store_true', default=False,
+                        help='Interative mode: ask whether to delete the entries')
+    parser.add_argument('--private', action='store_true', default=False,
+                        help='Select private logs only')
+    parser.add_argument('--dry-run', action='store_true', default=False,
+                        help='Only report what would be deleted')
+    parser.add_argument('--batch-size', action='store', type=int, default=500,
+                        help='Number of logs deleted per DB transaction (default=500)')
+    parser.add_argument('-j', '--jobs', action='store', type=int, default=16,
+                        help='Number of threads to remove files (default=16)')
+
+    args = parser.parse_args()
+
+    repository = get_metadata_repository()
+
+    # logs where more than max_age full days elapsed
+    older_than = datetime.datetime.now() - datetime.timedelta(days=args.max_age + 1)
+    db_tuples = repository.get_logs(source=args.source if len(args.source) > 0 else None,
+                                    private_only=args.private, older_than=older_than)
     print('will delete the following:')
-    for db_tuple in db_tuples:
-        log_id = db_tuple[0]
-        date = db_tuple[1]
-        description = db_tuple[2]
-
-        # check date
-        elapsed_days = (datetime.datetime.now()-date).days
-        if elapsed_days > max_age:
-            print('{} {} {}'.format(log_id, date.strftime('%Y_%m_%d-%H_%M'),
-                description))
-            log_ids_to_remove.append(log_id)
-
+    for log_id, date, description in db_tuples:
+        print('{} {} {}'.format(log_id, date.strftime('%Y_%m_%d-%H_%M'), description))
+    log_ids_to_remove = [db_tuple[0] for db_tuple in db_tuples]
 
     if len(log_ids_to_remove) == 0:
         print('no maches. exiting')
-        exit(0)
-
-    cur.execute('select count(*) from Logs')
-    num_total = cur.fetchone()
-    if num_total is not None:
-        print("Will delete {:} logs out of {:}".format(len(log_ids_to_remove), num_total[0]))
-
-    if interactive:
-        confirm = input('Press "y" and ENTER to confirm and delete: ')
-        if confirm != 'y':
-            print('Not deleting anything')
-            exit(0)
-
-    for log_id in log_ids_to_remove:
-        print('Removing '+log_id)
-        # db entry
-        cur.execute("DELETE FROM LogsGenerated WHERE Id = ?", (log_id,))
-        cur.execute("DELETE FROM Logs WHERE Id = ?", (log_id,))
-        num_deleted = cur.rowcount
-        if num_deleted != 1:
-            print('Error: not found ({})'.format(num_deleted))
-        con.commit()
-
-        # and the log file
-        ulog_file_name = get_log_filename(log_id)
-        if os.path.exists(ulog_file_name):
-            os.unlink(ulog_file_name)
-        #and preview image if exist
-        preview_image_filename=os.path.join(get_overview_img_filepath(), log_id+'.png')
-        if os.path.exists(preview_image_filename):
-            os.unlink(preview_image_filename)
-
-con.close()
-
+        return
+
+    num_total = repository.count_logs()
+    print("Will delete {:} logs out of {:}".format(len(log_ids_to_remove), num_total))
+
+    removed_files = _RemovedFiles()
+    with ThreadPoolExecutor(max_workers=max(args.jobs, 1)) as executor:
+        if args.dry_run:
+            _, blob_ids = repository.get_unreferenced_blob_ids(log_ids_to_remove)
+            removed_files.remove(executor, log_ids_to_remove, blob_ids, True)
+            removed_files.print_report('Would remove')
+            return
+
+        if args.interactive:
+            confirm = input('Press "y" and ENTER to confirm and delete: ')
+            if confirm != 'y':
+                print('Not deleting anything')
+                return
+
+        num_deleted = 0
+        for batch in sql_chunks(log_ids_to_remove, max(args.batch_size, 1)):
+            # db entries, then the log files unless other logs with the same
+            # content still use them
+            deleted, unreferenced_blob_ids = repository.delete_logs(batch)
+            if len(deleted) != len(batch):
+                print('Error: {} logs not found'.format(len(batch) - len(deleted)))
+            removed_files.remove(executor, deleted, unreferenced_blob_ids, False)
+            num_deleted += len(deleted)
+            print('{}/{} logs deleted'.format(num_deleted, len(log_ids_to_remove)))
+
+    removed_files.print_report('Removed')
+
+
+if __name__ == '__main__':
+    main()
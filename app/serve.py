@@ -5,6 +5,7 @@ from __future__ import absolute_import
 from __future__ import print_function
 
 import argparse
+import atexit
 import os
 import sys
 import errno
@@ -29,7 +30,10 @@ from tornado_handlers.radio_controller import RadioControllerHandler
 from tornado_handlers.error_labels import UpdateErrorLabelHandler
 
 from helper import set_log_id_is_filename, print_cache_info #pylint: disable=C0411
-from config import debug_print_timing, get_overview_img_filepath #pylint: disable=C0411
+from config import debug_print_timing, get_overview_img_filepath, \
+    get_fftw_wisdom_filename #pylint: disable=C0411
+from fft_plans import load_wisdom, save_wisdom #pylint: disable=C0411
+from db_pool import print_pool_info #pylint: disable=C0411
 
 #pylint: disable=invalid-name
 
@@ -93,8 +97,10 @@ if args.allow_websocket_origin is not None:
     server_kwargs['allow_websocket_origin'] = args.allow_websocket_origin
 server_kwargs['websocket_max_message_size'] = 100 * 1024 * 1024
 
-# increase the maximum upload size (default is 100MB)
-server_kwargs['http_server_kwargs'] = {'max_buffer_size': 300 * 1024 * 1024}
+# increase the maximum upload size (default is 100MB). Uploads are streamed to
+# the log storage, so the buffer size does not need to match the body size.
+server_kwargs['http_server_kwargs'] = {'max_body_size': 300 * 1024 * 1024,
+                                       'max_buffer_size': 10 * 1024 * 1024}
 
 
 show_ulog_file = False
@@ -110,6 +116,11 @@ if args.file is not None:
 
 set_log_id_is_filename(show_ulog_file)
 
+# reuse the FFTW plans measured by previous runs (the worker processes inherit
+# the wisdom)
+load_wisdom(get_fftw_wisdom_filename())
+atexit.register(save_wisdom)
+
 
 # additional request handlers
 extra_patterns = [
@@ -159,8 +170,9 @@ if args.show:
 
 if debug_print_timing():
     def print_statistics():
-        """ print ulog cache info once per hour """
+        """ print ulog cache & DB pool info once per hour """
         print_cache_info()
+        print_pool_info()
         server.io_loop.call_later(60*60, print_statistics)
     server.io_loop.call_later(60, print_statistics)
 
@@ -1,15 +1,17 @@
 #! /usr/bin/env python3
 
-# Script to create or upgrade the SQLite DB
+# Script to create or upgrade the DB (SQLite or PostgreSQL, see db_backend)
 
-import sqlite3 as lite
 import sys
 import os
 
 # this is needed for the following imports
 sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'plot_app'))
 from plot_app.config import get_db_filename, get_log_filepath, \
-    get_cache_filepath, get_kml_filepath, get_overview_img_filepath
+    get_cache_filepath, get_kml_filepath, get_overview_img_filepath, \
+    get_log_cache_filepath, get_pid_analysis_cache_filepath, \
+    get_spectral_analysis_cache_filepath, get_db_backend, get_db_connection
+from plot_app.db_repository import get_table_columns
 
 log_dir = get_log_filepath()
 if not os.path.exists(log_dir):
@@ -26,20 +28,36 @@ if not os.path.exists(cur_dir):
     print('creating kml directory '+cur_dir)
     os.makedirs(cur_dir)
 
+cur_dir = get_log_cache_filepath()
+if not os.path.exists(cur_dir):
+    print('creating log file cache directory '+cur_dir)
+    os.makedirs(cur_dir)
+
 cur_dir = get_overview_img_filepath()
 if not os.path.exists(cur_dir):
     print('creating overview image directory '+cur_dir)
     os.makedirs(cur_dir)
 
-print('creating DB at '+get_db_filename())
-con = lite.connect(get_db_filename())
-con.execute('PRAGMA journal_mode=WAL')
+cur_dir = get_pid_analysis_cache_filepath()
+if not os.path.exists(cur_dir):
+    print('creating PID analysis cache directory '+cur_dir)
+    os.makedirs(cur_dir)
+
+cur_dir = get_spectral_analysis_cache_filepath()
+if not os.path.exists(cur_dir):
+    print('creating spectral analysis cache directory '+cur_dir)
+    os.makedirs(cur_dir)
+
+if get_db_backend() == 'sqlite':
+    print('creating DB at '+get_db_filename())
+else:
+    print('creating DB tables in the PostgreSQL database')
+con = get_db_connection()
 with con:
     cur = con.cursor()
 
     # Logs table (contains information not found in the log file)
-    cur.execute("PRAGMA table_info('Logs')")
-    columns = cur.fetchall()
+    columns = get_table_columns(cur, 'Logs')
 
     if len(columns) == 0:
         cur.execute("CREATE TABLE Logs("
@@ -60,10 +78,12 @@ with con:
                 "ErrorLabels TEXT, " # the type of error (if any) that occurred during flight
                 "Public INT, " # if 1 this log can be publicly listed
                 "Token TEXT, " # Security token (currently used to delete the entry)
+                "ContentHash TEXT, " # SHA-256 of the log file (hex)
+                "BlobId TEXT, " # id of the stored log file (shared by duplicate uploads)
                 "CONSTRAINT Id_PK PRIMARY KEY (Id))")
     else:
         # try to upgrade
-        column_names = [ x[1] for x in columns]
+        column_names = columns
         if not 'Email' in column_names:
             print('Adding column Email')
             cur.execute("ALTER TABLE Logs ADD COLUMN Email TEXT DEFAULT ''")
@@ -91,11 +111,17 @@ with con:
         if not 'Token' in column_names:
             print('Adding column Token')
             cur.execute("ALTER TABLE Logs ADD COLUMN Token TEXT DEFAULT ''")
+        if not 'ContentHash' in column_names:
+            print('Adding column ContentHash')
+            cur.execute("ALTER TABLE Logs ADD COLUMN ContentHash TEXT")
+        if not 'BlobId' in column_names:
+            # NULL for existing logs: each has its own file
+            print('Adding column BlobId')
+            cur.execute("ALTER TABLE Logs ADD COLUMN BlobId TEXT")
 
 
     # LogsGenerated table (information from the log file, for faster access)
-    cur.execute("PRAGMA table_info('LogsGenerated')")
-    columns = cur.fetchall()
+    columns = get_table_columns(cur, 'LogsGenerated')
 
     if len(columns) == 0:
         cur.execute("CREATE TABLE LogsGenerated("
@@ -113,11 +139,12 @@ with con:
                 "UUID TEXT, " # vehicle UUID (sys_uuid in log)
                 "FlightModeDurations TEXT, " # comma-separated list of <flight_mode_int>:<duration_sec>
                 "StartTime INT, " #UTC Timestap from GPS log (useful when uploading multiple logs)
-                "CONSTRAINT Id_PK PRIMARY KEY (Id))")
+                "GeneratedVersion INT, " # version of the extractors (db_entry.GENERATED_VERSION)
+                "CONSTRAINT LogsGenerated_Id_PK PRIMARY KEY (Id))")
 
     else:
         # try to upgrade
-        column_names = [ x[1] for x in columns]
+        column_names = columns
 
         if not 'SoftwareVersion' in column_names:
             print('Adding column SoftwareVersion')
@@ -131,19 +158,142 @@ with con:
         if not 'StartTime' in column_names:
             print('Adding column StartTime')
             cur.execute("ALTER TABLE LogsGenerated ADD COLUMN StartTime INT DEFAULT 0")
+        if not 'GeneratedVersion' in column_names:
+            # existing entries were generated by the first version of the extractors
+            print('Adding column GeneratedVersion')
+            cur.execute("ALTER TABLE LogsGenerated ADD COLUMN GeneratedVersion INT DEFAULT 1")
 
 
     # Indexes for browse/search performance
     cur.execute("CREATE INDEX IF NOT EXISTS idx_logs_public_source_date "
                 "ON Logs(Public, Source, Date DESC)")
+    # Index for the date range selection of prune_old_logs.py
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_logs_date "
+                "ON Logs(Date)")
+    # Indexes for the upload deduplication & log file reference counting
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_logs_contenthash "
+                "ON Logs(ContentHash)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_logs_blobid "
+                "ON Logs(BlobId)")
     cur.execute("CREATE INDEX IF NOT EXISTS idx_logsgenerated_hardware "
                 "ON LogsGenerated(Hardware)")
     cur.execute("CREATE INDEX IF NOT EXISTS idx_logsgenerated_software "
                 "ON LogsGenerated(Software)")
+    # Index for finding the outdated entries to recompute
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_logsgenerated_version "
+                "ON LogsGenerated(GeneratedVersion)")
+
+    # LogFlightModes table (flight modes of a log, in order of occurrence).
+    # Replaces LogsGenerated.FlightModes & FlightModeDurations for reading.
+    columns = get_table_columns(cur, 'LogFlightModes')
+
+    if len(columns) == 0:
+        cur.execute("CREATE TABLE LogFlightModes("
+                "LogId TEXT, " # log id
+                "Seq INT, " # index of the flight mode change within the log
+                "Mode INT, " # flight mode (nav_state)
+                "Duration INT, " # duration in [s] (NULL if unknown)
+                "CONSTRAINT LogFlightModes_PK PRIMARY KEY (LogId, Seq))")
+
+        # migrate the comma-separated columns
+        print('Migrating flight modes to LogFlightModes')
+        cur.execute("SELECT Id, FlightModes, FlightModeDurations FROM LogsGenerated")
+        for log_id, flight_modes, flight_mode_durations in cur.fetchall():
+            rows = [tuple(map(int, x.split(':'))) for x in
+                    (flight_mode_durations or '').split(',') if len(x) > 0]
+            # older entries only have the set of flight modes
+            modes_with_duration = {mode for mode, _ in rows}
+            rows += [(int(x), None) for x in (flight_modes or '').split(',')
+                     if len(x) > 0 and int(x) not in modes_with_duration]
+            cur.executemany("INSERT INTO LogFlightModes (LogId, Seq, Mode, Duration) "
+                            "VALUES (?, ?, ?, ?)",
+                            [(log_id, i, mode, duration) for i, (mode, duration)
+                             in enumerate(rows)])
+
+    # LogErrorLabels table (error labels of a log).
+    # Replaces Logs.ErrorLabels for reading.
+    columns = get_table_columns(cur, 'LogErrorLabels')
+
+    if len(columns) == 0:
+        cur.execute("CREATE TABLE LogErrorLabels("
+                "LogId TEXT, " # log id
+                "Label INT, " # error label id (see error_labels_table)
+                "CONSTRAINT LogErrorLabels_PK PRIMARY KEY (LogId, Label))")
+
+        # migrate the comma-separated column
+        print('Migrating error labels to LogErrorLabels')
+        cur.execute("SELECT Id, ErrorLabels FROM Logs")
+        for log_id, error_labels in cur.fetchall():
+            labels = {int(x) for x in (error_labels or '').split(',') if len(x) > 0}
+            cur.executemany("INSERT INTO LogErrorLabels (LogId, Label) VALUES (?, ?)",
+                            [(log_id, label) for label in sorted(labels)])
+
+    # Indexes for flight mode & error label lookups (the primary keys cover
+    # lookups by log id)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_logflightmodes_mode "
+                "ON LogFlightModes(Mode, LogId)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_logerrorlabels_label "
+                "ON LogErrorLabels(Label, LogId)")
+
+    # LogParameters table (parameters of a log, extracted at upload, for
+    # the parameter downloads). Logs uploaded before are extracted on demand.
+    columns = get_table_columns(cur, 'LogParameters')
+
+    if len(columns) == 0:
+        cur.execute("CREATE TABLE LogParameters("
+                "LogId TEXT, " # log id
+                "Name TEXT, " # parameter name
+                "Type INT, " # MAV_PARAM_TYPE: 6=int32, 9=float
+                "Value DOUBLE PRECISION, " # initial value
+                "SystemDefault DOUBLE PRECISION, " # NULL if not in the log
+                "AirframeDefault DOUBLE PRECISION, " # NULL if not in the log
+                "CONSTRAINT LogParameters_PK PRIMARY KEY (LogId, Name))")
+
+    # LogParameterChanges table (parameter changes during a log)
+    columns = get_table_columns(cur, 'LogParameterChanges')
+
+    if len(columns) == 0:
+        cur.execute("CREATE TABLE LogParameterChanges("
+                "LogId TEXT, " # log id
+                "Seq INT, " # index of the change within the log
+                "Timestamp BIGINT, " # log timestamp in [us]
+                "Name TEXT, " # parameter name
+                "Value DOUBLE PRECISION, "
+                "CONSTRAINT LogParameterChanges_PK PRIMARY KEY (LogId, Seq))")
+
+    # LogMetrics table (flight summary metrics of a log, see log_metrics.py).
+    # Generated together with LogsGenerated, NULL if not available.
+    columns = get_table_columns(cur, 'LogMetrics')
+
+    if len(columns) == 0:
+        cur.execute("CREATE TABLE LogMetrics("
+                "LogId TEXT, " # log id
+                "TotalDistance DOUBLE PRECISION, " # [m]
+                "MaxAltitudeDiff DOUBLE PRECISION, " # [m]
+                "MeanSpeed DOUBLE PRECISION, " # [m/s] (not for VTOL's)
+                "MeanSpeedMC DOUBLE PRECISION, " # [m/s] (VTOL only)
+                "MeanSpeedFW DOUBLE PRECISION, " # [m/s] (VTOL only)
+                "MaxSpeed DOUBLE PRECISION, " # [m/s]
+                "MaxSpeedHorizontal DOUBLE PRECISION, " # [m/s]
+                "MaxSpeedUp DOUBLE PRECISION, " # [m/s]
+                "MaxSpeedDown DOUBLE PRECISION, " # [m/s]
+                "MaxTiltAngle DOUBLE PRECISION, " # [deg]
+                "MaxRotationSpeed DOUBLE PRECISION, " # [deg/s]
+                "MeanCurrent DOUBLE PRECISION, " # [A] (not for VTOL's)
+                "MeanCurrentMC DOUBLE PRECISION, " # [A] (VTOL only)
+                "MeanCurrentFW DOUBLE PRECISION, " # [A] (VTOL only)
+                "MaxCurrent DOUBLE PRECISION, " # [A]
+                "DischargedMah DOUBLE PRECISION, " # [mAh]
+                "MaxVibration DOUBLE PRECISION, " # max accel vibration metric [m/s^2]
+                "CONSTRAINT LogMetrics_PK PRIMARY KEY (LogId))")
+
+    # Indexes for sorting & filtering by the most used metrics
+    for column in ['TotalDistance', 'MaxSpeed', 'MaxCurrent', 'MaxVibration']:
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_logmetrics_{} "
+                    "ON LogMetrics({})".format(column.lower(), column))
 
     # Vehicle table (contains information about a vehicle)
-    cur.execute("PRAGMA table_info('Vehicle')")
-    columns = cur.fetchall()
+    columns = get_table_columns(cur, 'Vehicle')
 
     if len(columns) == 0:
         cur.execute("CREATE TABLE Vehicle("
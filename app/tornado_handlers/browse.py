@@ -11,12 +11,15 @@ import tornado.web
 
 # this is needed for the following imports
 sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '../plot_app'))
-from config import get_db_connection, get_overview_img_filepath
+from config import get_overview_img_filepath
 from db_entry import DBData, DBDataGenerated
+from db_repository import get_metadata_repository, get_log_metrics_where, \
+    get_log_metrics_order
 from helper import flight_modes_table, get_airframe_data
 
 #pylint: disable=relative-beyond-top-level,too-many-statements
-from .common import get_jinja_env, get_generated_db_data_from_log
+from .common import get_jinja_env, get_generated_db_data_from_log, \
+    get_log_metrics_arguments
 
 BROWSE_TEMPLATE = 'browse.html'
 
@@ -92,8 +95,7 @@ _SEARCH_COLUMNS = [
     'LogsGenerated.UUID',
 ]
 
-_BASE_WHERE = 'Logs.Public = 1 AND NOT Logs.Source = ?'
-_BASE_PARAMS = ['CI']
+_BASE_WHERE = "Logs.Public = 1 AND NOT Logs.Source = 'CI'"
 
 _SELECT_COLS = ('SELECT Logs.Id, Logs.Date, '
                 '       Logs.Description, Logs.WindSpeed, '
@@ -218,7 +220,7 @@ def _build_search_clause(search_str):
     return '(' + ' OR '.join(clauses) + ')', params
 
 
-def _get_columns_from_tuple(db_tuple, counter, all_overview_imgs, con, cur):
+def _get_columns_from_tuple(db_tuple, counter, all_overview_imgs, flight_modes_dict):
     """ load the display columns from a db_tuple """
 
     db_data = DBDataJoin()
@@ -232,8 +234,7 @@ def _get_columns_from_tuple(db_tuple, counter, all_overview_imgs, con, cur):
     db_data.video_url = db_tuple[5]
     generateddata_log_id = db_tuple[6]
     if log_id != generateddata_log_id:
-        print('Join failed, loading and updating data')
-        db_data_gen = get_generated_db_data_from_log(log_id, con, cur)
+        db_data_gen = get_generated_db_data_from_log(log_id)
         if db_data_gen is None:
             return None
         db_data.add_generated_db_data_from_log(db_data_gen)
@@ -246,13 +247,10 @@ def _get_columns_from_tuple(db_tuple, counter, all_overview_imgs, con, cur):
         db_data.ver_sw = db_tuple[12]
         db_data.num_logged_errors = db_tuple[13]
         db_data.num_logged_warnings = db_tuple[14]
-        db_data.flight_modes = \
-            {int(x) for x in db_tuple[15].split(',') if len(x) > 0}
         db_data.ver_sw_release = db_tuple[16]
         db_data.vehicle_uuid = db_tuple[17]
-        db_data.flight_mode_durations = \
-           [tuple(map(int, x.split(':'))) for x in db_tuple[18].split(',') if len(x) > 0]
         db_data.start_time_utc = db_tuple[19]
+        db_data.set_flight_modes(flight_modes_dict.get(log_id, []))
 
     # bring it into displayable form
     ver_sw = _format_sw_version(db_data.ver_sw_release, db_data.ver_sw)
@@ -326,9 +324,6 @@ class BrowseDataRetrievalHandler(tornado.web.RequestHandler):
 
         json_output = {'draw': draw_counter, 'data': []}
 
-        con = get_db_connection()
-        cur = con.cursor()
-
         # build ORDER BY — indices must match the DataTables columns config
         ordering_col = ['',                          # 0: row number
                         'Logs.Date',                 # 1: Uploaded
@@ -348,47 +343,42 @@ class BrowseDataRetrievalHandler(tornado.web.RequestHandler):
             # push NULLs to the end regardless of sort direction
             sql_order = f' ORDER BY {col} IS NULL, {col}{direction}'
 
+        # optional filtering & sorting by the LogMetrics (API only)
+        metric_filters, metric_order_by = get_log_metrics_arguments(self)
+        if metric_order_by is not None:
+            sql_order = ' ORDER BY ' + get_log_metrics_order(*metric_order_by)
+
         # build WHERE with optional search
         where = 'WHERE ' + _BASE_WHERE
-        params = list(_BASE_PARAMS)
+        params = []
 
         search_clause, search_params = _build_search_clause(search_str)
         if search_clause:
             where += ' AND ' + search_clause
             params += search_params
-
-        # total records (unfiltered)
-        cur.execute('SELECT COUNT(*) FROM Logs WHERE ' + _BASE_WHERE, _BASE_PARAMS)
-        json_output['recordsTotal'] = cur.fetchone()[0]
-
-        # filtered count
-        cur.execute('SELECT COUNT(*) FROM Logs '
-                    'LEFT JOIN LogsGenerated on Logs.Id=LogsGenerated.Id '
-                    + where, params)
-        records_filtered = cur.fetchone()[0]
-        json_output['recordsFiltered'] = records_filtered
+        metric_where, metric_params = get_log_metrics_where(metric_filters)
+        where += metric_where
+        params += metric_params
 
         # fetch only the page we need, enforce a hard max to prevent
         # unbounded queries from reintroducing the performance problem
         if data_length <= 0 or data_length > _MAX_PAGE_SIZE:
             data_length = _MAX_PAGE_SIZE
-        limit_clause = ' LIMIT ? OFFSET ?'
-        params += [data_length, data_start]
 
-        cur.execute(_SELECT_COLS + where + sql_order + limit_clause, params)
-        db_tuples = cur.fetchall()
+        records_total, records_filtered, db_tuples, flight_modes_dict = \
+            get_metadata_repository().search_public_logs(
+                _SELECT_COLS, where, params, sql_order, data_length, data_start)
+        json_output['recordsTotal'] = records_total
+        json_output['recordsFiltered'] = records_filtered
 
         all_overview_imgs = set(os.listdir(get_overview_img_filepath()))
         for i, db_tuple in enumerate(db_tuples):
             counter = data_start + i + 1
             columns = _get_columns_from_tuple(
-                db_tuple, counter, all_overview_imgs, con, cur)
+                db_tuple, counter, all_overview_imgs, flight_modes_dict)
             if columns is not None:
                 json_output['data'].append(columns)
 
-        cur.close()
-        con.close()
-
         self.set_header('Content-Type', 'application/json')
         self.write(json.dumps(json_output))
 
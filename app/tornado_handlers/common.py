@@ -4,7 +4,6 @@ Common methods and classes used by several tornado handlers
 
 from __future__ import print_function
 import os
-import sqlite3
 import sys
 
 from jinja2 import Environment, FileSystemLoader
@@ -13,7 +12,8 @@ import tornado.web
 # this is needed for the following imports
 sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '../plot_app'))
 from db_entry import DBDataGenerated
-from config import get_db_connection
+from db_repository import get_metadata_repository
+from log_metrics import LOG_METRICS
 
 #pylint: disable=abstract-method
 
@@ -49,7 +49,7 @@ class TornadoRequestHandlerBase(tornado.web.RequestHandler):
         self.write(html_template.format(status_code=status_code,
                                         error_message=error_message))
 
-def generate_db_data_from_log_file(log_id, db_connection=None):
+def generate_db_data_from_log_file(log_id):
     """
     Extract necessary information from the log file and insert as an entry to
     the LogsGenerated table (faster information retrieval later on).
@@ -61,74 +61,47 @@ def generate_db_data_from_log_file(log_id, db_connection=None):
     """
 
     db_data_gen = DBDataGenerated.from_log_file(log_id)
-
-    need_closing = False
-    if db_connection is None:
-        db_connection = get_db_connection()
-        need_closing = True
-
-    db_cursor = db_connection.cursor()
-    try:
-        db_cursor.execute(
-            'insert into LogsGenerated (Id, Duration, '
-            'Mavtype, Estimator, AutostartId, Hardware, '
-            'Software, NumLoggedErrors, NumLoggedWarnings, '
-            'FlightModes, SoftwareVersion, UUID, FlightModeDurations, StartTime) values '
-            '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
-            [log_id, db_data_gen.duration_s, db_data_gen.mav_type,
-             db_data_gen.estimator, db_data_gen.sys_autostart_id,
-             db_data_gen.sys_hw, db_data_gen.ver_sw,
-             db_data_gen.num_logged_errors,
-             db_data_gen.num_logged_warnings,
-             ','.join(map(str, db_data_gen.flight_modes)),
-             db_data_gen.ver_sw_release, db_data_gen.vehicle_uuid,
-             db_data_gen.flight_mode_durations_str(),
-             db_data_gen.start_time_utc])
-        db_connection.commit()
-    except sqlite3.IntegrityError:
-        # someone else already inserted it (race). just ignore it
-        pass
-
-    db_cursor.close()
-    if need_closing:
-        db_connection.close()
-
+    get_metadata_repository().insert_generated(log_id, db_data_gen)
     return db_data_gen
 
 
-def get_generated_db_data_from_log(log_id, con, cur):
+def get_generated_db_data_from_log(log_id):
     """
-    try to get the additional data from the DB (or generate it if it does not
-    exist)
-    :param con: db connection
-    :param cur: db cursor
+    get the additional data from the DB. Log files are not parsed in requests:
+    missing entries are generated with backfill_generated.py.
     :return: DBDataGenerated or None
     """
-    cur.execute('select * from LogsGenerated where Id = ?', [log_id])
-    db_tuple = cur.fetchone()
-    if db_tuple is None: # need to generate from file
-        try:
-            # Note that this is not necessary in most cases, as the entry is
-            # also generated after uploading (but with a timeout)
-            db_data_gen = generate_db_data_from_log_file(log_id, con)
-        except Exception as e:
-            print('Failed to load log file: '+str(e))
-            return None
-    else: # get it from the DB
-        db_data_gen = DBDataGenerated()
-        db_data_gen.duration_s = db_tuple[1]
-        db_data_gen.mav_type = db_tuple[2]
-        db_data_gen.estimator = db_tuple[3]
-        db_data_gen.sys_autostart_id = db_tuple[4]
-        db_data_gen.sys_hw = db_tuple[5]
-        db_data_gen.ver_sw = db_tuple[6]
-        db_data_gen.num_logged_errors = db_tuple[7]
-        db_data_gen.num_logged_warnings = db_tuple[8]
-        db_data_gen.flight_modes = \
-            {int(x) for x in db_tuple[9].split(',') if len(x) > 0}
-        db_data_gen.ver_sw_release = db_tuple[10]
-        db_data_gen.vehicle_uuid = db_tuple[11]
-        db_data_gen.flight_mode_durations = \
-            [tuple(map(int, x.split(':'))) for x in db_tuple[12].split(',') if len(x) > 0]
+    db_data_gen = get_metadata_repository().get_generated(log_id)
+    if db_data_gen is None:
+        print('No LogsGenerated entry for {} (run backfill_generated.py)'.format(log_id))
     return db_data_gen
 
+
+def get_log_metrics_arguments(handler):
+    """
+    get the LogMetrics filter & sort arguments of a request (metric names as in
+    log_metrics.LOG_METRICS, e.g. max_speed_m_s):
+    - min_<metric>, max_<metric>: the log's metric must be within the range
+    - sort_metric=<metric>, sort_dir=asc|desc: sort by a metric
+    :return: tuple (list of (column, min, max) filters, (column, descending)
+             or None)
+    """
+    metric_filters = []
+    order_by = None
+    try:
+        for column, name in LOG_METRICS:
+            min_value = handler.get_argument('min_' + name, None)
+            max_value = handler.get_argument('max_' + name, None)
+            if min_value is not None or max_value is not None:
+                metric_filters.append((
+                    column, None if min_value is None else float(min_value),
+                    None if max_value is None else float(max_value)))
+    except ValueError as e:
+        raise tornado.web.HTTPError(400, 'Invalid Parameter') from e
+    sort_metric = handler.get_argument('sort_metric', None)
+    if sort_metric is not None:
+        columns = {name: column for column, name in LOG_METRICS}
+        if sort_metric not in columns:
+            raise tornado.web.HTTPError(400, 'Invalid Parameter')
+        order_by = (columns[sort_metric], handler.get_argument('sort_dir', '') == 'desc')
+    return metric_filters, order_by
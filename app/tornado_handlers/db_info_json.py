@@ -9,13 +9,13 @@ import tornado.web
 
 # this is needed for the following imports
 sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '../plot_app'))
-from config import get_db_connection
-from db_entry import DBData
+from db_repository import get_metadata_repository
 from helper import get_airframe_data
+from log_metrics import log_metrics_to_json_dict
 
 
 #pylint: disable=relative-beyond-top-level
-from .common import get_generated_db_data_from_log
+from .common import get_generated_db_data_from_log, get_log_metrics_arguments
 
 #pylint: disable=abstract-method
 
@@ -23,46 +23,44 @@ class DBInfoHandler(tornado.web.RequestHandler):
     """ Get database info (JSON list of public logs) Tornado request handler """
 
     def get(self, *args, **kwargs):
-        """ GET request """
+        """ GET request
+
+        Optional filter arguments (comma-separated ids, a log must contain all):
+        - flight_modes: flight mode ids (see flight_modes_table)
+        - error_labels: error label ids (see error_labels_table)
+        Optional metric filter & sort arguments, see get_log_metrics_arguments()
+        """
+
+        try:
+            flight_modes = [int(x) for x in
+                            self.get_argument('flight_modes', '').split(',') if x]
+            error_labels = [int(x) for x in
+                            self.get_argument('error_labels', '').split(',') if x]
+        except ValueError as e:
+            raise tornado.web.HTTPError(400, 'Invalid Parameter') from e
+        metric_filters, order_by = get_log_metrics_arguments(self)
 
         jsonlist = []
 
-        # get the logs (but only the public ones)
-        con = get_db_connection()
-        cur = con.cursor()
+        repository = get_metadata_repository()
 
         # get vehicle name information from vehicle table
-        cur.execute('select UUID, Name from Vehicle')
-        db_tuples = cur.fetchall()
-        vehicle_table = {db_tuple[0]: db_tuple[1] for db_tuple in db_tuples}
-
-        cur.execute('SELECT Id, Date, Description, WindSpeed, Rating, VideoUrl, ErrorLabels, '
-                    'Source, Feedback, Type FROM Logs WHERE Public = 1 AND NOT Source = "CI"')
-        # need to fetch all here, because we will do more SQL calls while
-        # iterating (having multiple cursor's does not seem to work)
-        db_tuples = cur.fetchall()
-        for db_tuple in db_tuples:
+        vehicle_table = repository.get_vehicle_names()
+
+        # get the logs (but only the public ones)
+        for log_id, log_date, db_data, metrics in repository.get_public_logs(
+                flight_modes, error_labels, metric_filters, order_by):
             jsondict = {}
-            db_data = DBData()
-            log_id = db_tuple[0]
             jsondict['log_id'] = log_id
-            jsondict['log_date'] = db_tuple[1].strftime('%Y-%m-%d')
-            db_data.description = db_tuple[2]
-            db_data.wind_speed = db_tuple[3]
-            db_data.rating = db_tuple[4]
-            db_data.video_url = db_tuple[5]
-            db_data.error_labels = sorted([int(x) for x in db_tuple[6].split(',') if len(x) > 0]) \
-                if db_tuple[6] else []
-            db_data.source = db_tuple[7]
-            db_data.feedback = db_tuple[8]
-            db_data.type = db_tuple[9]
+            jsondict['log_date'] = log_date.strftime('%Y-%m-%d')
             jsondict.update(db_data.to_json_dict())
 
-            db_data_gen = get_generated_db_data_from_log(log_id, con, cur)
+            db_data_gen = get_generated_db_data_from_log(log_id)
             if db_data_gen is None:
                 continue
 
             jsondict.update(db_data_gen.to_json_dict())
+            jsondict.update(log_metrics_to_json_dict(metrics or {}))
             # add vehicle name
             jsondict['vehicle_name'] = vehicle_table.get(jsondict['vehicle_uuid'], '')
             airframe_data = get_airframe_data(jsondict['sys_autostart_id'])
@@ -73,9 +71,6 @@ class DBInfoHandler(tornado.web.RequestHandler):
 
             jsonlist.append(jsondict)
 
-        cur.close()
-        con.close()
-
         self.set_header('Content-Type', 'application/json')
         self.write(json.dumps(jsonlist))
 
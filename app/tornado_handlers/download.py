@@ -6,33 +6,78 @@ from __future__ import print_function
 import os
 from html import escape
 import sys
-import uuid
-import shutil
 import tornado.web
-
-from pyulog.ulog2kml import convert_ulog2kml
+from tornado.ioloop import IOLoop
+from tornado.iostream import StreamClosedError
 
 # this is needed for the following imports
 sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '../plot_app'))
-from helper import get_log_filename, validate_log_id, \
-    flight_modes_table, load_ulog_file, get_default_parameters
+from helper import get_log_filename, validate_log_id, get_default_parameters, \
+    get_kml_filename
+from kml_generator import generate_kml_file_from_log
+from log_parameters import get_log_parameters, has_log_defaults, render_qgc_params, \
+    render_csv, render_json
 
-from config import get_db_connection, get_kml_filepath
+from config import get_download_accel_redirect, get_storage_path
+from db_repository import get_metadata_repository
 
 #pylint: disable=relative-beyond-top-level
 from .common import CustomHTTPError, TornadoRequestHandlerBase
 
 #pylint: disable=abstract-method, unused-argument
 
+# KML files currently being generated: key=KML file name, value=Future
+_kml_builds = {}
+
+
+def _parse_byte_range(range_header, file_size):
+    """ parse a HTTP Range header
+    :return: (start, end) with end exclusive, or None if the header is not a
+             single byte range (then the whole file is sent)
+    :raise ValueError: if the range is not satisfiable
+    """
+    if not range_header.startswith('bytes='):
+        return None
+    byte_range = range_header[len('bytes='):].strip()
+    if ',' in byte_range or '-' not in byte_range:
+        return None # multiple ranges are not supported
+    start_str, end_str = (x.strip() for x in byte_range.split('-', 1))
+    if not all(x == '' or x.isdigit() for x in (start_str, end_str)) or \
+            start_str == end_str == '':
+        return None # invalid: ignore it
+    if start_str == '': # suffix range: the last N bytes
+        if int(end_str) == 0:
+            raise ValueError('empty suffix range')
+        start, end = max(file_size - int(end_str), 0), file_size
+    else:
+        start = int(start_str)
+        if start >= file_size:
+            raise ValueError('range start beyond end of file')
+        end = file_size if end_str == '' else int(end_str) + 1
+        if end <= start:
+            return None # invalid: ignore it
+    if start >= file_size: # empty file
+        raise ValueError('range not satisfiable')
+    return start, min(end, file_size)
+
+
 class DownloadHandler(TornadoRequestHandlerBase):
     """ Download log file Tornado request handler """
 
-    def get(self, *args, **kwargs):
+    # size of the chunks when sending a log file
+    CHUNK_SIZE = 256 * 1024
+
+    async def get(self, *args, **kwargs):
         """ GET request callback """
         log_id = self.get_argument('log')
         if not validate_log_id(log_id):
             raise tornado.web.HTTPError(400, 'Invalid Parameter')
-        log_file_name = get_log_filename(log_id)
+        # this might have to fetch the file from the log storage
+        try:
+            log_file_name = await IOLoop.current().run_in_executor(
+                None, get_log_filename, log_id)
+        except FileNotFoundError as error:
+            raise tornado.web.HTTPError(404, 'Log not found') from error
         download_type = self.get_argument('type', default='0')
         if not os.path.exists(log_file_name):
             raise tornado.web.HTTPError(404, 'Log not found')
@@ -42,86 +87,59 @@ class DownloadHandler(TornadoRequestHandlerBase):
             """
             get the uploaded file name & exchange the file extension
             """
-            con = None
             try:
-                con = get_db_connection()
-                cur = con.cursor()
-                cur.execute('select OriginalFilename '
-                            'from Logs where Id = ?', [log_id])
-                db_tuple = cur.fetchone()
-                if db_tuple is not None:
-                    original_file_name = escape(db_tuple[0])
+                original_file_name = get_metadata_repository().get_original_filename(log_id)
+                if original_file_name is not None:
+                    original_file_name = escape(original_file_name)
                     if original_file_name[-4:].lower() == '.ulg':
                         original_file_name = original_file_name[:-4]
                     return original_file_name + new_file_suffix
             except:
                 print("DB access failed:", sys.exc_info()[0], sys.exc_info()[1])
-            finally:
-                if con is not None:
-                    con.close()
             return default_value
 
-        if download_type == '1': # download the parameters
-            ulog = load_ulog_file(log_file_name)
-            param_keys = sorted(ulog.initial_parameters.keys())
+        if download_type in ('1', '3', '4', '5'): # download the parameters
+            parameters, changes = await IOLoop.current().run_in_executor(
+                None, get_log_parameters, log_id, log_file_name)
 
             self.set_header('Content-Type', 'application/octet-stream')
             self.set_header("Content-Description", "File Transfer")
-            self.set_header('Content-Disposition', 'attachment; filename=vehicle.params')
-
-            delimiter = '	'
-            for param_key in param_keys:
-                self.write("1") #sysid
-                self.write(delimiter)
-                self.write("1") #compid
-                self.write(delimiter)
-                self.write(param_key)
-                self.write(delimiter)
-                self.write(str(ulog.initial_parameters[param_key]))
-
-                #if the value is an int write a 6, if not write a 9
-                if isinstance(ulog.initial_parameters[param_key], int):
-                    self.write(delimiter)
-                    self.write("6")
-                else:
-                    self.write(delimiter)
-                    self.write("9")
-
-                self.write('\n')
+            if download_type == '1':
+                file_name = 'vehicle.params'
+                content = render_qgc_params(parameters)
+            elif download_type == '3':
+                file_name = 'non-default.params'
+                default_parameters = None
+                if not has_log_defaults(parameters):
+                    default_parameters = get_default_parameters()
+                content = render_qgc_params(parameters, True, default_parameters)
+            elif download_type == '4':
+                file_name = 'parameters.csv'
+                self.set_header('Content-Type', 'text/csv')
+                content = render_csv(parameters)
+            else:
+                file_name = 'parameters.json'
+                self.set_header('Content-Type', 'application/json')
+                content = render_json(parameters, changes)
+            self.set_header('Content-Disposition', 'attachment; filename='+file_name)
+            self.write(content)
 
         elif download_type == '2': # download the kml file
-            kml_path = get_kml_filepath()
-            kml_file_name = os.path.join(kml_path, log_id.replace('/', '.')+'.kml')
+            kml_file_name = get_kml_filename(log_id)
 
             # check if chached file exists
             if not os.path.exists(kml_file_name):
-                print('need to create kml file', kml_file_name)
-
-                def kml_colors(flight_mode):
-                    """ flight mode colors for KML file """
-                    if flight_mode not in flight_modes_table: flight_mode = 0
-
-                    color_str = flight_modes_table[flight_mode][1][1:] # color in form 'ff00aa'
-
-                    # increase brightness to match colors with template
-                    rgb = [int(color_str[2*x:2*x+2], 16) for x in range(3)]
-                    for i in range(3):
-                        rgb[i] += 40
-                        if rgb[i] > 255: rgb[i] = 255
-
-                    color_str = "".join(map(lambda x: format(x, '02x'), rgb))
-
-                    return 'ff'+color_str[4:6]+color_str[2:4]+color_str[0:2] # KML uses aabbggrr
-
-                style = {'line_width': 2}
-                # create in random temporary file, then move it (to avoid races)
+                # concurrent requests for the same log wait for the same build
+                kml_build = _kml_builds.get(kml_file_name)
+                if kml_build is None:
+                    print('need to create kml file', kml_file_name)
+                    kml_build = IOLoop.current().run_in_executor(
+                        None, generate_kml_file_from_log, log_file_name, kml_file_name)
+                    _kml_builds[kml_file_name] = kml_build
+                    kml_build.add_done_callback(
+                        lambda _: _kml_builds.pop(kml_file_name, None))
                 try:
-                    temp_file_name = kml_file_name+'.'+str(uuid.uuid4())
-                    convert_ulog2kml(log_file_name, temp_file_name,
-                                     'vehicle_global_position', kml_colors,
-                                     style=style,
-                                     camera_trigger_topic_name='camera_capture')
-                    shutil.move(temp_file_name, kml_file_name, copy_function=shutil.copyfile)
+                    await kml_build
                 except Exception as e:
                     print('Error creating KML file', sys.exc_info()[0], sys.exc_info()[1])
                     raise CustomHTTPError(400, 'No Position Data in log') from e
@@ -140,96 +158,69 @@ class DownloadHandler(TornadoRequestHandlerBase):
                     self.write(data)
                 self.finish()
 
-        elif download_type == '3': # download the non-default parameters
-            ulog = load_ulog_file(log_file_name)
-            param_keys = sorted(ulog.initial_parameters.keys())
-
-            self.set_header('Content-Type', 'application/octet-stream')
-            self.set_header("Content-Description", "File Transfer")
-            self.set_header('Content-Disposition', 'attachment; filename=non-default.params')
-            delimiter = '	'
-
-            # Use defaults from log if available
-            if ulog.has_default_parameters:
-                system_defaults = ulog.get_default_parameters(0)
-                airframe_defaults = ulog.get_default_parameters(1)
-                for param_key in param_keys:
-                    try:
-                        param_value = ulog.initial_parameters[param_key]
-                        is_default = True
-                        if param_key in airframe_defaults:
-                            is_default = param_value == airframe_defaults[param_key]
-                        elif param_key in system_defaults:
-                            is_default = param_value == system_defaults[param_key]
-
-                        if not is_default:
-                            self.write("1") # sysid
-                            self.write(delimiter)
-                            self.write("1") # compid
-                            self.write(delimiter)
-                            self.write(param_key)
-                            self.write(delimiter)
-                            self.write(str(param_value))
-
-                            #if the value is an int write a 6, if not write a 9
-                            if isinstance(param_value, int):
-                                self.write(delimiter)
-                                self.write("6")
-                            else:
-                                self.write(delimiter)
-                                self.write("9")
-
-                            self.write('\n')
-                    except:
-                        pass
-
-            else:
-                default_params = get_default_parameters()
-
-                for param_key in param_keys:
-                    try:
-                        param_value = str(ulog.initial_parameters[param_key])
-                        is_default = False
-
-                        if param_key in default_params:
-                            default_param = default_params[param_key]
-                            if default_param['type'] == 'FLOAT':
-                                is_default = abs(float(default_param['default']) -
-                                                 float(param_value)) < 0.00001
-                            else:
-                                is_default = int(default_param['default']) == int(param_value)
-
-                        if not is_default:
-                            self.write("1") # sysid
-                            self.write(delimiter)
-                            self.write("1") # compid
-                            self.write(delimiter)
-                            self.write(param_key)
-                            self.write(delimiter)
-                            self.write(param_value)
-
-                            #if the value is an int write a 6, if not write a 9
-                            if isinstance(param_value, int):
-                                self.write(delimiter)
-                                self.write("6")
-                            else:
-                                self.write(delimiter)
-                                self.write("9")
-
-                            self.write('\n')
-                    except:
-                        pass
-
         else: # download the log file
-            self.set_header('Content-Type', 'application/octet-stream')
-            self.set_header("Content-Description", "File Transfer")
-            self.set_header('Content-Disposition', 'attachment; filename={}'.format(
-                os.path.basename(log_file_name)))
-            with open(log_file_name, 'rb') as log_file:
-                while True:
-                    data = log_file.read(4096)
-                    if not data:
-                        break
-                    self.write(data)
-                self.finish()
+            await self._send_log_file(log_id, log_file_name)
+
+    async def _send_log_file(self, log_id, log_file_name):
+        """ send a ULog file in chunks without blocking the IOLoop, with
+        support for single byte ranges (Range & If-Range) and a strong ETag
+        derived from the log id and file size (log files are immutable).
+        If configured, the file is sent by nginx instead (X-Accel-Redirect).
+        """
+        file_size = os.path.getsize(log_file_name)
+        etag = '"{}-{}"'.format(log_id.replace('"', ''), file_size)
+        # not the name of the stored file: duplicate uploads share the file of
+        # another (possibly private) log
+        download_file_name = log_id + '.ulg'
+
+        self.set_header('Etag', etag)
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+        self.set_header('Content-Type', 'application/octet-stream')
+        self.set_header("Content-Description", "File Transfer")
+        self.set_header('Content-Disposition', 'attachment; filename={}'.format(
+            download_file_name))
+
+        accel_redirect = get_download_accel_redirect()
+        if accel_redirect:
+            relative_file_name = os.path.relpath(log_file_name, get_storage_path())
+            if not relative_file_name.startswith('..'):
+                # nginx handles ranges & conditional requests
+                self.set_header('X-Accel-Redirect', accel_redirect + relative_file_name)
+                return
+
+        self.set_header('Accept-Ranges', 'bytes')
+        start, end = 0, file_size
+        range_header = self.request.headers.get('Range')
+        if_range = self.request.headers.get('If-Range')
+        if range_header is not None and (if_range is None or if_range == etag):
+            try:
+                byte_range = _parse_byte_range(range_header, file_size)
+            except ValueError:
+                self.set_status(416)
+                self.clear_header('Content-Disposition')
+                self.set_header('Content-Range', 'bytes */{}'.format(file_size))
+                return
+            if byte_range is not None:
+                start, end = byte_range
+                self.set_status(206)
+                self.set_header('Content-Range', 'bytes {}-{}/{}'.format(
+                    start, end - 1, file_size))
+        self.set_header('Content-Length', end - start)
+
+        with open(log_file_name, 'rb') as log_file:
+            log_file.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                data = log_file.read(min(self.CHUNK_SIZE, remaining))
+                if not data:
+                    break
+                remaining -= len(data)
+                self.write(data)
+                try:
+                    # wait until the chunk is sent (limits memory usage)
+                    await self.flush()
+                except StreamClosedError:
+                    return
 
@@ -9,8 +9,9 @@ import tornado.web
 
 # this is needed for the following imports
 sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '../plot_app'))
-from config import get_db_connection, get_kml_filepath, get_overview_img_filepath
-from helper import clear_ulog_cache, get_log_filename
+from config import get_overview_img_filepath
+from db_repository import get_metadata_repository
+from helper import clear_ulog_cache, delete_log_file
 
 #pylint: disable=relative-beyond-top-level
 from .common import get_jinja_env
@@ -70,35 +71,24 @@ Click <a href="{delete_url}">here</a> to confirm and delete the log {log_id}.
 
         :return: True on success
         """
-        con = get_db_connection()
-        try:
-            cur = con.cursor()
-            cur.execute('select Token from Logs where Id = ?', (log_id,))
-            db_tuple = cur.fetchone()
-            if db_tuple is None:
-                return False
-            if token != db_tuple[0]: # validate token
-                return False
-
-            # kml file
-            kml_path = get_kml_filepath()
-            kml_file_name = os.path.join(kml_path, log_id.replace('/', '.')+'.kml')
-            if os.path.exists(kml_file_name):
-                os.unlink(kml_file_name)
-
-            #preview image
-            preview_image_filename = os.path.join(get_overview_img_filepath(), log_id+'.png')
-            if os.path.exists(preview_image_filename):
-                os.unlink(preview_image_filename)
-
-            log_file_name = get_log_filename(log_id)
-            print('deleting log entry {} and file {}'.format(log_id, log_file_name))
-            os.unlink(log_file_name)
-            cur.execute("DELETE FROM LogsGenerated WHERE Id = ?", (log_id,))
-            cur.execute("DELETE FROM Logs WHERE Id = ?", (log_id,))
-            con.commit()
-        finally:
-            con.close()
+        repository = get_metadata_repository()
+        db_token = repository.get_log_token(log_id)
+        if db_token is None:
+            return False
+        if token != db_token: # validate token
+            return False
+
+        #preview image
+        preview_image_filename = os.path.join(get_overview_img_filepath(), log_id+'.png')
+        if os.path.exists(preview_image_filename):
+            os.unlink(preview_image_filename)
+
+        print('deleting log entry {}'.format(log_id))
+        _, unreferenced_blob_ids = repository.delete_logs([log_id])
+        # the file is shared with other uploads of the same content
+        for blob_id in unreferenced_blob_ids:
+            print('deleting log file {}'.format(blob_id))
+            delete_log_file(blob_id)
 
         # need to clear the cache as well
         clear_ulog_cache()
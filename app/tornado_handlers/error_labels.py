@@ -9,8 +9,7 @@ import tornado.web
 
 # this is needed for the following imports
 sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'plot_app'))
-from config import get_db_connection
-from db_entry import *
+from db_repository import get_metadata_repository
 from helper import validate_log_id, validate_error_ids
 
 class UpdateErrorLabelHandler(tornado.web.RequestHandler):
@@ -29,22 +28,7 @@ class UpdateErrorLabelHandler(tornado.web.RequestHandler):
         if not validate_error_ids(error_ids):
             raise tornado.web.HTTPError(400, 'Invalid Parameter')
 
-        error_id_str = ""
-        for error_ix, error_id in enumerate(error_ids):
-            error_id_str += str(error_id)
-            if error_ix < len(error_ids)-1:
-                error_id_str += ","
-
-        con = get_db_connection()
-        cur = con.cursor()
-
-        cur.execute(
-            'UPDATE Logs SET ErrorLabels = ? WHERE Id = ?',
-            (error_id_str, log_id))
-
-        con.commit()
-        cur.close()
-        con.close()
+        get_metadata_repository().set_error_labels(log_id, error_ids)
 
         self.write('OK')
 
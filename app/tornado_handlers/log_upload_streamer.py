@@ -0,0 +1,142 @@
+"""
+Multipart streamer for log uploads: the log file is written directly to the
+log storage while it is received
+"""
+
+import hashlib
+import os
+import sys
+import uuid
+
+from pyulog import ULog
+
+# this is needed for the following imports
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '../plot_app'))
+from config import get_log_storage
+from helper import ULogEncDecryptor
+
+#pylint: disable=relative-beyond-top-level
+from .multipart_streamer import MultiPartStreamer, StreamedPart
+
+
+class LogFileStreamedPart(StreamedPart):
+    """
+    Uploaded log file part. The data is written to the staging file of a new
+    log id as it arrives, while computing the SHA-256 and checking the ULog
+    header. Encrypted (.ulge) files are decrypted on the fly.
+    Memory usage is independent of the file size.
+    """
+
+    def __init__(self, streamer, headers, ulge_key_path=None):
+        """
+        :param ulge_key_path: private key to decrypt the file with, or None if
+                              it is not encrypted
+        """
+        super().__init__(streamer, headers)
+        self._storage = get_log_storage()
+        while True:
+            self.log_id = str(uuid.uuid4())
+            if not self._storage.exists(self.log_id):
+                break
+        self.file_name = self._storage.get_staging_filename(self.log_id)
+        self.error = None # error message if the file is invalid
+        self.is_committed = False
+        self._sha256 = hashlib.sha256()
+        self._header = b''
+        self._num_bytes = 0
+        self._decryptor = None
+        if ulge_key_path:
+            try:
+                self._decryptor = ULogEncDecryptor(ulge_key_path)
+            except FileNotFoundError as e:
+                self.error = 'Decryption failed: ' + str(e)
+        self._f_out = open(self.file_name, 'wb')
+
+    def _fail(self, error):
+        """ stop writing the file, but keep receiving the stream """
+        self.error = error
+        self._f_out.close()
+
+    def feed(self, data):
+        """ decrypt, check, hash and write the next chunk of the file """
+        if self.error is not None:
+            return
+        if self._decryptor is not None:
+            try:
+                data = self._decryptor.decrypt(data)
+            except ValueError as e:
+                self._fail('Decryption failed: ' + str(e))
+                return
+        header_len = len(ULog.HEADER_BYTES)
+        if len(self._header) < header_len:
+            self._header += bytes(data[:header_len - len(self._header)])
+            if self._header != ULog.HEADER_BYTES[:len(self._header)]:
+                self._fail('Decrypted file is not a valid ULog'
+                           if self._decryptor is not None else 'Invalid File')
+                return
+        self._sha256.update(data)
+        self._num_bytes += len(data)
+        self._f_out.write(data)
+
+    def finalize(self):
+        """ close the file and check that it is complete """
+        try:
+            if self.error is None:
+                self._f_out.close()
+                if self._decryptor is not None:
+                    try:
+                        self._decryptor.finalize()
+                    except ValueError as e:
+                        self.error = 'Decryption failed: ' + str(e)
+                if self.error is None and self._header != ULog.HEADER_BYTES:
+                    self.error = 'Invalid File'
+        finally:
+            super().finalize()
+
+    def get_sha256(self):
+        """ :return: hex SHA-256 of the (decrypted) log file """
+        return self._sha256.hexdigest()
+
+    def get_log_size(self):
+        """ :return: size of the (decrypted) log file in bytes """
+        return self._num_bytes
+
+    def commit(self):
+        """ store the log file in the log storage """
+        if self.error is not None:
+            raise RuntimeError('Cannot commit an invalid log file')
+        self._storage.commit(self.log_id, self.file_name)
+        self.is_committed = True
+
+    def release(self):
+        """ delete the staging file if the log was not committed """
+        try:
+            if not self.is_committed:
+                self._f_out.close()
+                if os.path.exists(self.file_name):
+                    os.unlink(self.file_name)
+        finally:
+            super().release()
+
+
+class LogUploadStreamer(MultiPartStreamer):
+    """ MultiPartStreamer that streams the 'filearg' file part into a
+    LogFileStreamedPart, all other parts into temporary files """
+
+    def __init__(self, total, ulge_key_path=None):
+        """
+        :param ulge_key_path: private key to decrypt .ulge uploads with (or
+                              None if decryption is not configured)
+        """
+        super().__init__(total)
+        self._ulge_key_path = ulge_key_path
+
+    def create_part(self, headers):
+        """ create a LogFileStreamedPart for the uploaded log file """
+        part = StreamedPart(self, headers)
+        if part.get_name() != 'filearg' or not part.is_file():
+            return super().create_part(headers)
+        ulge_key_path = None
+        if self._ulge_key_path and part.get_filename().lower().endswith('.ulge'):
+            ulge_key_path = self._ulge_key_path
+        return LogFileStreamedPart(self, headers, ulge_key_path)
@@ -40,7 +40,9 @@ class StreamedPart:
     def feed(self, data):
         """Feed data into the stream.
 
-        :param data: Binary string that has arrived from the client."""
+        :param data: Binary data that has arrived from the client, a
+                     bytes-like object (bytes, bytearray or memoryview). It is
+                     only valid during the call, copy it if it needs to be kept."""
         raise NotImplementedError
 
     def finalize(self):
@@ -229,15 +231,23 @@ class MultiPartStreamer:
     # be parsed without a valid encoding.
     header_encoding = "UTF-8"
 
+    # chunks of part data with at least this size are fed to the part without
+    # copying them into the receive buffer
+    MIN_DIRECT_FEED_SIZE = 32 * 1024
+
     def __init__(self, total):
         """Create a new PostDataStreamer
 
         :param total: Total number of bytes in the stream. This is what the http
                       client sends as the Content-Length header of the whole form.
         """
-        self.buf = b""
+        # receive buffer. Processed data is removed from the front after each
+        # chunk, which is cheap for a bytearray (no re-copy of the remaining data)
+        self.buf = bytearray()
+        self.pos = 0 # start of the unprocessed data in buf
         self.dlen = None
         self.delimiter = None
+        self.boundary = None # SEP + delimiter
         self.in_data = False
         self.headers = []
         self.parts = []
@@ -245,20 +255,21 @@ class MultiPartStreamer:
         self.received = 0
         self.part = None
 
-    def _get_raw_header(self, data):
-        """Return raw header data.
+    def _get_raw_header(self):
+        """Return the next raw header line from the buffer.
 
         Internal method. Do not call directly.
 
-        :param data: A string containing raw data from the form part
-        :return: A tuple of (header_value, tail) where header_value is the first
-                 line of the form part. If there is no first line yet (e.g. the
-                 whole data is a single line) then header_value will be None.
+        :return: The next line (without line separator) starting at ``pos``,
+                 which is advanced past it. If there is no complete line yet,
+                 then None is returned.
         """
-        idx = data.find(self.SEP)
-        if idx >= 0:
-            return data[:idx], data[idx + self.L_SEP:]
-        return None, data
+        idx = self.buf.find(self.SEP, self.pos)
+        if idx < 0:
+            return None
+        header = bytes(self.buf[self.pos:idx])
+        self.pos = idx + self.L_SEP
+        return header
 
     def _parse_header(self, header):
         """Parse raw header data.
@@ -316,41 +327,81 @@ class MultiPartStreamer:
         feeds binary data into created StreamedPart instances. You need to call
         this when a chunk of data is available for the part.
 
+        Part data is passed to StreamedPart.feed() as a bytes-like object
+        (bytes, bytearray or memoryview).
+
         This method may raise a ParseError if the received data is malformed.
         """
         self.received += len(chunk)
         self.on_progress(self.received, self.total)
+        if self.pos > 0: # drop the processed data
+            del self.buf[:self.pos]
+            self.pos = 0
+        if self.in_data and len(chunk) >= self.MIN_DIRECT_FEED_SIZE and \
+                self._feed_chunk(chunk):
+            return
         self.buf += chunk
+        self._parse()
+
+    def _feed_chunk(self, chunk):
+        """Internal method: fast path for a chunk within part data.
+
+        If the chunk does not contain the end of the part, it is fed to the
+        part directly, without copying it into the buffer. Only the tail needed
+        to detect a boundary spanning two chunks is kept in the buffer.
 
+        :return: False if the chunk needs to be parsed (it contains a boundary)
+        """
+        size = len(chunk)
+        keep = 2 * self.dlen
+        # a boundary within the chunk, or starting in the buffered tail
+        # (the buffer only contains the tail of the previous chunk here)
+        if chunk.find(self.boundary) >= 0 or \
+                self.boundary in self.buf + chunk[:len(self.boundary) - 1]:
+            return False
+        if self.buf:
+            self._feed_part(bytes(self.buf))
+        # chunk is immutable, so the memoryview does not need to be released
+        self._feed_part(memoryview(chunk)[:size - keep])
+        self.buf = bytearray(chunk[size - keep:])
+        return True
+
+    def _parse(self):
+        """Internal method to process the data in the buffer starting at ``pos``."""
         if not self.delimiter:
-            self.delimiter, self.buf = self._get_raw_header(self.buf)
-            if self.delimiter:
-                self.delimiter += self.SEP
+            delimiter = self._get_raw_header()
+            if delimiter:
+                self.delimiter = delimiter + self.SEP
                 self.dlen = len(self.delimiter)
-            elif len(self.buf) > 1000:
+                self.boundary = self.SEP + self.delimiter
+            elif len(self.buf) - self.pos > 1000:
                 raise ParseError("Cannot find multipart delimiter")
             else:
                 return
 
         while True:
             if self.in_data:
-                if len(self.buf) > 3 * self.dlen:
-                    idx = self.buf.find(self.SEP + self.delimiter)
+                if len(self.buf) - self.pos > 3 * self.dlen:
+                    # the boundary can only start in the retained tail of the
+                    # previous chunk or the new chunk, nothing else is scanned
+                    idx = self.buf.find(self.boundary, self.pos)
                     if idx >= 0:
-                        self._feed_part(self.buf[:idx])
+                        self._feed_buffer(idx)
                         self._end_part()
-                        self.buf = self.buf[idx + len(self.SEP + self.delimiter):]
+                        self.pos = idx + len(self.boundary)
                         self.in_data = False
                     else:
+                        # keep enough data to detect the closing delimiter
+                        # in data_complete()
                         limit = len(self.buf) - 2 * self.dlen
-                        self._feed_part(self.buf[:limit])
-                        self.buf = self.buf[limit:]
+                        self._feed_buffer(limit)
+                        self.pos = limit
                         return
                 else:
                     return
             if not self.in_data:
                 while True:
-                    header, self.buf = self._get_raw_header(self.buf)
+                    header = self._get_raw_header()
                     if header == b"":
                         assert self.delimiter
                         self.in_data = True
@@ -364,14 +415,21 @@ class MultiPartStreamer:
                         # Header is None, not enough data yet
                         return
 
+    def _feed_buffer(self, end):
+        """Internal method to feed the buffer from ``pos`` to end to the current part.
+
+        The data is copied: large chunks without boundary are not buffered (see
+        _feed_chunk), and for small amounts a copy is cheaper than a memoryview."""
+        self._feed_part(self.buf[self.pos:end])
+
     def data_complete(self):
         """Call this after the last receive() call, e.g. when all data arrived for the form.
 
         You MUST call this before using the parts."""
         if self.in_data:
-            idx = self.buf.rfind(self.SEP + self.delimiter[:-2])
-            if idx > 0:
-                self._feed_part(self.buf[:idx])
+            idx = self.buf.rfind(self.SEP + self.delimiter[:-2], self.pos)
+            if idx > self.pos:
+                self._feed_buffer(idx)
             self._end_part()
 
     def create_part(self, headers):
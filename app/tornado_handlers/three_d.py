@@ -31,7 +31,10 @@ class ThreeDHandler(TornadoRequestHandlerBase):
         log_id = self.get_argument('log')
         if not validate_log_id(log_id):
             raise tornado.web.HTTPError(400, 'Invalid Parameter')
-        log_file_name = get_log_filename(log_id)
+        try:
+            log_file_name = get_log_filename(log_id)
+        except FileNotFoundError as error:
+            raise tornado.web.HTTPError(404, 'Log not found') from error
         ulog = load_ulog_file(log_file_name)
 
         # extract the necessary information from the log
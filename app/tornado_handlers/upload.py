@@ -8,75 +8,113 @@ import json
 import os
 from html import escape
 import sys
-import uuid
 import binascii
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import tornado.web
 from tornado.ioloop import IOLoop
 
-from pyulog import ULog
 from pyulog.px4 import PX4ULog
 
 # this is needed for the following imports
 sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '../plot_app'))
-from db_entry import DBVehicleData, DBData
-from config import get_db_connection, get_http_protocol, get_domain_name, \
-    email_notifications_config, get_ulge_private_key_path
-from helper import get_total_flight_time, validate_url, get_log_filename, \
-    load_ulog_file, get_airframe_name, ULogException, ULogTimeoutException, \
-    decrypt_ulge_payload
-from overview_generator import generate_overview_img_from_id
+from db_entry import DBVehicleData, DBData, DBDataGenerated
+from config import get_http_protocol, get_domain_name, \
+    email_notifications_config, get_ulge_private_key_path, get_log_storage
+from db_repository import get_metadata_repository
+from helper import get_total_flight_time, get_total_flight_time_from_parameters, \
+    validate_url, load_ulog_file, get_airframe_name, ULogException, ULogTimeoutException
+from overview_generator import generate_overview_img_from_id, copy_overview_img
+from pid_analysis_plots import precompute_pid_analysis
+from log_parameters import store_parameters
 
 
 #pylint: disable=relative-beyond-top-level
 from .common import get_jinja_env, CustomHTTPError, generate_db_data_from_log_file, \
     TornadoRequestHandlerBase
 from .send_email import send_notification_email, send_flightreport_email
-from .multipart_streamer import MultiPartStreamer
+from .log_upload_streamer import LogUploadStreamer, LogFileStreamedPart
 
 
 UPLOAD_TEMPLATE = 'upload.html'
 
+# the PID analysis precomputation is CPU-heavy, so it runs in its own thread
+# instead of the default executor (which serves the downloads). Each queued job
+# keeps its ULog in memory, so only a few are queued; the analysis of the other
+# logs is computed when their page is opened.
+_pid_analysis_executor = ThreadPoolExecutor(max_workers=1)
+_pid_analysis_slots = threading.BoundedSemaphore(2)
+
 
 #pylint: disable=attribute-defined-outside-init,too-many-statements, unused-argument
 
 
-def update_vehicle_db_entry(cur, ulog, log_id, vehicle_name):
+def get_vehicle_db_entry(ulog, log_id, vehicle_name):
     """
-    Update the Vehicle DB entry
-    :param cur: DB cursor
+    Get the updated Vehicle DB entry
     :param ulog: ULog object
     :param vehicle_name: new vehicle name or '' if not updated
-    :return vehicle_data: DBVehicleData object
+    :return vehicle_data: DBVehicleData object (uuid is None if the log has no
+                          vehicle UUID)
     """
+    vehicle_uuid = None
+    if 'sys_uuid' in ulog.msg_info_dict:
+        vehicle_uuid = escape(ulog.msg_info_dict['sys_uuid'])
+    return _get_vehicle_db_entry(vehicle_uuid, get_total_flight_time(ulog),
+                                 log_id, vehicle_name)
+
 
+def get_duplicate_vehicle_db_entry(db_data_gen, log_id, vehicle_name):
+    """
+    Get the updated Vehicle DB entry of a log with the same content as an
+    existing one, from the data copied from it (the file is not parsed)
+    :param db_data_gen: DBDataGenerated object or None
+    :param vehicle_name: new vehicle name or '' if not updated
+    :return vehicle_data: DBVehicleData object (uuid is None if the log has no
+                          vehicle UUID)
+    """
+    if db_data_gen is None or db_data_gen.vehicle_uuid in (None, ''):
+        return DBVehicleData()
+    flight_time = None
+    parameters = get_metadata_repository().get_parameters(log_id)
+    if parameters is not None:
+        flight_time = get_total_flight_time_from_parameters(
+            {name: value for name, _, value, _, _ in parameters[0]})
+    return _get_vehicle_db_entry(db_data_gen.vehicle_uuid, flight_time,
+                                 log_id, vehicle_name)
+
+
+def _get_vehicle_db_entry(vehicle_uuid, flight_time, log_id, vehicle_name):
     vehicle_data = DBVehicleData()
-    if 'sys_uuid' in ulog.msg_info_dict:
-        vehicle_data.uuid = escape(ulog.msg_info_dict['sys_uuid'])
+    if vehicle_uuid is not None:
+        vehicle_data.uuid = vehicle_uuid
 
         if vehicle_name == '':
-            cur.execute('select Name '
-                        'from Vehicle where UUID = ?', [vehicle_data.uuid])
-            db_tuple = cur.fetchone()
-            if db_tuple is not None:
-                vehicle_data.name = db_tuple[0]
+            db_vehicle_data = get_metadata_repository().get_vehicle(vehicle_data.uuid)
+            if db_vehicle_data is not None:
+                vehicle_data.name = db_vehicle_data.name
             print('reading vehicle name from db:'+vehicle_data.name)
         else:
             vehicle_data.name = vehicle_name
             print('vehicle name from uploader:'+vehicle_data.name)
 
         vehicle_data.log_id = log_id
-        flight_time = get_total_flight_time(ulog)
         if flight_time is not None:
             vehicle_data.flight_time = flight_time
 
-        # update or insert the DB entry
-        cur.execute('insert or replace into Vehicle (UUID, LatestLogId, Name, FlightTime)'
-                    'values (?, ?, ?, ?)',
-                    [vehicle_data.uuid, vehicle_data.log_id, vehicle_data.name,
-                     vehicle_data.flight_time])
     return vehicle_data
 
 
+def _precompute_pid_analysis_maybe(ulog, blob_id):
+    """ queue the PID analysis precomputation of a log, unless too many are
+    queued already """
+    if not _pid_analysis_slots.acquire(blocking=False):
+        print('Not precomputing the PID analysis of {}: queue is full'.format(blob_id))
+        return
+    future = _pid_analysis_executor.submit(precompute_pid_analysis, ulog, blob_id)
+    future.add_done_callback(lambda _: _pid_analysis_slots.release())
+
+
 @tornado.web.stream_request_body
 class UploadHandler(TornadoRequestHandlerBase):
     """ Upload log file Tornado request handler: handles page requests and POST
@@ -85,6 +123,7 @@ class UploadHandler(TornadoRequestHandlerBase):
     def initialize(self):
         """ initialize the instance """
         self.multipart_streamer = None
+        self._processing = False
 
     def prepare(self):
         """ called before a new request """
@@ -96,30 +135,64 @@ class UploadHandler(TornadoRequestHandlerBase):
                 total = int(self.request.headers.get("Content-Length", "0"))
             except KeyError:
                 total = 0
-            self.multipart_streamer = MultiPartStreamer(total)
+            self.multipart_streamer = LogUploadStreamer(
+                total, get_ulge_private_key_path())
 
     def data_received(self, chunk):
         """ called whenever new data is received """
         if self.multipart_streamer:
             self.multipart_streamer.data_received(chunk)
 
+    def on_connection_close(self):
+        """ called if the client aborts the upload """
+        # once the upload is complete, post() releases the parts itself (the
+        # log file might be in the middle of being stored)
+        if self.multipart_streamer and not self._processing:
+            # remove the partially written log file
+            self.multipart_streamer.release_parts()
+            self.multipart_streamer = None
+        super().on_connection_close()
+
     def get(self, *args, **kwargs):
         """ GET request callback """
         template = get_jinja_env().get_template(UPLOAD_TEMPLATE)
         self.write(template.render())
 
-    def _generate_unique_log_filename(self):
-        """Generate a unique log filename that does not exist yet."""
-        while True:
-            log_id = str(uuid.uuid4())
-            new_file_name = get_log_filename(log_id)
-            if not os.path.exists(new_file_name):
-                return log_id, new_file_name
-
-
-    def post(self, *args, **kwargs):
+    @staticmethod
+    def _store_log_file(file_obj):
+        """ store an uploaded log file, unless a log with the same content
+        exists already
+        :return: tuple (id of the existing log or None, blob id of the file)
+        """
+        duplicate = get_metadata_repository().find_log_by_content_hash(
+            file_obj.get_sha256())
+        if duplicate is not None:
+            return duplicate
+        file_obj.commit()
+        return None, file_obj.log_id
+
+    @staticmethod
+    def _link_duplicate(log_id, source_log_id, blob_id, file_obj):
+        """ reuse the data extracted from an existing log with the same
+        content for a new log entry
+        :return: DBDataGenerated or None if the existing log has none
+        """
+        repository = get_metadata_repository()
+        has_generated = repository.copy_log_data(source_log_id, log_id)
+        # the file might have been deleted in the meantime (the new entry
+        # references it now, so it won't be deleted anymore afterwards)
+        if not get_log_storage().exists(blob_id):
+            print('Log file {} was deleted, storing the upload'.format(blob_id))
+            file_obj.commit()
+            repository.set_blob_id(log_id, log_id)
+        if has_generated:
+            return repository.get_generated(log_id)
+        return None
+
+    async def post(self, *args, **kwargs):
         """ POST request callback """
         if self.multipart_streamer:
+            self._processing = True
             try:
                 self.multipart_streamer.data_complete()
                 form_data = self.multipart_streamer.get_values(
@@ -184,40 +257,17 @@ class UploadHandler(TornadoRequestHandlerBase):
                 file_obj = self.multipart_streamer.get_parts_by_name('filearg')[0]
                 upload_file_name = file_obj.get_filename()
 
-                # check if the file is encrypted
-                ulge_key_path = get_ulge_private_key_path()
-                if ulge_key_path and upload_file_name.lower().endswith('.ulge'):
-                    file_payload = file_obj.get_payload()  # full content as bytes
-                    try:
-                        decrypted_data = decrypt_ulge_payload(
-                        file_payload,
-                        get_ulge_private_key_path()
-                    )
-
-                    except Exception as e:
-                        raise CustomHTTPError(400, f"Decryption failed: {str(e)}") from e
-
-                    if decrypted_data[:len(ULog.HEADER_BYTES)] != ULog.HEADER_BYTES:
-                        raise CustomHTTPError(400, "Decrypted file is not a valid ULog")
-
-                    # Write decrypted .ulg to disk
-                    log_id, new_file_name = self._generate_unique_log_filename()
-
-                    with open(new_file_name, 'wb') as output_file:
-                        output_file.write(decrypted_data)
-
-                    print(f"Decryption successful for {upload_file_name}, saved to {new_file_name}")
-
-                else:
-                    # Regular .ulg file
-                    log_id, new_file_name = self._generate_unique_log_filename()
-
-                    header_len = len(ULog.HEADER_BYTES)
-                    if file_obj.get_payload_partial(header_len) != ULog.HEADER_BYTES:
-                        raise CustomHTTPError(400, 'Invalid File')
-
-                    print('Moving uploaded file to', new_file_name)
-                    file_obj.move(new_file_name)
+                if not isinstance(file_obj, LogFileStreamedPart):
+                    raise CustomHTTPError(400, 'Invalid File')
+                if file_obj.error is not None:
+                    raise CustomHTTPError(400, file_obj.error)
+                log_id = file_obj.log_id
+                content_hash = file_obj.get_sha256()
+                # storing the file might upload it to the log storage
+                source_log_id, blob_id = await IOLoop.current().run_in_executor(
+                    None, self._store_log_file, file_obj)
+                print('Uploaded file', upload_file_name, 'stored as', log_id,
+                      '(sha256:', content_hash+', file:', blob_id+')')
 
                 if obfuscated == 1:
                     # TODO: randomize gps data, ...
@@ -228,34 +278,49 @@ class UploadHandler(TornadoRequestHandlerBase):
 
                 # Load the ulog file but only if not uploaded via CI.
                 # Then we open the DB connection.
+                # Known content is not parsed again (see below).
                 ulog = None
-                if source != 'CI':
-                    ulog_file_name = get_log_filename(log_id)
+                if source != 'CI' and source_log_id is None:
+                    # not via get_log_filename(): the log is not in the DB yet
+                    ulog_file_name = get_log_storage().get_local_filename(blob_id)
                     ulog = load_ulog_file(ulog_file_name)
 
                 # put additional data into a DB
-                con = get_db_connection()
-                try:
-                    cur = con.cursor()
-                    cur.execute(
-                        'insert into Logs (Id, Title, Description, '
-                        'OriginalFilename, Date, AllowForAnalysis, Obfuscated, '
-                        'Source, Email, WindSpeed, Rating, Feedback, Type, '
-                        'videoUrl, ErrorLabels, Public, Token) values '
-                        '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
-                        [log_id, title, description, upload_file_name,
-                         datetime.datetime.now(), allow_for_analysis,
-                         obfuscated, source, stored_email, wind_speed, rating,
-                         feedback, upload_type, video_url, error_labels, is_public, token])
-
-                    if ulog is not None:
-                        vehicle_data = update_vehicle_db_entry(cur, ulog, log_id, vehicle_name)
+                vehicle_data = None
+                if ulog is not None:
+                    vehicle_data = get_vehicle_db_entry(ulog, log_id, vehicle_name)
+                    vehicle_name = vehicle_data.name
+                    if vehicle_data.uuid is None:
+                        vehicle_data = None
+                get_metadata_repository().insert_log({
+                    'Id': log_id, 'Title': title, 'Description': description,
+                    'OriginalFilename': upload_file_name,
+                    'Date': datetime.datetime.now(),
+                    'AllowForAnalysis': allow_for_analysis, 'Obfuscated': obfuscated,
+                    'Source': source, 'Email': stored_email, 'WindSpeed': wind_speed,
+                    'Rating': rating, 'Feedback': feedback, 'Type': upload_type,
+                    'VideoUrl': video_url, 'ErrorLabels': error_labels,
+                    'Public': is_public, 'Token': token,
+                    'ContentHash': content_hash, 'BlobId': blob_id}, vehicle_data)
+                db_data_gen = None
+                if ulog is not None:
+                    # for the parameter downloads
+                    store_parameters(log_id, ulog)
+                    # generated data & metrics (cheap, as the log is loaded already)
+                    db_data_gen = DBDataGenerated.from_ulog(ulog)
+                    get_metadata_repository().insert_generated(log_id, db_data_gen)
+                    # the PID analysis page is slow, so prepare it in the background
+                    _precompute_pid_analysis_maybe(ulog, blob_id)
+                if source_log_id is not None:
+                    db_data_gen = await IOLoop.current().run_in_executor(
+                        None, self._link_duplicate, log_id, source_log_id,
+                        blob_id, file_obj)
+                    if source != 'CI':
+                        vehicle_data = get_duplicate_vehicle_db_entry(
+                            db_data_gen, log_id, vehicle_name)
                         vehicle_name = vehicle_data.name
-
-                    con.commit()
-                    cur.close()
-                finally:
-                    con.close()
+                        if vehicle_data.uuid is not None:
+                            get_metadata_repository().update_vehicle(vehicle_data)
 
                 url = '/plot_app?log='+log_id
                 full_plot_url = get_http_protocol()+'://'+get_domain_name()+url
@@ -300,6 +365,13 @@ class UploadHandler(TornadoRequestHandlerBase):
                     if 'ver_sw' in ulog.msg_info_dict:
                         ver_sw = escape(ulog.msg_info_dict['ver_sw'])
                         info['software'] = ver_sw + branch_info
+                elif db_data_gen is not None:
+                    info['type'] = db_data_gen.mav_type
+                    info['airframe'] = str(db_data_gen.sys_autostart_id)
+                    info['hardware'] = db_data_gen.sys_hw
+                    if db_data_gen.sys_hw != 'SITL':
+                        info['uuid'] = db_data_gen.vehicle_uuid or ''
+                    info['software'] = db_data_gen.ver_sw
 
 
                 if upload_type == 'flightreport' and is_public and source != 'CI':
@@ -315,9 +387,12 @@ class UploadHandler(TornadoRequestHandlerBase):
                         email, info)
 
                     # generate the additional DB entry (opens its own connection)
-                    generate_db_data_from_log_file(log_id)
+                    if db_data_gen is None:
+                        generate_db_data_from_log_file(log_id)
                     # also generate the preview image
-                    IOLoop.instance().add_callback(generate_overview_img_from_id, log_id)
+                    if source_log_id is None or \
+                            not copy_overview_img(source_log_id, log_id):
+                        IOLoop.instance().add_callback(generate_overview_img_from_id, log_id)
 
                 # send notification emails
                 send_notification_email(email, full_plot_url, delete_url, info)
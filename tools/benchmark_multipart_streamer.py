@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+"""
+Throughput benchmark for the multipart/form-data parser used by the upload
+handler (app/tornado_handlers/multipart_streamer.py).
+
+Streams a synthetic multipart body (a few form fields and one large file
+part) in tornado-sized chunks through the current parser and through the
+previous implementation (which copied the accumulated buffer on every chunk)
+and reports the throughput of each. The body is generated on the fly, so a
+1 GB body does not need 1 GB of RAM.
+
+Usage:
+    python3 benchmark_multipart_streamer.py [--size-mb 1024] [--chunk-size 65536]
+"""
+
+import argparse
+import hashlib
+import os
+import random
+import sys
+import timeit
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             '../app/tornado_handlers'))
+# the path is only added at runtime
+#pylint: disable=wrong-import-position,import-error
+from multipart_streamer import MultiPartStreamer, StreamedPart, ParseError
+
+
+class BenchmarkStreamedPart(StreamedPart):
+    """ part that discards its data, optionally hashing it (to compare the
+    parser outputs) """
+
+    verify = False
+
+    def __init__(self, streamer, headers):
+        super().__init__(streamer, headers)
+        self.sha256 = hashlib.sha256()
+
+    def feed(self, data):
+        """ hash the data (if verifying) """
+        if self.verify:
+            self.sha256.update(data)
+
+    def get_payload(self):
+        """ the data is not kept """
+        return b''
+
+
+class PreviousMultiPartStreamer(MultiPartStreamer):
+    """ the parser before it was changed to scan a bytearray buffer in place:
+    the buffer is re-created (copied) for every chunk and fed part """
+
+    def __init__(self, total):
+        super().__init__(total)
+        # parser state of the previous implementation
+        self.buf = b""
+        self.received = 0
+        self.delimiter = None
+        self.dlen = None
+        self.in_data = False
+        self.headers = []
+
+    def create_part(self, headers):
+        """ create a part that discards its data """
+        return BenchmarkStreamedPart(self, headers)
+
+    @staticmethod
+    def _split_header(data):
+        idx = data.find(MultiPartStreamer.SEP)
+        if idx >= 0:
+            return data[:idx], data[idx + MultiPartStreamer.L_SEP:]
+        return None, data
+
+    def data_received(self, chunk):
+        """ previous implementation """
+        self.received += len(chunk)
+        self.on_progress(self.received, self.total)
+        self.buf += chunk
+
+        if not self.delimiter:
+            self.delimiter, self.buf = self._split_header(self.buf)
+            if self.delimiter:
+                self.delimiter += self.SEP
+                self.dlen = len(self.delimiter)
+            elif len(self.buf) > 1000:
+                raise ParseError("Cannot find multipart delimiter")
+            else:
+                return
+
+        while True:
+            if self.in_data:
+                if len(self.buf) > 3 * self.dlen:
+                    idx = self.buf.find(self.SEP + self.delimiter)
+                    if idx >= 0:
+                        self._feed_part(self.buf[:idx])
+                        self._end_part()
+                        self.buf = self.buf[idx + len(self.SEP + self.delimiter):]
+                        self.in_data = False
+                    else:
+                        limit = len(self.buf) - 2 * self.dlen
+                        self._feed_part(self.buf[:limit])
+                        self.buf = self.buf[limit:]
+                        return
+                else:
+                    return
+            if not self.in_data:
+                while True:
+                    header, self.buf = self._split_header(self.buf)
+                    if header == b"":
+                        self.in_data = True
+                        self._begin_part(self.headers)
+                        self.headers = []
+                        break
+
+                    if header:
+                        self.headers.append(self._parse_header(header))
+                    else:
+                        return
+
+    def data_complete(self):
+        """ previous implementation """
+        if self.in_data:
+            idx = self.buf.rfind(self.SEP + self.delimiter[:-2])
+            if idx > 0:
+                self._feed_part(self.buf[:idx])
+            self._end_part()
+
+
+class CurrentMultiPartStreamer(MultiPartStreamer):
+    """ the current parser, with the same parts """
+
+    def create_part(self, headers):
+        """ create a part that discards its data """
+        return BenchmarkStreamedPart(self, headers)
+
+
+def generate_body(file_size, chunk_size, boundary=b'----BenchmarkBoundary7MA4YWxkTrZu0gW'):
+    """ generate the chunks of a multipart body with a few form fields and a
+    file part of file_size bytes """
+    fields = b''
+    for name, value in [(b'description', b'benchmark'), (b'email', b''),
+                        (b'type', b'personal')]:
+        fields += (b'--' + boundary + b'\r\nContent-Disposition: form-data; name="' +
+                   name + b'"\r\n\r\n' + value + b'\r\n')
+    fields += (b'--' + boundary + b'\r\nContent-Disposition: form-data; name="filearg"; '
+               b'filename="benchmark.ulg"\r\nContent-Type: application/octet-stream\r\n\r\n')
+    closing = b'\r\n--' + boundary + b'--\r\n'
+    # repeated (seeded) random block: the same content for all runs
+    block = random.Random(0).getrandbits(8 * 1024 * 1024).to_bytes(1024 * 1024, 'little')
+
+    def file_data():
+        remaining = file_size
+        while remaining > 0:
+            data = block[:remaining]
+            remaining -= len(data)
+            yield data
+
+    pending = fields
+    for data in file_data():
+        pending += data
+        offset = 0
+        while len(pending) - offset >= chunk_size:
+            yield pending[offset:offset + chunk_size]
+            offset += chunk_size
+        pending = pending[offset:]
+    pending += closing
+    for offset in range(0, len(pending), chunk_size):
+        yield pending[offset:offset + chunk_size]
+
+
+def run(streamer_class, file_size, chunk_size):
+    """ parse a body with a streamer class
+    :return: tuple (duration [s], total body size, sha256 of the file part)
+    """
+    chunks = generate_body(file_size, chunk_size)
+    streamer = streamer_class(0)
+    total = 0
+    duration = 0
+    for chunk in chunks:
+        total += len(chunk)
+        start = timeit.default_timer()
+        streamer.data_received(chunk)
+        duration += timeit.default_timer() - start
+    start = timeit.default_timer()
+    streamer.data_complete()
+    duration += timeit.default_timer() - start
+    file_part = streamer.get_parts_by_name('filearg')[0]
+    if file_part.size != file_size:
+        raise RuntimeError('Wrong file size: {:} != {:}'.format(file_part.size, file_size))
+    return duration, total, file_part.sha256.hexdigest()
+
+
+def main():
+    """ run the benchmark """
+    parser = argparse.ArgumentParser(description='Multipart parser throughput benchmark')
+    parser.add_argument('--size-mb', type=int, default=1024,
+                        help='size of the file part in MB (default=1024)')
+    parser.add_argument('--chunk-size', type=int, default=64 * 1024,
+                        help='size of the received chunks in bytes '
+                        '(default=65536, tornado\'s chunk size)')
+    parser.add_argument('--verify', action='store_true', default=False,
+                        help='check that both parsers return the same file content '
+                        '(hashing is included in the measured time)')
+    args = parser.parse_args()
+    BenchmarkStreamedPart.verify = args.verify
+
+    file_size = args.size_mb * 1024 * 1024
+    results = {}
+    for name, streamer_class in [('previous', PreviousMultiPartStreamer),
+                                 ('current', CurrentMultiPartStreamer)]:
+        duration, total, digest = run(streamer_class, file_size, args.chunk_size)
+        results[name] = (duration, digest)
+        print('{:>8}: {:8.3f} s, {:8.1f} MB/s (parser time only, {:} bytes)'.format(
+            name, duration, total / duration / 1e6, total))
+
+    if args.verify and results['previous'][1] != results['current'][1]:
+        print('Error: the parsers returned different file contents')
+        sys.exit(1)
+    print('speedup: {:.2f}x'.format(results['previous'][0] / results['current'][0]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+"""
+Benchmark for the VTOL tailsitter attitude & rate correction
+(app/plot_app/vtol_tailsitter.py) on long synthetic VTOL logs.
+
+Generates the attitude, angular velocity and rates setpoint topics of a
+tailsitter flight with many back-transitions and runs the current
+implementation (FW intervals with np.searchsorted, FW rotation only for the FW
+samples) and the previous one (three interval masks per array and FW interval,
+FW rotation of the full series), and checks that both return the same values.
+
+Usage:
+    python3 benchmark_tailsitter_orientation.py [--duration-min 120] [--transitions 100]
+"""
+
+import argparse
+import os
+import sys
+import timeit
+
+import numpy as np
+from scipy.spatial.transform import Rotation as Rot
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             '../app/plot_app'))
+from vtol_tailsitter import tailsitter_orientation # pylint: disable=wrong-import-position
+
+
+class BenchmarkDataset: #pylint: disable=too-few-public-methods
+    """ dataset of a topic (like pyulog's ULog.Data) """
+
+    def __init__(self, name, data):
+        self.name = name
+        self.multi_id = 0
+        self.data = data
+
+
+class BenchmarkULog:
+    """ log with a set of topics (like pyulog's ULog) """
+
+    def __init__(self, datasets):
+        self._datasets = datasets
+
+    def get_dataset(self, name):
+        """ get a copy of a dataset (the previous implementation modifies it) """
+        if name not in self._datasets:
+            raise IndexError('topic not found: '+name)
+        return BenchmarkDataset(name, {key: value.copy() for key, value
+                                       in self._datasets[name].items()})
+
+
+def generate_log(duration_s, attitude_rate, angular_velocity_rate, num_transitions, seed=0):
+    """ generate a tailsitter log with alternating MC & FW phases
+    :return: tuple (BenchmarkULog, vtol_states)
+    """
+    rng = np.random.default_rng(seed)
+    start_us = 10_000_000
+    end_us = start_us + int(duration_s * 1e6)
+
+    def timestamps(rate):
+        num_samples = int(duration_s * rate)
+        jitter = rng.integers(0, int(2e5 / rate), num_samples)
+        return np.sort(np.linspace(start_us, end_us, num_samples).astype(np.uint64) +
+                       jitter.astype(np.uint64))
+
+    def signal(num_samples):
+        return np.cumsum(rng.normal(0, 0.01, num_samples)).astype(np.float32)
+
+    attitude_t = timestamps(attitude_rate)
+    quat = rng.normal(size=(len(attitude_t), 4)) # random orientations
+    quat = (quat / np.linalg.norm(quat, axis=1, keepdims=True)).astype(np.float32)
+    attitude = {'timestamp': attitude_t}
+    for i in range(4):
+        attitude['q['+str(i)+']'] = quat[:, i]
+
+    angular_velocity_t = timestamps(angular_velocity_rate)
+    angular_velocity = {'timestamp': angular_velocity_t}
+    for i in range(3):
+        angular_velocity['xyz['+str(i)+']'] = signal(len(angular_velocity_t))
+
+    rates_setpoint_t = timestamps(attitude_rate)
+    rates_setpoint = {'timestamp': rates_setpoint_t}
+    for axis in ['roll', 'pitch', 'yaw']:
+        rates_setpoint[axis] = signal(len(rates_setpoint_t))
+
+    # MC -> transition -> FW -> transition -> MC ... (states: 1=transition, 2=FW, 3=MC)
+    change_times = np.sort(rng.uniform(start_us, end_us, 2 * num_transitions)).astype(np.uint64)
+    vtol_states = [(start_us, 3)]
+    for i, change_time in enumerate(change_times):
+        vtol_states.append((int(change_time), 1))
+        vtol_states.append((int(change_time) + 2_000_000, 2 if i % 2 == 0 else 3))
+    vtol_states.append((end_us, -1))
+
+    ulog = BenchmarkULog({'vehicle_attitude': attitude,
+                          'vehicle_angular_velocity': angular_velocity,
+                          'vehicle_rates_setpoint': rates_setpoint})
+    return ulog, vtol_states
+
+
+def previous_tailsitter_orientation(ulog, vtol_states):
+    """ the previous implementation (without the error handling) """
+    #pylint: disable=too-many-locals,too-many-statements
+    cur_dataset = ulog.get_dataset('vehicle_attitude')
+    quat_0 = cur_dataset.data['q[0]']
+    quat_1 = cur_dataset.data['q[1]']
+    quat_2 = cur_dataset.data['q[2]']
+    quat_3 = cur_dataset.data['q[3]']
+    quat_t = cur_dataset.data['timestamp']
+
+    rotations = Rot.from_quat(np.transpose(np.asarray([quat_0, quat_1, quat_2, quat_3])))
+    rpy = rotations.as_euler('xyz', degrees=True)
+    fw_rotation = Rot.from_euler('y', -90, degrees=True)
+    rpy_fw = (fw_rotation*rotations).as_euler('xyz', degrees=True)
+
+    roll = np.deg2rad(rpy[:, 2])
+    pitch = np.deg2rad(-1*rpy[:, 1])
+    yaw = -180-rpy[:, 0]
+    yaw[yaw > 180] = yaw[yaw > 180]-360
+    yaw[yaw < -180] = yaw[yaw < -180]+360
+    yaw = np.deg2rad(yaw)
+
+    roll_fw = np.deg2rad(rpy_fw[:, 2])
+    pitch_fw = np.deg2rad(-1*rpy_fw[:, 1])
+    yaw_fw = -180-rpy_fw[:, 0]
+    yaw_fw[yaw_fw > 180] = yaw_fw[yaw_fw > 180]-360
+    yaw_fw[yaw_fw < -180] = yaw_fw[yaw_fw < -180]+360
+    yaw_fw = np.deg2rad(yaw_fw)
+
+    is_vtol_fw = False
+    fw_start = np.nan
+    fw_end = np.nan
+    for i in vtol_states:
+        if is_vtol_fw:
+            fw_end = i[0]
+            roll[np.logical_and(quat_t > fw_start, quat_t < fw_end)] = \
+                            roll_fw[np.logical_and(quat_t > fw_start, quat_t < fw_end)]
+            pitch[np.logical_and(quat_t > fw_start, quat_t < fw_end)] = \
+                            pitch_fw[np.logical_and(quat_t > fw_start, quat_t < fw_end)]
+            yaw[np.logical_and(quat_t > fw_start, quat_t < fw_end)] = \
+                            yaw_fw[np.logical_and(quat_t > fw_start, quat_t < fw_end)]
+            is_vtol_fw = False
+        if i[1] == 2:
+            fw_start = i[0]
+            is_vtol_fw = True
+    vtol_attitude = {'roll': roll, 'pitch': pitch, 'yaw': yaw}
+
+    def correct_rates(dataset, roll_field, yaw_field):
+        rate_r = dataset.data[roll_field]
+        rate_y = dataset.data[yaw_field]
+        rate_t = dataset.data['timestamp']
+        rate_r_fw = rate_y*-1
+        rate_y_fw = rate_r*1
+        is_vtol_fw = False
+        fw_start = np.nan
+        fw_end = np.nan
+        for i in vtol_states:
+            if is_vtol_fw:
+                fw_end = i[0]
+                rate_r[np.logical_and(rate_t > fw_start, rate_t < fw_end)] = \
+                                rate_r_fw[np.logical_and(rate_t > fw_start, rate_t < fw_end)]
+                rate_y[np.logical_and(rate_t > fw_start, rate_t < fw_end)] = \
+                                rate_y_fw[np.logical_and(rate_t > fw_start, rate_t < fw_end)]
+                is_vtol_fw = False
+            if i[1] == 2:
+                fw_start = i[0]
+                is_vtol_fw = True
+        return rate_r, rate_y
+
+    cur_dataset = ulog.get_dataset('vehicle_angular_velocity')
+    w_r, w_y = correct_rates(cur_dataset, 'xyz[0]', 'xyz[2]')
+    vtol_rates = {'roll': w_r, 'pitch': cur_dataset.data['xyz[1]'], 'yaw': w_y}
+
+    setp_dataset = ulog.get_dataset('vehicle_rates_setpoint')
+    setp_r, setp_y = correct_rates(setp_dataset, 'roll', 'yaw')
+    vtol_rates_setpoint = {'roll': setp_r, 'pitch': setp_dataset.data['pitch'], 'yaw': setp_y}
+
+    return [vtol_attitude, vtol_rates, vtol_rates_setpoint]
+
+
+def run(function, ulog, vtol_states, repeat):
+    """ :return: tuple (minimum duration [s], result) """
+    durations = []
+    result = None
+    for _ in range(repeat):
+        start = timeit.default_timer()
+        result = function(ulog, vtol_states)
+        durations.append(timeit.default_timer() - start)
+    return min(durations), result
+
+
+def main():
+    """ run the benchmark """
+    parser = argparse.ArgumentParser(description='VTOL tailsitter correction benchmark')
+    parser.add_argument('--duration-min', type=float, default=120,
+                        help='log duration in minutes (default=120)')
+    parser.add_argument('--transitions', type=int, default=100,
+                        help='number of front-transitions (default=100)')
+    parser.add_argument('--attitude-rate', type=float, default=250,
+                        help='attitude & rates setpoint rate in Hz (default=250)')
+    parser.add_argument('--angular-velocity-rate', type=float, default=1000,
+                        help='angular velocity rate in Hz (default=1000)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of runs, the fastest is reported (default=3)')
+    args = parser.parse_args()
+
+    ulog, vtol_states = generate_log(args.duration_min * 60, args.attitude_rate,
+                                     args.angular_velocity_rate, args.transitions)
+    print('{:} attitude, {:} angular velocity samples, {:} VTOL states'.format(
+        len(ulog.get_dataset('vehicle_attitude').data['timestamp']),
+        len(ulog.get_dataset('vehicle_angular_velocity').data['timestamp']),
+        len(vtol_states)))
+
+    results = {}
+    for name, function in [('previous', previous_tailsitter_orientation),
+                           ('current', tailsitter_orientation)]:
+        duration, result = run(function, ulog, vtol_states, max(args.repeat, 1))
+        results[name] = (duration, result)
+        print('{:>8}: {:8.3f} s'.format(name, duration))
+
+    for previous, current in zip(results['previous'][1], results['current'][1]):
+        for axis in ['roll', 'pitch', 'yaw']:
+            if not np.allclose(previous[axis], current[axis], rtol=0, atol=1e-9):
+                print('Error: different results for', axis)
+                sys.exit(1)
+    print('speedup: {:.2f}x'.format(results['previous'][0] / results['current'][0]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""
+Checks the metadata repository (app/plot_app/db_repository.py) against the
+configured DB backend: inserts a few logs, reads them back through the
+repository methods used by the handlers & scripts and deletes them again.
+For PostgreSQL, it also checks that the connection pool waits for a free
+connection instead of failing when all connections are in use.
+
+Run it against a throwaway database, e.g. a local PostgreSQL stand-in:
+    docker run -d --rm -p 5432:5432 -e POSTGRES_PASSWORD=check postgres:16
+    # config_user.ini:
+    #   db_backend = postgresql
+    #   db_postgres_dsn = host=localhost user=postgres password=check
+    python3 app/setup_db.py
+    python3 tools/check_metadata_repository.py
+
+The logs use ids with a 'check-' prefix and are deleted at the end.
+"""
+
+import datetime
+import os
+import sys
+import threading
+import time
+import uuid
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             '../app/plot_app'))
+#pylint: disable=wrong-import-position
+from config import get_db_backend, get_db_connection, get_db_postgres_dsn
+from db_entry import DBDataGenerated, DBVehicleData
+from db_postgres import PostgresConnectionPool
+from db_repository import get_metadata_repository
+from log_metrics import LOG_METRICS_COLUMNS
+
+
+def check(condition, message):
+    """ exit with an error if condition is False """
+    if not condition:
+        print('Error:', message)
+        sys.exit(1)
+
+
+def check_query_conversion():
+    """ '?' in string literals is not a parameter, '%' is not a format """
+    con = get_db_connection(read_only=True)
+    try:
+        cur = con.cursor()
+        cur.execute("select 'a?b', '100%', ?", ['c'])
+        check(tuple(cur.fetchone()) == ('a?b', '100%', 'c'),
+              "'?' or '%' in a string literal was changed")
+        cur.close()
+    finally:
+        con.close()
+
+
+def create_log(prefix, index, date, **columns):
+    """ :return: insert_logs() entry of a public log """
+    log_id = '{}-{}'.format(prefix, index)
+    entry_columns = {'Id': log_id, 'Title': '', 'Description': 'check ?' + str(index),
+                     'OriginalFilename': 'check.ulg', 'Date': date,
+                     'AllowForAnalysis': 1, 'Obfuscated': 0, 'Source': 'webui',
+                     'Email': '', 'WindSpeed': 5, 'Rating': 'good', 'Feedback': '',
+                     'Type': 'flightreport', 'VideoUrl': '', 'ErrorLabels': '',
+                     'Public': 1, 'Token': 'token-' + log_id,
+                     'ContentHash': '{}-hash-{}'.format(prefix, index)}
+    entry_columns.update(columns)
+    return {'columns': entry_columns}
+
+
+def check_repository(prefix):
+    """ insert, read & delete logs through the repository """
+    repository = get_metadata_repository()
+    date = datetime.datetime(2020, 1, 1)
+
+    entries = [create_log(prefix, i, date + datetime.timedelta(days=i)) for i in range(2)]
+    db_data_gen = DBDataGenerated()
+    db_data_gen.duration_s = 120
+    db_data_gen.mav_type = 'Quadrotor'
+    db_data_gen.flight_modes = {2, 3}
+    db_data_gen.flight_mode_durations = [(2, 60), (3, 60)]
+    db_data_gen.version = 1
+    db_data_gen.metrics = dict.fromkeys(LOG_METRICS_COLUMNS)
+    db_data_gen.metrics['TotalDistance'] = 1000.
+    entries[0]['generated'] = db_data_gen
+    entries[0]['parameters'] = ([('MPC_XY_VEL_MAX', 9, 12., 12., None)],
+                                [(1000000, 'MPC_XY_VEL_MAX', 10.)])
+    vehicle_data = DBVehicleData()
+    vehicle_data.uuid = prefix + '-vehicle'
+    vehicle_data.log_id = entries[0]['columns']['Id']
+    vehicle_data.name = 'check'
+    vehicle_data.flight_time = 120
+    entries[0]['vehicle'] = vehicle_data
+    # duplicate upload of the first log, sharing its file
+    entries[1]['columns']['ContentHash'] = entries[0]['columns']['ContentHash']
+    entries[1]['columns']['BlobId'] = entries[0]['columns']['Id']
+    entries[1]['copy_from'] = entries[0]['columns']['Id']
+    log_ids = [entry['columns']['Id'] for entry in entries]
+
+    try:
+        repository.insert_logs(entries)
+        third = create_log(prefix, 2, date + datetime.timedelta(days=2), Public=0)
+        repository.insert_log(third['columns'])
+        log_ids.append(third['columns']['Id'])
+
+        check(repository.get_log_token(log_ids[0]) == 'token-' + log_ids[0], 'get_log_token')
+        db_data = repository.get_db_data(log_ids[1])
+        check(db_data is not None and db_data.description == 'check ?1', 'get_db_data')
+        repository.set_error_labels(log_ids[0], [3, 1])
+        check(repository.get_db_data(log_ids[0]).error_labels == [1, 3], 'error labels')
+
+        check(repository.get_blob_id(log_ids[1]) == log_ids[0], 'get_blob_id')
+        found = repository.find_log_by_content_hash(entries[0]['columns']['ContentHash'])
+        check(found is not None and found[1] == log_ids[0], 'find_log_by_content_hash')
+        for log_id in log_ids[:2]:
+            generated = repository.get_generated(log_id)
+            check(generated is not None and generated.duration_s == 120 and
+                  generated.flight_mode_durations == [(2, 60), (3, 60)],
+                  'get_generated of ' + log_id)
+            check(repository.get_log_metrics(log_id)['TotalDistance'] == 1000.,
+                  'get_log_metrics of ' + log_id)
+            check(repository.get_parameters(log_id) is not None,
+                  'get_parameters of ' + log_id)
+        check(repository.get_vehicle(vehicle_data.uuid).name == 'check', 'get_vehicle')
+
+        public_logs = [log[0] for log in repository.get_public_logs(
+            flight_modes=[3], metric_filters=[('TotalDistance', 500, None)],
+            order_by=('TotalDistance', True)) if log[0].startswith(prefix)]
+        check(sorted(public_logs) == log_ids[:2], 'get_public_logs filters')
+        check(any(log[0] == log_ids[2] for log in
+                  repository.get_logs(private_only=True, older_than=date.replace(year=2021))),
+              'get_logs')
+        intervals = repository.get_log_date_intervals(True, 24 * 3600)
+        check(sum(count for _, count in intervals) >= 2, 'get_log_date_intervals')
+
+        # the shared file is only unreferenced when both logs are deleted
+        _, unreferenced = repository.get_unreferenced_blob_ids([log_ids[0]])
+        check(unreferenced == [], 'blob referenced by the duplicate')
+        found, unreferenced = repository.delete_logs(log_ids)
+        check(sorted(found) == log_ids and unreferenced == sorted([log_ids[0], log_ids[2]]),
+              'delete_logs')
+        check(repository.get_generated(log_ids[1]) is None, 'generated data deleted')
+    finally:
+        repository.delete_logs(log_ids)
+        con = get_db_connection()
+        with con:
+            con.execute('delete from Vehicle where UUID = ?', [vehicle_data.uuid])
+        con.close()
+
+
+def check_postgres_pool_wait():
+    """ acquire() waits for a released connection (and times out) """
+    pool = PostgresConnectionPool(get_db_postgres_dsn(), 1, timeout=5)
+    connections = [pool.acquire(read_only=True) for _ in range(4)]
+    acquired = []
+    thread = threading.Thread(target=lambda: acquired.append(pool.acquire(read_only=True)))
+    thread.start()
+    time.sleep(0.5)
+    check(len(acquired) == 0, 'acquire() did not wait')
+    connections.pop().close()
+    thread.join()
+    check(len(acquired) == 1, 'acquire() did not get the released connection')
+    connections.extend(acquired)
+
+    pool = PostgresConnectionPool(get_db_postgres_dsn(), 1, timeout=0.2)
+    connections.extend(pool.acquire() for _ in range(4))
+    try:
+        pool.acquire()
+        check(False, 'acquire() did not time out')
+    except pool.psycopg2.pool.PoolError:
+        pass
+    for con in connections:
+        con.close()
+
+
+def main():
+    """ run the checks """
+    print('checking the {:} backend'.format(get_db_backend()))
+    check_query_conversion()
+    check_repository('check-' + str(uuid.uuid4()))
+    if get_db_backend() == 'postgresql':
+        check_postgres_pool_wait()
+    print('OK')
+
+
+if __name__ == '__main__':
+    main()
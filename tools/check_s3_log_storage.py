@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+"""
+Checks the S3 log storage (app/plot_app/log_storage.py) against a local
+in-memory stand-in for an S3-compatible object storage (like MinIO): uploads,
+the parallel ranged download into the local cache (incl. the ETag check and
+incomplete ranges), deletes and the LRU eviction of the cache.
+
+No S3 server or boto3 is needed.
+
+Usage:
+    python3 check_s3_log_storage.py
+"""
+
+import io
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             '../app/plot_app'))
+from log_storage import LocalFileCache, S3LogStorage # pylint: disable=wrong-import-position
+
+MB = 1024 * 1024
+
+
+class FakeClientError(Exception):
+    """ like botocore's ClientError """
+
+    def __init__(self, code):
+        super().__init__(code)
+        self.response = {'Error': {'Code': code}}
+
+
+class FakeS3Client:
+    """
+    in-memory object storage with the parts of the boto3 S3 client interface
+    used by S3LogStorage: head_object, (ranged) get_object with IfMatch,
+    upload_file & delete_object
+    """
+
+    class exceptions: #pylint: disable=invalid-name,too-few-public-methods
+        """ like boto3's client.exceptions """
+        ClientError = FakeClientError
+
+    def __init__(self, request_delay=0.05):
+        self._lock = threading.Lock()
+        self._objects = {} # (bucket, key) -> (data, etag)
+        self._version = 0
+        self._request_delay = request_delay
+        self._active_requests = 0
+        self.max_parallel_requests = 0
+        self.ranges = []
+        self.truncate_range = None # start of a range to return incomplete
+        self.on_get_object = None # callback before a get_object request
+
+    def put(self, bucket, key, data):
+        """ store an object (with a new ETag) """
+        with self._lock:
+            self._version += 1
+            self._objects[(bucket, key)] = (bytes(data), '"{:}"'.format(self._version))
+
+    def _get(self, bucket, key):
+        with self._lock:
+            obj = self._objects.get((bucket, key))
+        if obj is None:
+            raise FakeClientError('404')
+        return obj
+
+    def head_object(self, Bucket, Key): #pylint: disable=invalid-name
+        """ :return: dict with ContentLength & ETag """
+        data, etag = self._get(Bucket, Key)
+        return {'ContentLength': len(data), 'ETag': etag}
+
+    def get_object(self, Bucket, Key, IfMatch=None, Range=None): #pylint: disable=invalid-name
+        """ :return: dict with Body (file-like object) """
+        if self.on_get_object is not None:
+            self.on_get_object()
+        with self._lock:
+            self._active_requests += 1
+            self.max_parallel_requests = max(self.max_parallel_requests,
+                                             self._active_requests)
+        try:
+            time.sleep(self._request_delay)
+            data, etag = self._get(Bucket, Key)
+            if IfMatch is not None and IfMatch != etag:
+                raise FakeClientError('PreconditionFailed')
+            start, end = 0, len(data) - 1
+            if Range is not None:
+                start, end = [int(x) for x in Range[len('bytes='):].split('-')]
+            with self._lock:
+                self.ranges.append((start, end))
+            body = data[start:end + 1]
+            if start == self.truncate_range:
+                body = body[:len(body) // 2]
+            return {'Body': io.BytesIO(body)}
+        finally:
+            with self._lock:
+                self._active_requests -= 1
+
+    def upload_file(self, Filename, Bucket, Key): #pylint: disable=invalid-name
+        """ upload a local file """
+        with open(Filename, 'rb') as log_file:
+            self.put(Bucket, Key, log_file.read())
+
+    def delete_object(self, Bucket, Key): #pylint: disable=invalid-name
+        """ delete an object (not an error if it does not exist) """
+        with self._lock:
+            self._objects.pop((Bucket, Key), None)
+
+
+def check(condition, message):
+    """ exit with an error if condition is False """
+    if not condition:
+        print('Error:', message)
+        sys.exit(1)
+
+
+def store_log(storage, log_id, data):
+    """ store a new log file through the staging file, like uploads do """
+    file_name = storage.get_staging_filename(log_id)
+    with open(file_name, 'wb') as log_file:
+        log_file.write(data)
+    storage.commit(log_id, file_name)
+
+
+def check_upload_download(temp_dir):
+    """ upload, parallel ranged download & delete """
+    client = FakeS3Client()
+    cache = LocalFileCache(os.path.join(temp_dir, 'cache'), 100 * MB)
+    storage = S3LogStorage(client, 'bucket', 'logs/', cache, num_connections=4,
+                           chunk_size=MB)
+    data = os.urandom(5 * MB + 12345)
+    store_log(storage, 'log1', data)
+    check(client.head_object('bucket', 'logs/log1.ulg')['ContentLength'] == len(data),
+          'upload')
+    check(cache.get('log1') is not None, 'uploaded file not cached')
+
+    # cold read
+    cache.remove('log1')
+    file_name = storage.get_local_filename('log1')
+    with open(file_name, 'rb') as log_file:
+        check(log_file.read() == data, 'downloaded data differs')
+    check(sorted(client.ranges) == [(start, min(start + MB, len(data)) - 1)
+                                    for start in range(0, len(data), MB)],
+          'unexpected ranges: {}'.format(client.ranges))
+    check(client.max_parallel_requests > 1, 'ranges not fetched in parallel')
+
+    # hot read
+    client.ranges = []
+    check(storage.get_local_filename('log1') == file_name and not client.ranges,
+          'cached file not used')
+
+    # not found
+    check(not os.path.exists(storage.get_local_filename('missing')), 'missing log')
+    check(not storage.exists('missing') and storage.get_size('missing') is None,
+          'missing log exists')
+
+    check(storage.delete('log1') and not storage.exists('log1'), 'delete')
+    check(cache.get('log1') is None, 'deleted file still cached')
+    check(not storage.delete('log1'), 'delete of a deleted log')
+
+
+def check_download_errors(temp_dir):
+    """ an incomplete range or a changed object fail the download without
+    leaving a (partial) cache entry """
+    client = FakeS3Client(request_delay=0)
+    cache = LocalFileCache(os.path.join(temp_dir, 'cache_errors'), 100 * MB)
+    storage = S3LogStorage(client, 'bucket', '', cache, chunk_size=MB)
+    client.put('bucket', 'log2.ulg', os.urandom(3 * MB))
+
+    client.truncate_range = MB
+    try:
+        storage.get_local_filename('log2')
+        check(False, 'incomplete range not detected')
+    except IOError as error:
+        check('Incomplete download' in str(error), 'unexpected error: {}'.format(error))
+    client.truncate_range = None
+
+    # the object is replaced during the download
+    client.on_get_object = lambda: client.put('bucket', 'log2.ulg', os.urandom(3 * MB))
+    try:
+        storage.get_local_filename('log2')
+        check(False, 'changed object not detected')
+    except FakeClientError as error:
+        check(error.response['Error']['Code'] == 'PreconditionFailed',
+              'unexpected error: {}'.format(error))
+    client.on_get_object = None
+
+    check(os.listdir(os.path.join(temp_dir, 'cache_errors')) == [],
+          'partial download left in the cache')
+    check(os.path.exists(storage.get_local_filename('log2')), 'download after errors')
+
+
+def check_cache_eviction(temp_dir):
+    """ the least recently used files are evicted, recently used ones are kept """
+    cache = LocalFileCache(os.path.join(temp_dir, 'cache_eviction'), 3 * MB)
+    cache.MIN_AGE = 0
+    now = time.time()
+    for i in range(3):
+        file_name = cache.new_temp_filename()
+        with open(file_name, 'wb') as log_file:
+            log_file.write(b'\0' * MB)
+        cache.add('log{}'.format(i), file_name)
+        os.utime(cache.get_filename('log{}'.format(i)), (now - 100 + i, now - 100 + i))
+    cache.get('log0') # log1 is now the least recently used
+
+    file_name = cache.new_temp_filename()
+    with open(file_name, 'wb') as log_file:
+        log_file.write(b'\0' * MB)
+    cache.add('log3', file_name)
+    check(cache.get('log1') is None, 'least recently used file not evicted')
+    check(all(cache.get(key) is not None for key in ['log0', 'log2', 'log3']),
+          'recently used file evicted')
+
+    # recently used files are kept, even if over the limit
+    cache.MIN_AGE = 200
+    file_name = cache.new_temp_filename()
+    with open(file_name, 'wb') as log_file:
+        log_file.write(b'\0' * MB)
+    cache.add('log4', file_name)
+    check(all(cache.get(key) is not None for key in ['log0', 'log2', 'log3', 'log4']),
+          'file evicted within MIN_AGE')
+
+
+def main():
+    """ run the checks """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        check_upload_download(temp_dir)
+        check_download_errors(temp_dir)
+        check_cache_eviction(temp_dir)
+    print('OK')
+
+
+if __name__ == '__main__':
+    main()